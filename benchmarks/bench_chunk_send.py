@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+並行分塊發送基準測試
+比較 sendfile (零拷貝) 與 pread + memoryview (fallback) 兩種發送路徑的
+每 GB CPU 時間與吞吐量
+
+使用方式:
+    python benchmarks/bench_chunk_send.py                 # 預設 1024MB, 8 分塊
+    python benchmarks/bench_chunk_send.py --size-mb 4096 --chunks 8
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network.client import TransferClient, HAS_SENDFILE, optimize_socket
+
+
+def _drain_server(listener: socket.socket, connections: int):
+    """接收端 (獨立進程): 接收並丟棄數據，不計入發送端 CPU"""
+    def drain(conn):
+        buf = bytearray(262144)
+        while conn.recv_into(buf):
+            pass
+        conn.close()
+
+    threads = []
+    for _ in range(connections):
+        conn, _ = listener.accept()
+        t = threading.Thread(target=drain, args=(conn,), daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+
+def _cpu_seconds() -> float:
+    """本進程累計 CPU 時間 (user + system)"""
+    t = os.times()
+    return t.user + t.system
+
+
+def run_path(filepath: str, filesize: int, chunks: int, use_sendfile: bool) -> tuple:
+    """以指定路徑並行發送整個檔案，返回 (牆鐘秒數, CPU 秒數)"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(chunks)
+    port = listener.getsockname()[1]
+
+    receiver = multiprocessing.Process(target=_drain_server, args=(listener, chunks))
+    receiver.start()
+
+    client = TransferClient(on_status=lambda m: None)
+    chunk_size = filesize // chunks
+
+    with open(filepath, 'rb') as f:
+        fd = f.fileno()
+        socks = []
+        for _ in range(chunks):
+            s = socket.create_connection(('127.0.0.1', port))
+            optimize_socket(s)
+            socks.append(s)
+
+        def worker(i):
+            offset = i * chunk_size
+            size = filesize - offset if i == chunks - 1 else chunk_size
+            client._send_file_range(socks[i], fd, offset, size, use_sendfile=use_sendfile)
+            socks[i].close()
+
+        cpu_start = _cpu_seconds()
+        wall_start = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(chunks)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - wall_start
+        cpu = _cpu_seconds() - cpu_start
+
+    receiver.join()
+    listener.close()
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sendfile vs pread 分塊發送基準測試")
+    parser.add_argument("--size-mb", type=int, default=1024, help="測試檔案大小 (MB)")
+    parser.add_argument("--chunks", type=int, default=8, help="並行分塊數")
+    parser.add_argument("--rounds", type=int, default=3, help="每種路徑測試次數 (取最佳)")
+    args = parser.parse_args()
+
+    filesize = args.size_mb * 1024 * 1024
+    gb = filesize / (1024 ** 3)
+
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        block = os.urandom(1048576)
+        for _ in range(args.size_mb):
+            tmp.write(block)
+        filepath = tmp.name
+
+    try:
+        # 預熱 page cache，讓兩種路徑都從記憶體讀取
+        with open(filepath, 'rb') as f:
+            while f.read(8388608):
+                pass
+
+        paths = [("pread+memoryview", False)]
+        if HAS_SENDFILE:
+            paths.insert(0, ("sendfile", True))
+        else:
+            print("[INFO] 此平台不支援 os.sendfile，只測試 fallback 路徑")
+
+        print(f"檔案 {args.size_mb} MB, {args.chunks} 分塊, 各 {args.rounds} 輪")
+        print(f"{'路徑':<20}{'MB/s':>10}{'CPU 秒/GB':>14}")
+        for name, use_sendfile in paths:
+            best = None
+            for _ in range(args.rounds):
+                wall, cpu = run_path(filepath, filesize, args.chunks, use_sendfile)
+                if best is None or cpu < best[1]:
+                    best = (wall, cpu)
+            wall, cpu = best
+            speed = args.size_mb / wall if wall > 0 else 0
+            print(f"{name:<20}{speed:>10.1f}{cpu / gb:>14.3f}")
+    finally:
+        os.remove(filepath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+持久性模式基準測試
+以本機回環實際收發「大量小檔案的資料夾」與「單一大檔案」，
+比較各 DURABILITY_MODE (none / session / file / range) 的吞吐量代價
+
+接收目錄建立在 --dir 指定的位置 (預設為系統暫存目錄)，
+fsync 的代價取決於該處的檔案系統與磁碟，tmpfs 上各模式不會有差異
+
+使用方式:
+    python benchmarks/bench_durability.py
+    python benchmarks/bench_durability.py --files 5000 --file-kb 4 --big-mb 1024 --dir /mnt/data
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import network.server as server_module
+from network.server import TransferServer
+from network.client import TransferClient
+from utils.fileio import DURABILITY_LEVELS
+
+
+def _transfer(send, target: str) -> float:
+    """執行一次傳輸並等待完成，返回牆鐘秒數"""
+    result = []
+    done = threading.Event()
+    client = TransferClient(on_complete=lambda ok, msg: (result.append((ok, msg)), done.set()),
+                            on_status=lambda m: None)
+    start = time.perf_counter()
+    send(client)('127.0.0.1', target)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    client.close_sessions()
+
+    ok, msg = result[0]
+    if not ok:
+        raise RuntimeError(f"傳輸失敗: {msg}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="持久性模式基準測試")
+    parser.add_argument("--files", type=int, default=2000, help="資料夾中的小檔案數")
+    parser.add_argument("--file-kb", type=int, default=8, help="小檔案大小 (KB)")
+    parser.add_argument("--big-mb", type=int, default=256, help="大檔案大小 (MB)")
+    parser.add_argument("--dir", default=None, help="測試目錄 (接收端所在的檔案系統)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    receive_dir = os.path.join(workdir, "received")
+    os.makedirs(receive_dir)
+    server_module.RECEIVE_DIR = receive_dir
+
+    # 小檔案分散在 10 個子目錄 (也測到目錄 fsync)
+    folder = os.path.join(workdir, "folder")
+    payload = os.urandom(args.file_kb * 1024)
+    for i in range(args.files):
+        sub = os.path.join(folder, f"d{i % 10}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"f{i}.bin"), 'wb') as f:
+            f.write(payload)
+
+    big = os.path.join(workdir, "big.bin")
+    with open(big, 'wb') as f:
+        block = os.urandom(1048576)
+        for _ in range(args.big_mb):
+            f.write(block)
+
+    server = TransferServer(on_status=lambda m: None)
+    server.start()
+    time.sleep(0.3)
+
+    try:
+        print(f"資料夾 {args.files} x {args.file_kb}KB, 大檔案 {args.big_mb}MB, 接收目錄 {receive_dir}")
+        print(f"{'模式':<10}{'檔案/秒':>12}{'大檔案 MB/s':>16}{'fsync 批次':>14}")
+        for mode in DURABILITY_LEVELS:
+            server.durability = mode
+            batches = server._committer.batches
+
+            folder_time = _transfer(lambda c: c.send_folder, folder)
+            big_time = _transfer(lambda c: c.send_file, big)
+
+            for name in os.listdir(receive_dir):
+                path = os.path.join(receive_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+            files_per_sec = args.files / folder_time if folder_time > 0 else 0
+            big_speed = args.big_mb / big_time if big_time > 0 else 0
+            print(f"{mode:<10}{files_per_sec:>12.0f}{big_speed:>16.1f}"
+                  f"{server._committer.batches - batches:>14}")
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
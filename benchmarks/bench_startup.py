@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+啟動時間基準測試
+以子程序實際啟動 GUI，量測程序啟動到
+  - 匯入完成 (gui.app 模組載入完成)
+  - 第一次繪製 (視窗已顯示)
+  - 就緒 (網路模組已載入、發現與接收服務已啟動)
+的時間，取多次的中位數並與 STARTUP_FIRST_PAINT_BUDGET / STARTUP_READY_BUDGET 比較，超過預算時以狀態碼 1 結束
+
+沒有圖形環境 (無 DISPLAY) 時改為不建立視窗，只量測匯入與網路服務的啟動 (不含第一次繪製)
+子程序的 HOME 指向暫存目錄，不會在使用者的家目錄建立接收目錄
+
+使用方式:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _child():
+    """子程序: 啟動 GUI (或無視窗時直接啟動網路服務)，就緒後輸出各時間點 (time.time()) 並結束"""
+    marks = {"first_paint": None, "ready": None, "headless": False}
+    import tkinter as tk
+    import gui.app as app_module
+    marks["imported"] = time.time()
+
+    try:
+        app = app_module.PCPCSApp()
+    except tk.TclError:
+        app = None
+
+    if app is None:
+        marks["headless"] = True
+        from network.discovery import NetworkDiscovery
+        from network.server import TransferServer
+        from network.client import TransferClient
+        server = TransferServer(on_status=lambda m: None)
+        discovery = NetworkDiscovery(capacity=server.capacity)
+        TransferClient(on_status=lambda m: None, capacity=discovery.peer_capacity)
+        discovery.start()
+        server.start()
+        marks["ready"] = time.time()
+        discovery.stop()
+        server.stop()
+    else:
+        def poll():
+            if "ready" in app.startup_times:
+                marks.update(app.startup_times)
+                app._on_close()
+            else:
+                app.root.after(10, poll)
+
+        app.root.after(10, poll)
+        app.run()
+
+    print(json.dumps(marks), flush=True)
+
+
+def _run_once(home: str) -> dict:
+    env = dict(os.environ, HOME=home, USERPROFILE=home)
+    start = time.time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60).stdout
+    marks = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return {
+        "imported": marks["imported"] - start,
+        "first_paint": marks["first_paint"] - start if marks["first_paint"] else None,
+        "ready": marks["ready"] - start,
+        "headless": marks["headless"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PCPCS 啟動時間基準測試")
+    parser.add_argument("--runs", type=int, default=5, help="啟動次數 (取中位數)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child()
+        return
+
+    from utils.config import STARTUP_FIRST_PAINT_BUDGET, STARTUP_READY_BUDGET
+
+    home = tempfile.mkdtemp(prefix="pcpcs_startup_")
+    try:
+        runs = [_run_once(home) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    headless = runs[0]["headless"]
+    if headless:
+        print("無圖形環境: 未建立視窗，只量測匯入與網路服務啟動")
+    print(f"{'次':<4}{'匯入 ms':>10}{'第一次繪製 ms':>16}{'就緒 ms':>10}")
+    for index, run in enumerate(runs, 1):
+        paint = f"{run['first_paint'] * 1000:.0f}" if run["first_paint"] is not None else "-"
+        print(f"{index:<4}{run['imported'] * 1000:>10.0f}{paint:>16}{run['ready'] * 1000:>10.0f}")
+
+    ready = statistics.median(run["ready"] for run in runs)
+    over = ready > STARTUP_READY_BUDGET
+    print(f"就緒中位數 {ready * 1000:.0f}ms (預算 {STARTUP_READY_BUDGET * 1000:.0f}ms)")
+    if not headless:
+        paint = statistics.median(run["first_paint"] for run in runs)
+        over = over or paint > STARTUP_FIRST_PAINT_BUDGET
+        print(f"第一次繪製中位數 {paint * 1000:.0f}ms (預算 {STARTUP_FIRST_PAINT_BUDGET * 1000:.0f}ms)")
+    if over:
+        print("超過啟動時間預算")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
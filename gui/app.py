@@ -17,9 +17,7 @@ import time
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.config import get_hostname, get_local_ip, RECEIVE_DIR
-from network.discovery import NetworkDiscovery, PeerInfo
-from network.server import TransferServer
-from network.client import TransferClient
+# 網路模組在視窗第一次繪製之後才載入 (見 PCPCSApp._start_services)
 
 
 # 本地數據目錄
@@ -50,6 +48,10 @@ LANG = {
         "discovered_computers": "已發現的電腦",
         "rescan": "重新掃描",
         "manual_add_ip": "手動添加 IP",
+        "sweep_done": "網段掃描完成，找到 {count} 台電腦",
+        "target_low_space_title": "對方空間不足",
+        "target_low_space_msg": "{name} 的接收目錄只剩 {free}，此次傳輸需要 {size}。\n仍要發送嗎？",
+        "target_busy": "{name} 正在接收 {count} 個傳輸，速度可能較慢",
         "test_connection": "測試連接",
         "network_diagnostic": "網路診斷",
         "recent_connections": "最近連線",
@@ -211,6 +213,10 @@ LANG = {
         "discovered_computers": "Discovered Computers",
         "rescan": "Rescan",
         "manual_add_ip": "Add IP Manually",
+        "sweep_done": "Subnet sweep finished, {count} computers found",
+        "target_low_space_title": "Not Enough Space on Target",
+        "target_low_space_msg": "{name} has only {free} free in its receive folder, this transfer needs {size}.\nSend anyway?",
+        "target_busy": "{name} is receiving {count} transfers, this may be slower",
         "test_connection": "Test Connection",
         "network_diagnostic": "Network Diagnostic",
         "recent_connections": "Recent Connections",
@@ -463,25 +469,32 @@ class ChatHistory:
 
 
 class LanguageManager:
-    """語言管理"""
+    """語言管理 (settings.json 只在建立時讀取一次，之後讀取記憶體中的設定，寫入時同步更新)"""
 
     def __init__(self):
         self.settings_file = os.path.join(DATA_DIR, "settings.json")
-        self.current_lang = self._load_language()
+        self._settings = self._read_settings_file()
+        self.current_lang = self._settings.get("language", "zh-TW")
 
-    def _load_settings(self) -> dict:
+    def _read_settings_file(self) -> dict:
         if os.path.exists(self.settings_file):
             try:
                 with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    settings = json.load(f)
+                    if isinstance(settings, dict):
+                        return settings
             except:
                 pass
         return {}
 
+    def _load_settings(self) -> dict:
+        return dict(self._settings)
+
     def _save_settings(self, settings: dict):
         os.makedirs(DATA_DIR, exist_ok=True)
         with open(self.settings_file, 'w', encoding='utf-8') as f:
             json.dump(settings, f, ensure_ascii=False, indent=2)
+        self._settings = dict(settings)
 
     def get_last_selected_peer(self) -> tuple:
         """取得上次選擇的 peer"""
@@ -495,28 +508,10 @@ class LanguageManager:
         settings["last_peer_name"] = name
         self._save_settings(settings)
 
-    def _load_language(self) -> str:
-        if os.path.exists(self.settings_file):
-            try:
-                with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
-                    return settings.get("language", "zh-TW")
-            except:
-                pass
-        return "zh-TW"
-
     def save_language(self, lang: str):
-        os.makedirs(DATA_DIR, exist_ok=True)
-        settings = {}
-        if os.path.exists(self.settings_file):
-            try:
-                with open(self.settings_file, 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
-            except:
-                pass
+        settings = self._load_settings()
         settings["language"] = lang
-        with open(self.settings_file, 'w', encoding='utf-8') as f:
-            json.dump(settings, f, ensure_ascii=False, indent=2)
+        self._save_settings(settings)
         self.current_lang = lang
 
     def get(self, key: str, **kwargs) -> str:
@@ -550,6 +545,8 @@ class DiagnosticSystem:
         progress_callback: (step, total, message) -> None
         """
         total_steps = 5 if target_ip else 4
+        # 網路環境可能在啟動後改變 (例如連上 VPN)，診斷時重新探測
+        self.local_ip = get_local_ip(refresh=True)
 
         def report_progress(step, msg):
             if progress_callback:
@@ -1053,23 +1050,13 @@ class PCPCSApp:
         # 診斷系統
         self.diagnostic = DiagnosticSystem(self.lang_mgr)
 
-        # 網路元件
-        self.discovery = NetworkDiscovery(on_peer_update=self._on_peer_update)
-        self.server = TransferServer(
-            on_text_received=self._on_text_received,
-            on_file_received=self._on_file_received,
-            on_folder_received=self._on_folder_received,
-            on_progress=self._on_receive_progress,
-            on_folder_progress=self._on_folder_receive_progress,
-            on_status=self._log,
-            on_transfer_start=self._on_receive_start
-        )
-        self.client = TransferClient(
-            on_progress=self._on_send_progress,
-            on_status=self._log,
-            on_complete=self._on_send_complete,
-            on_folder_progress=self._on_folder_send_progress
-        )
+        # 網路元件 (第一次繪製後由 _start_services 建立)
+        self.server = None
+        self.discovery = None
+        self.client = None
+
+        # 啟動時間點 (time.time()): first_paint 視窗第一次繪製完成 / ready 網路服務已啟動
+        self.startup_times = {}
 
         # 資料夾傳輸狀態
         self.folder_transfer_active = False
@@ -1217,6 +1204,7 @@ class PCPCSApp:
         )
         self.peer_listbox.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
         self.peer_listbox.bind('<<ListboxSelect>>', self._on_peer_select)
+        self._peer_rows = []  # 各列對應的節點 IP (依列順序)，節點變動時只更新對應的列
 
         # 按鈕
         btn_frame = ttk.Frame(self.peer_labelframe, style='Card.TFrame')
@@ -1465,6 +1453,7 @@ class PCPCSApp:
         try:
             self.discovery.stop()
             self.server.stop()
+            self.client.close_sessions()
         except:
             pass
 
@@ -1483,6 +1472,7 @@ class PCPCSApp:
             self.recent_listbox.insert(tk.END, f"{hostname} ({ip})")
 
     def _on_recent_double_click(self, event):
+        from network.discovery import PeerInfo
         selection = self.recent_listbox.curselection()
         if selection:
             connections = self.recent_connections.load()
@@ -1492,10 +1482,8 @@ class PCPCSApp:
                 hostname = conn.get("hostname")
                 platform_name = conn.get("platform", "Unknown")
 
-                if ip not in self.discovery.peers:
-                    peer = PeerInfo(ip, hostname, platform_name)
-                    self.discovery.peers[ip] = peer
-                    self._update_peer_list(self.discovery.peers)
+                if self.discovery.registry.add(PeerInfo(ip, hostname, platform_name), replace=False):
+                    self._apply_peer_delta(self.discovery.registry.flush())
 
                 self.selected_peer_ip = ip
                 self.selected_peer_name = hostname
@@ -1510,36 +1498,67 @@ class PCPCSApp:
 
                 self._log(self._t("selected_recent", name=hostname))
 
-    def _on_peer_update(self, peers: dict):
-        self.root.after(0, lambda: self._update_peer_list(peers))
-
-    def _update_peer_list(self, peers: dict):
-        current_selection = self.selected_peer_ip
-        self.peer_listbox.delete(0, tk.END)
-
-        for ip, peer in peers.items():
-            status = "●" if peer.is_reachable else "○"
-            ping_str = f"{peer.ping_ms:.0f}ms" if peer.ping_ms else "---"
-            os_icon = "🐧" if "Linux" in peer.platform else "🪟" if "Windows" in peer.platform else "🍎" if "Darwin" in peer.platform else "💻"
-            display = f"{status} {os_icon} {peer.hostname} ({ip}) [{ping_str}]"
-            self.peer_listbox.insert(tk.END, display)
+    def _on_peer_update(self, delta):
+        self.root.after(0, lambda: self._apply_peer_delta(delta))
+
+    def _peer_display(self, peer) -> str:
+        # ● 正常 / ◐ 不穩定 (訊號延遲或量測常遺失) / ○ 不可達
+        status = "◐" if peer.unstable else "●" if peer.is_reachable else "○"
+        ping_str = f"{peer.ping_ms:.0f}ms" if peer.ping_ms is not None else "---"
+        if peer.ping_ms is not None and peer.link.samples > 1:
+            ping_str += f" ±{peer.link.jitter:.0f}"
+        loss = peer.link.loss_rate
+        if loss > 0:
+            ping_str += f" {loss:.0%}"
+        os_icon = "🐧" if "Linux" in peer.platform else "🪟" if "Windows" in peer.platform else "🍎" if "Darwin" in peer.platform else "💻"
+        # 對端公告的容量: ⇅ 進行中的接收數 / 💾 接收目錄剩餘空間
+        load_str = ""
+        capacity = peer.capacity
+        if capacity is not None and capacity.fresh:
+            if capacity.busy:
+                load_str += f" ⇅{capacity.transfers}"
+            if capacity.free is not None:
+                load_str += f" 💾{self._format_size(capacity.free)}"
+        return f"{status} {os_icon} {peer.hostname} ({peer.ip}) [{ping_str}]{load_str}"
+
+    def _apply_peer_delta(self, delta):
+        """
+        只更新有變動的列 (不重建整個列表)
+        以登錄表目前的狀態為準，延遲送達的舊變動也不會讓列表與登錄表不一致
+        """
+        for ip in delta.changed:
+            peer = self.discovery.registry.get(ip)
+            row = self._peer_rows.index(ip) if ip in self._peer_rows else None
+
+            if peer is None:
+                if row is not None:
+                    self.peer_listbox.delete(row)
+                    del self._peer_rows[row]
+                continue
+
+            display = self._peer_display(peer)
+            if row is None:
+                self.peer_listbox.insert(tk.END, display)
+                self._peer_rows.append(ip)
+                row = len(self._peer_rows) - 1
+            elif self.peer_listbox.get(row) != display:
+                self.peer_listbox.delete(row)
+                self.peer_listbox.insert(row, display)
+            else:
+                continue
 
-        if current_selection:
-            for i in range(self.peer_listbox.size()):
-                if current_selection in self.peer_listbox.get(i):
-                    self.peer_listbox.selection_set(i)
-                    break
+            if ip == self.selected_peer_ip:
+                self.peer_listbox.selection_set(row)
 
     def _on_peer_select(self, event):
         selection = self.peer_listbox.curselection()
-        if selection:
-            item = self.peer_listbox.get(selection[0])
-            import re
-            match = re.search(r'\((\d+\.\d+\.\d+\.\d+)\)', item)
-            if match:
-                self.selected_peer_ip = match.group(1)
-                hostname_match = re.search(r'[●○]\s+.\s+(.+?)\s+\(', item)
-                self.selected_peer_name = hostname_match.group(1) if hostname_match else self.selected_peer_ip
+        if selection and selection[0] < len(self._peer_rows):
+            # 由列對應的 IP 與登錄表取得名稱 (不解析顯示字串，狀態符號與格式可能改變)
+            ip = self._peer_rows[selection[0]]
+            peer = self.discovery.registry.get(ip)
+            if peer:
+                self.selected_peer_ip = ip
+                self.selected_peer_name = peer.hostname or ip
                 self.target_label.config(text=f"{self.selected_peer_name} ({self.selected_peer_ip})")
                 self._log(self._t("selected", name=self.selected_peer_name))
                 self._load_chat_history()
@@ -1547,21 +1566,20 @@ class PCPCSApp:
                 # 保存選擇的 peer (供重啟後恢復)
                 self.lang_mgr.set_last_selected_peer(self.selected_peer_ip, self.selected_peer_name)
 
-                if self.selected_peer_ip in self.discovery.peers:
-                    peer = self.discovery.peers[self.selected_peer_ip]
-                    self.recent_connections.add_connection(
-                        self.selected_peer_ip,
-                        self.selected_peer_name,
-                        peer.platform
-                    )
-                    self._update_recent_list()
+                self.recent_connections.add_connection(
+                    self.selected_peer_ip,
+                    self.selected_peer_name,
+                    peer.platform
+                )
+                self._update_recent_list()
 
     def _ensure_peer_exists(self, sender_ip: str, sender_name: str, sender_platform: str):
-        if sender_ip not in self.discovery.peers:
-            peer = PeerInfo(sender_ip, sender_name, sender_platform)
-            peer.is_reachable = True
-            self.discovery.peers[sender_ip] = peer
-            self.root.after(0, lambda: self._update_peer_list(self.discovery.peers))
+        from network.discovery import PeerInfo
+        peer = PeerInfo(sender_ip, sender_name, sender_platform)
+        peer.heard()
+        peer.evaluate()
+        # 由接收執行緒呼叫: 列表更新經由登錄表的合併通知送到 GUI
+        if self.discovery.registry.add(peer, replace=False):
             self._log(self._t("auto_add_peer", name=sender_name, ip=sender_ip))
 
     def _load_chat_history(self):
@@ -1695,8 +1713,15 @@ class PCPCSApp:
 
     def _refresh_peers(self):
         self._log(self._t("scanning"))
-        self.discovery.peers.clear()
-        self._update_peer_list({})
+        self.discovery.registry.clear()
+        self._apply_peer_delta(self.discovery.registry.flush())
+
+        # 除了等待廣播，也主動掃描網段 (網路擋住廣播時仍能找到電腦)
+        def do_sweep():
+            found = self.discovery.sweep()
+            self._log(self._t("sweep_done", count=len(found)))
+
+        threading.Thread(target=do_sweep, daemon=True).start()
 
     def _manual_ping(self):
         if not self.selected_peer_ip:
@@ -1722,14 +1747,15 @@ class PCPCSApp:
             self._log(self._t("trying_connect", ip=ip))
 
             def try_connect():
+                from network.discovery import PeerInfo
                 ping_result = self.discovery.manual_ping(ip)
                 hostname = f"Manual-{ip}"
                 platform_name = "Unknown"
 
                 peer = PeerInfo(ip, hostname, platform_name)
-                peer.ping_ms = ping_result
-                peer.is_reachable = ping_result is not None
-                self.discovery.peers[ip] = peer
+                peer.record_rtt(ping_result)
+                peer.evaluate()
+                self.discovery.registry.add(peer)
 
                 if ping_result:
                     self._log(self._t("add_success", ip=ip, ms=ping_result))
@@ -1737,7 +1763,7 @@ class PCPCSApp:
                     self._log(self._t("add_no_ping", ip=ip))
 
                 def select_peer():
-                    self._update_peer_list(self.discovery.peers)
+                    self._apply_peer_delta(self.discovery.registry.flush())
                     self.selected_peer_ip = ip
                     self.selected_peer_name = hostname
                     self.target_label.config(text=f"{hostname} ({ip})")
@@ -1939,6 +1965,26 @@ class PCPCSApp:
         self.send_btn.config(state='disabled')
         self.client.send_text(self.selected_peer_ip, text)
 
+    def _check_target_capacity(self, size: int) -> bool:
+        """
+        依選定對端公告的容量確認是否發送: 剩餘空間不足時詢問使用者，正忙碌時提示
+        (未公告容量的舊版對端直接發送)
+        """
+        capacity = self.discovery.peer_capacity(self.selected_peer_ip)
+        if capacity is None:
+            return True
+        name = self.selected_peer_name or self.selected_peer_ip
+        if not capacity.fits(size):
+            if not messagebox.askyesno(
+                self._t("target_low_space_title"),
+                self._t("target_low_space_msg", name=name,
+                        free=self._format_size(capacity.free), size=self._format_size(size))
+            ):
+                return False
+        if capacity.busy:
+            self._log(self._t("target_busy", name=name, count=capacity.transfers))
+        return True
+
     def _send_file(self):
         if not self.selected_peer_ip:
             messagebox.showwarning(self._t("hint"), self._t("select_target_first"))
@@ -1949,6 +1995,9 @@ class PCPCSApp:
             messagebox.showwarning(self._t("hint"), self._t("select_valid_file"))
             return
 
+        if not self._check_target_capacity(os.path.getsize(filepath)):
+            return
+
         self.transfer_size = os.path.getsize(filepath)
         self.transfer_start_time = time.time()
 
@@ -2000,6 +2049,9 @@ class PCPCSApp:
             messagebox.showwarning(self._t("hint"), self._t("folder_empty"))
             return
 
+        if not self._check_target_capacity(total_size):
+            return
+
         self.transfer_size = total_size
         self.transfer_start_time = time.time()
         self.folder_transfer_active = True
@@ -2340,14 +2392,52 @@ class PCPCSApp:
         self.root.after(0, _write)
 
     def _on_close(self):
-        self.discovery.stop()
-        self.server.stop()
+        if self.discovery:
+            self.discovery.stop()
+            self.server.stop()
+            self.client.close_sessions()
         self.root.destroy()
 
-    def run(self):
-        self._log(self._t("starting"))
+    def _start_services(self):
+        """載入網路模組、建立並啟動網路元件 (發現訊息公告接收端的容量)"""
+        from network.discovery import NetworkDiscovery
+        from network.server import TransferServer
+        from network.client import TransferClient
+
+        self.server = TransferServer(
+            on_text_received=self._on_text_received,
+            on_file_received=self._on_file_received,
+            on_folder_received=self._on_folder_received,
+            on_progress=self._on_receive_progress,
+            on_folder_progress=self._on_folder_receive_progress,
+            on_status=self._log,
+            on_transfer_start=self._on_receive_start
+        )
+        self.discovery = NetworkDiscovery(on_peer_update=self._on_peer_update,
+                                          cache_path=os.path.join(DATA_DIR, "peer_cache.json"),
+                                          capacity=self.server.capacity)
+        self.client = TransferClient(
+            on_progress=self._on_send_progress,
+            on_status=self._log,
+            on_complete=self._on_send_complete,
+            on_folder_progress=self._on_folder_send_progress,
+            link_stats=self.discovery.link_stats,
+            route=self.discovery.best_address,
+            paths=self.discovery.usable_addresses,
+            on_capabilities=self.discovery.remember_capabilities,
+            capacity=self.discovery.peer_capacity
+        )
         self.discovery.start()
         self.server.start()
+
+    def run(self):
+        # 先完成第一次繪製，再載入網路模組並啟動服務 (使用者先看到視窗)
+        self.root.update()
+        self.startup_times["first_paint"] = time.time()
+
+        self._log(self._t("starting"))
+        self._start_services()
+        self.startup_times["ready"] = time.time()
         self._log(self._t("service_started"))
         self._log(self._t("receive_location", path=RECEIVE_DIR))
 
@@ -36,6 +36,11 @@ def check_dependencies():
 
 def main():
     """主程式入口"""
+    # 打包後的執行檔以 spawn 啟動多程序接收的工作程序時需要 (未打包時不載入 multiprocessing)
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+
     print("=" * 50)
     print("  PCPCS - Perspic Cross PC Communication System")
     print("=" * 50)
@@ -1,3 +1,22 @@
-from .discovery import NetworkDiscovery, PeerInfo
-from .server import TransferServer
-from .client import TransferClient
+"""
+網路模組 (延遲載入: 取用時才匯入對應的子模組，只需要發現服務時不連帶載入傳輸模組)
+"""
+import importlib
+
+_EXPORTS = {
+    "NetworkDiscovery": "discovery",
+    "PeerInfo": "discovery",
+    "TransferServer": "server",
+    "TransferClient": "client",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,105 @@
+"""
+能力協商
+會話開始時雙方交換 HELLO (版本、壓縮、hash 演算法、協定版本、並行數、續傳、多路徑並行)
+各自挑選雙方都支援的最快路徑，結果依對端快取
+"""
+import hashlib
+import time
+from typing import Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    VERSION, PARALLEL_CONNECTIONS, WIRE_VERSIONS, WIRE_VERSION_JSON,
+    COMPRESSION_CODECS, HASH_ALGORITHMS
+)
+
+# 舊版對端 (不支援 HELLO) 的能力: 與 1.0.0 行為一致
+LEGACY_CAPABILITIES = {
+    "version": "1.0.0",
+    "compression": ["none"],
+    "hash": ["md5"],
+    "wire": [WIRE_VERSION_JSON],
+    "max_parallel": PARALLEL_CONNECTIONS,
+    "resume": True,
+    "multipath": False
+}
+
+# 已實作的壓縮方式
+SUPPORTED_COMPRESSION = ("none", "zlib")
+
+# hash 演算法建構函式
+HASH_FACTORIES = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+
+_hash_order: Optional[list] = None
+
+
+def new_hash(algo: str):
+    """建立 hash 物件 (未知演算法時使用 md5)"""
+    return HASH_FACTORIES.get(algo, hashlib.md5)()
+
+
+def _measure_hash_order() -> list:
+    """以 1MB 資料實測各演算法速度，由快到慢排序 (只在首次使用時執行)"""
+    sample = bytes(1048576)
+    timings = []
+    for algo in HASH_ALGORITHMS:
+        if algo not in HASH_FACTORIES:
+            continue
+        try:
+            start = time.perf_counter()
+            new_hash(algo).update(sample)
+            timings.append((time.perf_counter() - start, algo))
+        except ValueError:
+            # 例如 FIPS 模式下停用 md5
+            continue
+    return [algo for _, algo in sorted(timings)]
+
+
+def local_capabilities() -> dict:
+    """本機能力 (列表依偏好排序)"""
+    global _hash_order
+    if _hash_order is None:
+        _hash_order = _measure_hash_order()
+    return {
+        "version": VERSION,
+        "compression": [c for c in COMPRESSION_CODECS if c in SUPPORTED_COMPRESSION],
+        "hash": list(_hash_order),
+        "wire": list(WIRE_VERSIONS),
+        "max_parallel": PARALLEL_CONNECTIONS,
+        "resume": True,
+        "multipath": True
+    }
+
+
+def _pick(local: list, remote: list, default):
+    """依本機偏好挑選第一個雙方都支援的選項"""
+    for item in local:
+        if item in remote:
+            return item
+    return default
+
+
+def negotiate(remote: Optional[dict]) -> dict:
+    """
+    由對端能力計算協商結果
+    remote 為 None 表示舊版對端
+    """
+    local = local_capabilities()
+    remote = remote or LEGACY_CAPABILITIES
+    return {
+        "version": remote.get("version", "unknown"),
+        "compression": _pick(local["compression"], remote.get("compression", ["none"]), "none"),
+        "hash": _pick(local["hash"], remote.get("hash", ["md5"]), "md5"),
+        "wire": [v for v in local["wire"] if v in remote.get("wire", [WIRE_VERSION_JSON])] or [WIRE_VERSION_JSON],
+        "parallel": max(1, min(local["max_parallel"], int(remote.get("max_parallel", 1)))),
+        "resume": bool(remote.get("resume", False)),
+        "multipath": bool(remote.get("multipath", False))
+    }
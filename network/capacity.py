@@ -0,0 +1,99 @@
+"""
+節點容量公告
+發現訊息與量測回應 (PONG) 附帶精簡的 "cap" 欄位 (短鍵名，整個訊息仍在一個封包內):
+  f: 接收目錄剩餘空間 (MB)   b: 進行中的接收數   s: 連結速度 (Mbps)
+  v: 版本   p: 並行連接上限   m: 支援多路徑並行   w: 支援的線路格式
+發送端據此選擇目標 (空間不足、正忙碌) 與並行連接數；HELLO 協商仍為傳輸參數的依據
+"""
+import time
+from typing import List, Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import VERSION, PARALLEL_CONNECTIONS, WIRE_VERSIONS, CAPACITY_MAX_AGE, CAPACITY_SLOW_LINK
+
+_MB = 1048576
+
+
+def capacity_field(free: Optional[int], transfers: int, speed: Optional[int]) -> dict:
+    """本機的 "cap" 欄位 (free 為 bytes，無法取得的項目省略)"""
+    field = {"b": transfers, "v": VERSION, "p": PARALLEL_CONNECTIONS, "m": 1, "w": list(WIRE_VERSIONS)}
+    if free is not None:
+        field["f"] = free // _MB
+    if speed:
+        field["s"] = speed
+    return field
+
+
+def _count(value) -> Optional[int]:
+    return value if isinstance(value, int) and not isinstance(value, bool) and value >= 0 else None
+
+
+class PeerCapacity:
+    """對端最近一次公告的容量 (無法取得的項目為 None)"""
+    __slots__ = ("free", "transfers", "speed", "version", "max_parallel", "multipath", "wire", "received")
+
+    def __init__(self, free: Optional[int] = None, transfers: int = 0, speed: Optional[int] = None,
+                 version: Optional[str] = None, max_parallel: Optional[int] = None,
+                 multipath: bool = False, wire: Optional[List[int]] = None):
+        self.free = free                    # bytes
+        self.transfers = transfers
+        self.speed = speed                  # Mbps
+        self.version = version
+        self.max_parallel = max_parallel
+        self.multipath = multipath
+        self.wire = wire or []
+        self.received = time.monotonic()
+
+    @classmethod
+    def parse(cls, field) -> Optional["PeerCapacity"]:
+        """解析 "cap" 欄位 (格式不符時返回 None)"""
+        if not isinstance(field, dict):
+            return None
+        free = _count(field.get("f"))
+        version = field.get("v")
+        wire = field.get("w")
+        return cls(free=free * _MB if free is not None else None,
+                   transfers=_count(field.get("b")) or 0,
+                   speed=_count(field.get("s")) or None,
+                   version=version if isinstance(version, str) else None,
+                   max_parallel=_count(field.get("p")) or None,
+                   multipath=bool(field.get("m")),
+                   wire=[v for v in wire if isinstance(v, int)] if isinstance(wire, list) else None)
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() - self.received <= CAPACITY_MAX_AGE
+
+    @property
+    def busy(self) -> bool:
+        return self.transfers > 0
+
+    def fits(self, size: int) -> bool:
+        """size bytes 是否放得下 (剩餘空間未知時視為放得下)"""
+        return self.free is None or size <= self.free
+
+    def parallel_limit(self, streams: int) -> int:
+        """
+        依對端負載與連結速度調整並行連接數:
+        正在接收 n 個傳輸時只用 1/(n+1) (接收端的磁碟與頻寬由各傳輸分享，多開連接只會互相排隊)；
+        慢速連結 (CAPACITY_SLOW_LINK 以下) 最多 2 條
+        """
+        streams = max(1, streams // (self.transfers + 1))
+        if self.speed is not None and self.speed <= CAPACITY_SLOW_LINK:
+            streams = min(streams, 2)
+        return streams
+
+    def to_dict(self) -> dict:
+        return {
+            "free": self.free,
+            "transfers": self.transfers,
+            "speed": self.speed,
+            "version": self.version,
+            "max_parallel": self.max_parallel,
+            "multipath": self.multipath,
+            "wire": self.wire,
+            "age": round(time.monotonic() - self.received, 1)
+        }
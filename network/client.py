@@ -5,9 +5,11 @@ TCP 傳輸客戶端
 import socket
 import json
 import os
+import select
 import threading
 import time
-from typing import Callable, Optional
+from functools import partial
+from typing import Callable, Dict, Optional
 
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -17,16 +19,23 @@ from utils.config import (
     MSG_TYPE_TEXT, MSG_TYPE_FILE,
     MSG_TYPE_FOLDER_START, MSG_TYPE_FOLDER_FILE, MSG_TYPE_FOLDER_END,
     MSG_TYPE_PARALLEL_FILE, MSG_TYPE_PARALLEL_CHUNK, MSG_TYPE_PARALLEL_DONE,
-    RESP_ACK_STRIPPED, RESP_SKIP_STRIPPED, RESP_LENGTH,
+    MSG_TYPE_SESSION, SESSION_IDLE_TIMEOUT, SESSION_ACK_TIMEOUT, WIRE_VERSIONS, DATA_TIMEOUT,
+    RESP_ACK_STRIPPED, RESP_SKIP_STRIPPED, RESP_ERROR_STRIPPED, RESP_LENGTH, PEER_CAPS_TTL,
     SOCKET_SEND_BUFFER, SOCKET_RECV_BUFFER,
-    PARALLEL_CONNECTIONS, PARALLEL_CHUNK_SIZE, PARALLEL_PORT_START, PARALLEL_MIN_FILE_SIZE,
+    PARALLEL_CHUNK_SIZE, PARALLEL_PORT_START, PARALLEL_MIN_FILE_SIZE, PARALLEL_LOSSY_CHUNK_SIZE,
     get_hostname, get_platform
 )
+from network.protocol import parse_wire_response, create_codec
+from network.capabilities import local_capabilities, negotiate, new_hash
+from network.offload import get_offload
+from network.progress import ProgressTracker, RateLimit
+from network.multipath import StripePlan, stripe_size
+from network.session import PeerSession, SessionClosed
+from utils.fileio import CacheAdvisor
 
 # 高速發送塊大小 (256KB - 減少系統調用次數)
 SEND_CHUNK_SIZE = 262144
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import hashlib
 
 # 檢查是否支援 sendfile (Linux/macOS)
 try:
@@ -35,6 +44,25 @@ try:
 except AttributeError:
     HAS_SENDFILE = False
 
+# 以偏移量讀取 (不移動檔案位置，可多執行緒共用同一 fd)
+HAS_PREADV = hasattr(os, 'preadv')
+HAS_PREAD = hasattr(os, 'pread')
+_seek_lock = threading.Lock()  # 無 pread 的平台 (Windows) 共用 fd 時需在鎖內 seek + read
+
+
+def _read_at(fd: int, view: memoryview, offset: int) -> int:
+    """從 fd 的指定偏移量讀入緩衝區，返回讀取字節數"""
+    if HAS_PREADV:
+        return os.preadv(fd, [view], offset)
+    if HAS_PREAD:
+        data = os.pread(fd, len(view), offset)
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, len(view))
+    view[:len(data)] = data
+    return len(data)
+
 
 def optimize_socket(sock: socket.socket):
     """優化 socket 設定以獲得最大傳輸速度"""
@@ -52,15 +80,34 @@ class TransferClient:
                  on_progress: Optional[Callable] = None,
                  on_status: Optional[Callable] = None,
                  on_complete: Optional[Callable] = None,
-                 on_folder_progress: Optional[Callable] = None):
+                 on_folder_progress: Optional[Callable] = None,
+                 link_stats: Optional[Callable] = None,
+                 route: Optional[Callable] = None,
+                 paths: Optional[Callable] = None,
+                 on_capabilities: Optional[Callable] = None,
+                 capacity: Optional[Callable] = None):
         self.on_progress = on_progress
         self.on_status = on_status
         self.on_complete = on_complete
         self.on_folder_progress = on_folder_progress  # (current_file, total_files, file_name, file_progress, overall_progress)
+        self.link_stats = link_stats  # link_stats(ip) -> LinkStats 或 None，依鏈路品質調整傳輸參數
+        self.route = route  # route(ip) -> 要連接的位址 (多介面節點選擇目前最佳的路徑)
+        self.paths = paths  # paths(ip) -> 對端所有可用位址 (由佳到差)，並行傳輸分散到各路徑
+        self.on_capabilities = on_capabilities  # on_capabilities(ip, caps) 於協商完成後呼叫
+        self.capacity = capacity  # capacity(ip) -> 對端公告的 PeerCapacity 或 None，依對端負載調整並行數
         self.hostname = get_hostname()
         self.platform = get_platform()
         self._cancel_folder_transfer = False
 
+        # 持久會話 (每個對端一條長連接): 文字、小檔案與能力協商
+        # 資料夾與並行大檔案刻意不走會話，各自使用專用連接 (見 send_folder / send_file_parallel)
+        self._sessions: Dict[str, PeerSession] = {}
+        self._session_locks: Dict[str, threading.Lock] = {}
+        self._sessions_lock = threading.Lock()
+        self._legacy_peers: Dict[str, float] = {}  # 已確認的舊版對端 -> 確認時間 (PEER_CAPS_TTL 後重新偵測)
+        self._peer_caps: Dict[str, dict] = {}  # 協商後的對端能力 (依 IP 快取)
+        self._peer_caps_time: Dict[str, float] = {}  # 能力協商時間 (PEER_CAPS_TTL 後失效)
+
     def _log(self, message: str):
         """輸出狀態訊息"""
         if self.on_status:
@@ -86,13 +133,14 @@ class TransferClient:
         返回實際發送的字節數
         """
         sent = 0
-        start_time = time.time()
+        tracker = ProgressTracker(filesize, on_progress_callback)
 
         if HAS_SENDFILE:
             # 使用 zero-copy sendfile (Linux/macOS)
             with open(filepath, 'rb') as f:
                 fd = f.fileno()
                 sock_fd = sock.fileno()
+                cache = CacheAdvisor(fd, 0, filesize, 'read')
                 while sent < filesize:
                     try:
                         # sendfile 一次最多傳輸 2GB
@@ -101,65 +149,218 @@ class TransferClient:
                         if n == 0:
                             break
                         sent += n
+                        cache.advance(sent)
 
                         # 更新進度
-                        if on_progress_callback:
-                            elapsed = time.time() - start_time
-                            speed = sent / elapsed if elapsed > 0 else 0
-                            remaining = (filesize - sent) / speed if speed > 0 else 0
-                            on_progress_callback(sent, filesize, speed, remaining)
+                        tracker.set(0, sent)
                     except BlockingIOError:
                         continue
+                cache.finish()
         else:
             # Fallback: 普通 read/send
             with open(filepath, 'rb') as f:
+                cache = CacheAdvisor(f.fileno(), 0, filesize, 'read')
                 while sent < filesize:
                     chunk = f.read(FILE_CHUNK_SIZE)
                     if not chunk:
                         break
                     sock.sendall(chunk)
                     sent += len(chunk)
+                    cache.advance(sent)
 
                     # 更新進度
-                    if on_progress_callback:
-                        elapsed = time.time() - start_time
-                        speed = sent / elapsed if elapsed > 0 else 0
-                        remaining = (filesize - sent) / speed if speed > 0 else 0
-                        on_progress_callback(sent, filesize, speed, remaining)
+                    tracker.set(0, sent)
+                cache.finish()
 
+        tracker.finish()
         return sent
 
+    def _send_header(self, sock: socket.socket, header: dict):
+        """發送 4 bytes 長度 + JSON 標頭 (合併為單次系統調用)"""
+        header_json = json.dumps(header).encode('utf-8')
+        sock.sendall(len(header_json).to_bytes(4, 'big') + header_json)
+
+    def _address(self, target_ip: str) -> str:
+        """本次連接使用的位址 (會話、能力快取仍以 target_ip 為鍵)"""
+        address = self.route(target_ip) if self.route else target_ip
+        if address != target_ip:
+            self._log(f"經由 {address} 連接 {target_ip}")
+        return address
+
+    def _get_session(self, target_ip: str) -> Optional[PeerSession]:
+        """
+        取得或建立與對端的持久會話
+        對端為舊版 (不支援 SESSION) 時返回 None
+        """
+        with self._sessions_lock:
+            confirmed = self._legacy_peers.get(target_ip)
+            if confirmed is not None:
+                if time.monotonic() - confirmed < PEER_CAPS_TTL:
+                    return None
+                del self._legacy_peers[target_ip]
+            peer_lock = self._session_locks.setdefault(target_ip, threading.Lock())
+
+        with peer_lock:
+            session = self._sessions.get(target_ip)
+            if session and session.alive:
+                return session
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            optimize_socket(sock)
+            sock.settimeout(10)
+            try:
+                sock.connect((self._address(target_ip), TRANSFER_PORT))
+                self._send_header(sock, {
+                    "type": MSG_TYPE_SESSION,
+                    "sender": self.hostname,
+                    "platform": self.platform,
+                    "wire": list(WIRE_VERSIONS)
+                })
+                # 逾時、連接重置直接拋出 (不是舊版的證據)
+                data = self._recv_exact(sock, RESP_LENGTH)
+            except Exception:
+                sock.close()
+                raise
+
+            if data is None:
+                # 舊版伺服器不認識 SESSION，不回覆直接關閉連接
+                # 此時只改用舊版協定完成本次操作，待舊版回應確認後才記錄 (見 _confirm_legacy)
+                sock.close()
+                return None
+
+            response = data.decode('utf-8', 'replace').rstrip('_')
+            wire_version = parse_wire_response(response)
+            if wire_version is None:
+                sock.close()
+                if response == RESP_ERROR_STRIPPED:
+                    raise ConnectionError(f"對端忙碌，拒絕連接: {target_ip}")
+                raise ConnectionError(f"無法識別的會話回應: {response!r}")
+
+            sock.settimeout(SESSION_IDLE_TIMEOUT + SESSION_ACK_TIMEOUT)
+            session = PeerSession(sock, target_ip, create_codec(wire_version))
+
+            # 會話開始時交換能力，挑選雙方都支援的最快路徑
+            self._remember_caps(target_ip, negotiate(session.hello(local_capabilities())))
+            self._sessions[target_ip] = session
+            return session
+
+    def _remember_caps(self, target_ip: str, caps: dict):
+        with self._sessions_lock:
+            self._peer_caps[target_ip] = caps
+            self._peer_caps_time[target_ip] = time.monotonic()
+        if self.on_capabilities:
+            self.on_capabilities(target_ip, caps)
+
+    def _forget_caps(self, target_ip: str):
+        """使對端能力快取失效 (會話斷線、對端可能已重啟或升級)"""
+        with self._sessions_lock:
+            self._peer_caps.pop(target_ip, None)
+            self._peer_caps_time.pop(target_ip, None)
+
+    def _confirm_legacy(self, target_ip: str):
+        """舊版協定收到舊版確認 (b"OK")，記錄對端為舊版 (PEER_CAPS_TTL 內不再嘗試會話)"""
+        with self._sessions_lock:
+            self._legacy_peers[target_ip] = time.monotonic()
+        self._remember_caps(target_ip, negotiate(None))
+
+    def _cached_caps(self, target_ip: str) -> Optional[dict]:
+        """未過期的對端能力快取"""
+        with self._sessions_lock:
+            caps = self._peer_caps.get(target_ip)
+            if caps and time.monotonic() - self._peer_caps_time.get(target_ip, 0) < PEER_CAPS_TTL:
+                return caps
+        return None
+
+    def get_peer_capabilities(self, target_ip: str) -> dict:
+        """
+        取得與對端協商後的能力 (快取未過期則直接返回)
+        尚未協商時建立會話完成 HELLO；無法連接或尚未確認為舊版時返回舊版預設值 (不快取)
+        """
+        caps = self._cached_caps(target_ip)
+        if caps:
+            return caps
+        try:
+            self._get_session(target_ip)
+        except Exception:
+            return negotiate(None)
+        return self._cached_caps(target_ip) or negotiate(None)
+
+    def _session_call(self, target_ip: str, action: Callable):
+        """
+        在持久會話上執行操作，串流尚未送出就斷線時重建會話重送一次
+        已送出資料後斷線或等待確認超時 (SessionTimeout) 不重送，避免對端重複接收
+        對端不支援會話時返回 None (呼叫者改用舊版協定)
+        """
+        for attempt in range(2):
+            session = self._get_session(target_ip)
+            if session is None:
+                return None
+            try:
+                return action(session)
+            except SessionClosed as e:
+                session.close()
+                self._forget_caps(target_ip)
+                if attempt or not e.unsent:
+                    raise
+
+    def close_sessions(self):
+        """關閉所有持久會話"""
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            self._peer_caps.clear()
+            self._peer_caps_time.clear()
+        for session in sessions:
+            session.close()
+
+    def _send_text_legacy(self, target_ip: str, text_bytes: bytes) -> bool:
+        """舊版協定: 每則訊息一條連接"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        optimize_socket(sock)
+        sock.settimeout(10)
+        sock.connect((self._address(target_ip), TRANSFER_PORT))
+
+        # 準備標頭
+        header = {
+            "type": MSG_TYPE_TEXT,
+            "sender": self.hostname,
+            "platform": self.platform,
+            "length": len(text_bytes)
+        }
+        header_json = json.dumps(header).encode('utf-8')
+
+        # 發送標頭長度 + 標頭 + 內容
+        sock.sendall(len(header_json).to_bytes(4, 'big') + header_json + text_bytes)
+
+        # 等待確認
+        response = sock.recv(BUFFER_SIZE)
+        sock.close()
+        if response == b"OK":
+            self._confirm_legacy(target_ip)
+            return True
+        return False
+
     def send_text(self, target_ip: str, text: str) -> bool:
         """
-        發送文字訊息
+        發送文字訊息 (優先使用持久會話)
         """
         def _send():
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                optimize_socket(sock)
-                sock.settimeout(10)
-                sock.connect((target_ip, TRANSFER_PORT))
-
-                # 準備標頭
                 text_bytes = text.encode('utf-8')
-                header = {
+                # 寄件者資訊已在會話握手時送出
+                meta = {
                     "type": MSG_TYPE_TEXT,
-                    "sender": self.hostname,
-                    "platform": self.platform,
                     "length": len(text_bytes)
                 }
-                header_json = json.dumps(header).encode('utf-8')
-
-                # 發送標頭長度 + 標頭 + 內容
-                sock.send(len(header_json).to_bytes(4, 'big'))
-                sock.send(header_json)
-                sock.send(text_bytes)
+                response = self._session_call(
+                    target_ip, lambda session: session.send_bytes(meta, text_bytes))
 
-                # 等待確認
-                response = sock.recv(BUFFER_SIZE)
-                sock.close()
+                if response is None:
+                    ok = self._send_text_legacy(target_ip, text_bytes)
+                else:
+                    ok = response == RESP_ACK_STRIPPED
 
-                if response == b"OK":
+                if ok:
                     self._log(f"文字訊息已發送到 {target_ip}")
                     if self.on_complete:
                         self.on_complete(True, "文字發送成功")
@@ -181,11 +382,57 @@ class TransferClient:
         thread.start()
         return True
 
-    def _send_chunk_worker(self, target_ip: str, port: int, filepath: str,
+    def _send_file_range(self, sock: socket.socket, fd: int, offset: int, size: int,
+                         on_sent: Optional[Callable] = None,
+                         use_sendfile: bool = HAS_SENDFILE) -> int:
+        """
+        發送 fd 中 [offset, offset + size) 的數據
+        sendfile: 以偏移量零拷貝發送，不移動檔案位置，可多執行緒共用 fd
+        fallback: pread 讀入預分配緩衝區 + memoryview 發送
+        on_sent(sent) 於每次發送後回報累計字節數；返回實際發送的字節數
+        """
+        sent = 0
+        cache = CacheAdvisor(fd, offset, size, 'read', filesize=os.fstat(fd).st_size)
+
+        if use_sendfile:
+            sock_fd = sock.fileno()
+            timeout = sock.gettimeout()
+            while sent < size:
+                try:
+                    n = _sendfile(sock_fd, fd, offset + sent, min(size - sent, SEND_CHUNK_SIZE * 4))
+                except BlockingIOError:
+                    # 有超時設定的 socket 為非阻塞模式，等待可寫
+                    _, writable, _ = select.select([], [sock_fd], [], timeout)
+                    if not writable:
+                        raise socket.timeout("sendfile 超時")
+                    continue
+                if n == 0:
+                    break
+                sent += n
+                cache.advance(sent)
+                if on_sent:
+                    on_sent(sent)
+        else:
+            buf = bytearray(SEND_CHUNK_SIZE)
+            view = memoryview(buf)
+            while sent < size:
+                n = _read_at(fd, view[:min(SEND_CHUNK_SIZE, size - sent)], offset + sent)
+                if n == 0:
+                    break
+                sock.sendall(view[:n])
+                sent += n
+                cache.advance(sent)
+                if on_sent:
+                    on_sent(sent)
+
+        cache.finish()
+        return sent
+
+    def _send_chunk_worker(self, target_ip: str, port: int, fd: int,
                            chunk_id: int, start_offset: int, chunk_size: int,
-                           progress_dict: dict, lock: threading.Lock) -> bool:
+                           tracker: ProgressTracker) -> bool:
         """
-        並行傳輸的單個分塊工作者
+        並行傳輸的單個分塊工作者 (所有工作者共用同一個唯讀 fd)
         """
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -200,9 +447,7 @@ class TransferClient:
                 "offset": start_offset,
                 "size": chunk_size
             }
-            header_json = json.dumps(header).encode('utf-8')
-            sock.send(len(header_json).to_bytes(4, 'big'))
-            sock.send(header_json)
+            self._send_header(sock, header)
 
             # 等待 ACK
             response = self._recv_response(sock)
@@ -210,21 +455,8 @@ class TransferClient:
                 sock.close()
                 return False
 
-            # 發送分塊數據 (使用較大的塊減少系統調用)
-            sent = 0
-            with open(filepath, 'rb') as f:
-                f.seek(start_offset)
-                while sent < chunk_size:
-                    read_size = min(SEND_CHUNK_SIZE, chunk_size - sent)
-                    data = f.read(read_size)
-                    if not data:
-                        break
-                    sock.sendall(data)
-                    sent += len(data)
-
-                    # 更新進度
-                    with lock:
-                        progress_dict[chunk_id] = sent
+            # 發送分塊數據 (進度寫入本分塊自己的計數)
+            self._send_file_range(sock, fd, start_offset, chunk_size, partial(tracker.set, chunk_id))
 
             # 等待確認
             response = self._recv_response(sock)
@@ -235,9 +467,81 @@ class TransferClient:
             self._log(f"分塊 {chunk_id} 傳輸失敗: {e}")
             return False
 
+    def _send_stripe_worker(self, plan: StripePlan, stream: int, port: int, fd: int,
+                            tracker: ProgressTracker) -> bool:
+        """
+        多路徑並行傳輸的單個連接: 從 plan 依序領取條帶發送，直到沒有條帶
+        連接失敗時條帶放回佇列、該路徑停用，改經由其他可用路徑重新連接同一端口
+        """
+        base = 0    # 本連接已完成條帶的字節數 (進度)
+        while True:
+            address = plan.assign(stream)
+            if address is None:
+                return False
+            stripe = None
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                optimize_socket(sock)
+                sock.settimeout(10)
+                sock.connect((address, port))
+                sock.settimeout(DATA_TIMEOUT)
+                while True:
+                    stripe = plan.take()
+                    if stripe is None:
+                        # 關閉連接即通知接收端沒有更多條帶
+                        return True
+                    offset, size = stripe
+                    start = time.monotonic()
+                    self._send_header(sock, {
+                        "type": MSG_TYPE_PARALLEL_CHUNK,
+                        "chunk_id": stream,
+                        "offset": offset,
+                        "size": size
+                    })
+                    if self._recv_response(sock) != RESP_ACK_STRIPPED:
+                        raise Exception("接收端拒絕條帶")
+                    self._send_file_range(sock, fd, offset, size, lambda sent: tracker.set(stream, base + sent))
+                    if self._recv_response(sock) != RESP_ACK_STRIPPED:
+                        raise Exception("條帶未確認")
+                    plan.done(stripe, address, time.monotonic() - start)
+                    base += size
+                    stripe = None
+            except Exception as e:
+                tracker.set(stream, base)
+                plan.failed(stripe, address)
+                self._log(f"路徑 {address} 傳輸失敗，停用此路徑: {e}")
+            finally:
+                sock.close()
+
+    def _parallel_paths(self, target_ip: str, address: str) -> list:
+        """並行分塊可用的路徑 (主連接的位址在前)"""
+        paths = self.paths(target_ip) if self.paths else []
+        return [address] + [path for path in paths if path != address]
+
+    def _parallel_chunk_size(self, target_ip: str) -> int:
+        """依對端的量測遺失率選擇並行分塊大小"""
+        link = self.link_stats(target_ip) if self.link_stats else None
+        if link is not None and link.lossy:
+            self._log(f"鏈路不穩定 (量測遺失 {link.loss_rate:.0%})，改用 {PARALLEL_LOSSY_CHUNK_SIZE // 1048576}MB 分塊")
+            return PARALLEL_LOSSY_CHUNK_SIZE
+        return PARALLEL_CHUNK_SIZE
+
+    def _parallel_limit(self, target_ip: str, max_parallel: int) -> int:
+        """依對端公告的負載與連結速度調整並行連接上限 (見 PeerCapacity.parallel_limit)"""
+        capacity = self.capacity(target_ip) if self.capacity else None
+        if capacity is None:
+            return max_parallel
+        limit = capacity.parallel_limit(max_parallel)
+        if limit < max_parallel:
+            self._log(f"對端進行中的接收 {capacity.transfers} 個、連結 {capacity.speed or '?'} Mbps，"
+                      f"並行連接數 {max_parallel} → {limit}")
+        return limit
+
     def send_file_parallel(self, target_ip: str, filepath: str) -> bool:
         """
         使用多連接並行發送大檔案 (類似 FileZilla)
+        不走持久會話 (只用會話協商能力): 並行本身需要多條 TCP 連接，
+        且大量數據佔用會話窗口會讓同一對端的文字訊息排在後面
         """
         if not os.path.exists(filepath):
             self._log(f"檔案不存在: {filepath}")
@@ -250,30 +554,45 @@ class TransferClient:
                 filesize = os.path.getsize(filepath)
                 filename = os.path.basename(filepath)
 
+                # 整個傳輸 (主連接與所有分塊) 使用同一條路徑
+                address = self._address(target_ip)
+
+                # 計算分塊 (並行數不超過雙方協商的上限，對端忙碌時再減少；不穩定鏈路用較小分塊分散到更多連接)
+                # 協商在建立主連接前完成: 主連接不佔用對端的連接名額，也不會在協商期間閒置逾時
+                caps = self.get_peer_capabilities(target_ip)
+                max_parallel = self._parallel_limit(target_ip, caps["parallel"])
+                num_chunks = min(max_parallel, max(1, filesize // self._parallel_chunk_size(address)))
+                # 對端有多個可用位址且支援多路徑時，分塊連接分散到各路徑、以條帶佇列分配資料
+                paths = self._parallel_paths(target_ip, address) if caps["multipath"] else [address]
+                plan = None
+                chunks = []
+
+                if len(paths) > 1:
+                    num_chunks = min(max_parallel, max(num_chunks, len(paths)))
+                    plan = StripePlan(filesize, stripe_size(filesize, num_chunks), paths)
+                    chunks = [{"chunk_id": i, "port": PARALLEL_PORT_START + i} for i in range(num_chunks)]
+                    self._log(f"多路徑並行: {', '.join(paths)}")
+                else:
+                    chunk_size = filesize // num_chunks
+                    for i in range(num_chunks):
+                        start = i * chunk_size
+                        if i == num_chunks - 1:
+                            # 最後一塊包含剩餘所有字節
+                            size = filesize - start
+                        else:
+                            size = chunk_size
+                        chunks.append({
+                            "chunk_id": i,
+                            "offset": start,
+                            "size": size,
+                            "port": PARALLEL_PORT_START + i
+                        })
+
                 # 建立主控制連接
                 main_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 optimize_socket(main_sock)
                 main_sock.settimeout(30)
-                main_sock.connect((target_ip, TRANSFER_PORT))
-
-                # 計算分塊
-                num_chunks = min(PARALLEL_CONNECTIONS, max(1, filesize // PARALLEL_CHUNK_SIZE))
-                chunk_size = filesize // num_chunks
-                chunks = []
-
-                for i in range(num_chunks):
-                    start = i * chunk_size
-                    if i == num_chunks - 1:
-                        # 最後一塊包含剩餘所有字節
-                        size = filesize - start
-                    else:
-                        size = chunk_size
-                    chunks.append({
-                        "chunk_id": i,
-                        "offset": start,
-                        "size": size,
-                        "port": PARALLEL_PORT_START + i
-                    })
+                main_sock.connect((address, TRANSFER_PORT))
 
                 # 發送並行傳輸請求
                 header = {
@@ -285,6 +604,8 @@ class TransferClient:
                     "num_chunks": num_chunks,
                     "chunks": chunks
                 }
+                if plan is not None:
+                    header["multipath"] = 1
                 header_json = json.dumps(header).encode('utf-8')
                 main_sock.send(len(header_json).to_bytes(4, 'big'))
                 main_sock.send(header_json)
@@ -296,55 +617,49 @@ class TransferClient:
 
                 self._log(f"開始並行發送檔案: {filename} ({filesize} bytes, {num_chunks} 連接)")
 
-                # 進度追蹤
-                progress_dict = {i: 0 for i in range(num_chunks)}
-                lock = threading.Lock()
+                # 進度追蹤 (每個分塊一個計數，由工作者在發送時回報)
                 start_time = time.time()
 
-                # 啟動進度更新線程
-                progress_running = True
-                def update_progress():
-                    while progress_running:
-                        with lock:
-                            total_sent = sum(progress_dict.values())
-                        progress = (total_sent / filesize) * 100
-                        elapsed = time.time() - start_time
-                        speed = total_sent / elapsed if elapsed > 0 else 0
-                        remaining = (filesize - total_sent) / speed if speed > 0 else 0
+                def on_sent(total_sent, total, speed, remaining):
+                    if self.on_progress:
+                        progress = (total_sent / total) * 100
                         speed_mb = speed / (1024 * 1024)
                         time_str = self._format_time(remaining)
+                        self.on_progress(progress, f"{filename} ({speed_mb:.1f} MB/s, {time_str})")
 
-                        if self.on_progress:
-                            self.on_progress(progress, f"{filename} ({speed_mb:.1f} MB/s, {time_str})")
-                        time.sleep(0.1)
-
-                progress_thread = threading.Thread(target=update_progress, daemon=True)
-                progress_thread.start()
+                tracker = ProgressTracker(filesize, on_sent, streams=num_chunks)
 
-                # 並行發送所有分塊
-                with ThreadPoolExecutor(max_workers=num_chunks) as executor:
+                # 並行發送所有分塊 (共用同一個 fd，以偏移量讀取)
+                with open(filepath, 'rb') as src, ThreadPoolExecutor(max_workers=num_chunks) as executor:
                     futures = []
                     for chunk in chunks:
-                        future = executor.submit(
-                            self._send_chunk_worker,
-                            target_ip,
-                            chunk["port"],
-                            filepath,
-                            chunk["chunk_id"],
-                            chunk["offset"],
-                            chunk["size"],
-                            progress_dict,
-                            lock
-                        )
+                        if plan is not None:
+                            future = executor.submit(self._send_stripe_worker, plan, chunk["chunk_id"],
+                                                     chunk["port"], src.fileno(), tracker)
+                        else:
+                            future = executor.submit(
+                                self._send_chunk_worker,
+                                address,
+                                chunk["port"],
+                                src.fileno(),
+                                chunk["chunk_id"],
+                                chunk["offset"],
+                                chunk["size"],
+                                tracker
+                            )
                         futures.append(future)
 
                     # 等待所有分塊完成
                     results = [f.result() for f in as_completed(futures)]
 
-                progress_running = False
-
-                if not all(results):
+                if plan is not None:
+                    # 多路徑: 個別連接失敗不影響結果，所有條帶送達即成功
+                    self._log(f"各路徑: {plan.summary()}")
+                    if not plan.complete:
+                        raise Exception("所有路徑都失敗")
+                elif not all(results):
                     raise Exception("部分分塊傳輸失敗")
+                tracker.finish()
 
                 # 發送完成信號
                 done_header = {
@@ -402,25 +717,6 @@ class TransferClient:
                 filesize = os.path.getsize(filepath)
                 filename = os.path.basename(filepath)
 
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                optimize_socket(sock)
-                sock.settimeout(300)  # 5 分鐘超時 (大檔案)
-                sock.connect((target_ip, TRANSFER_PORT))
-
-                # 準備標頭
-                header = {
-                    "type": MSG_TYPE_FILE,
-                    "sender": self.hostname,
-                    "platform": self.platform,
-                    "filename": filename,
-                    "filesize": filesize
-                }
-                header_json = json.dumps(header).encode('utf-8')
-
-                # 發送標頭
-                sock.send(len(header_json).to_bytes(4, 'big'))
-                sock.send(header_json)
-
                 self._log(f"開始發送檔案: {filename} ({filesize} bytes)")
 
                 # 進度回調
@@ -431,15 +727,25 @@ class TransferClient:
                         time_str = self._format_time(remaining)
                         self.on_progress(progress, f"{filename} ({speed_mb:.1f} MB/s, {time_str})")
 
-                # 使用高效發送
-                self._send_file_data(sock, filepath, filesize, progress_callback)
-
-                # 等待確認
-                sock.settimeout(30)
-                response = sock.recv(BUFFER_SIZE)
-                sock.close()
+                def send_on_session(session):
+                    meta = {
+                        "type": MSG_TYPE_FILE,
+                        "filename": filename,
+                        "filesize": filesize
+                    }
+                    compression = self._peer_caps.get(target_ip, {}).get("compression", "none")
+                    if compression != "none":
+                        meta["compression"] = compression
+                    return session.send_file(meta, filepath, filesize, progress_callback)
+
+                response = self._session_call(target_ip, send_on_session)
+
+                if response is None:
+                    ok = self._send_file_legacy(target_ip, filepath, filename, filesize, progress_callback)
+                else:
+                    ok = response == RESP_ACK_STRIPPED
 
-                if response == b"OK":
+                if ok:
                     self._log(f"檔案已發送到 {target_ip}")
                     if self.on_complete:
                         self.on_complete(True, f"檔案 {filename} 發送成功")
@@ -461,11 +767,40 @@ class TransferClient:
         thread.start()
         return True
 
-    def _calculate_file_hash(self, filepath: str, quick: bool = True) -> str:
+    def _send_file_legacy(self, target_ip: str, filepath: str, filename: str, filesize: int,
+                          progress_callback: Optional[Callable] = None) -> bool:
+        """舊版協定: 每個檔案一條連接"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        optimize_socket(sock)
+        sock.settimeout(300)  # 5 分鐘超時 (大檔案)
+        sock.connect((self._address(target_ip), TRANSFER_PORT))
+
+        # 發送標頭
+        self._send_header(sock, {
+            "type": MSG_TYPE_FILE,
+            "sender": self.hostname,
+            "platform": self.platform,
+            "filename": filename,
+            "filesize": filesize
+        })
+
+        # 使用高效發送
+        self._send_file_data(sock, filepath, filesize, progress_callback)
+
+        # 等待確認
+        sock.settimeout(30)
+        response = sock.recv(BUFFER_SIZE)
+        sock.close()
+        if response == b"OK":
+            self._confirm_legacy(target_ip)
+            return True
+        return False
+
+    def _calculate_file_hash(self, filepath: str, quick: bool = True, algo: str = "md5") -> str:
         """
-        計算檔案的 hash
+        計算檔案的 hash (algo 為協商的演算法，舊版對端為 md5)
         quick=True: 只讀取檔案頭尾各 64KB + 檔案大小，速度快但不完全精確
-        quick=False: 完整 MD5 hash，精確但慢
+        quick=False: 完整 hash，精確但慢
 
         如果檔案無法讀取，返回空字串
         """
@@ -486,14 +821,12 @@ class TransferClient:
                     if filesize > 65536:
                         f.seek(-65536, 2)
                         hash_data += f.read(65536)
-                return hashlib.md5(hash_data).hexdigest()
+                hasher = new_hash(algo)
+                hasher.update(hash_data)
+                return hasher.hexdigest()
             else:
-                # 完整 MD5
-                hash_md5 = hashlib.md5()
-                with open(filepath, 'rb') as f:
-                    for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
-                        hash_md5.update(chunk)
-                return hash_md5.hexdigest()
+                # 完整 hash (大檔案交給程序池，以 mmap 讀取)
+                return get_offload().file_digest(filepath, algo)
         except (OSError, IOError) as e:
             self._log(f"無法計算檔案 hash: {filepath} - {e}")
             return ""
@@ -568,6 +901,8 @@ class TransferClient:
     def send_folder(self, target_ip: str, folder_path: str, resume_state: dict = None) -> bool:
         """
         發送資料夾（支援斷點續傳）
+        不走持久會話 (只用會話協商能力): 資料夾傳輸使用專用連接，以管線化的逐檔確認、
+        續傳比對與取消為單位，也避免長時間的批量數據阻塞同一對端的文字訊息
 
         resume_state: 續傳狀態，包含已完成的檔案列表
         """
@@ -599,14 +934,19 @@ class TransferClient:
                 if resume_state and 'completed' in resume_state:
                     completed_files = set(resume_state['completed'])
 
+                # 協商能力 (hash 演算法、協定版本、續傳)
+                caps = self.get_peer_capabilities(target_ip)
+                hash_algo = caps["hash"]
+
                 # 建立連接
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 optimize_socket(sock)
                 sock.settimeout(300)  # 5 分鐘超時
-                sock.connect((target_ip, TRANSFER_PORT))
+                sock.connect((self._address(target_ip), TRANSFER_PORT))
 
                 # 傳輸時間追蹤
                 transfer_start_time = time.time()
+                throttle = RateLimit()  # 檔案發送中的進度回呼節流
 
                 # 發送 FOLDER_START
                 header = {
@@ -615,16 +955,18 @@ class TransferClient:
                     "platform": self.platform,
                     "folder_name": folder_name,
                     "total_files": total_files,
-                    "total_size": total_size
+                    "total_size": total_size,
+                    "wire": caps["wire"],
+                    "hash_algo": hash_algo
                 }
-                header_json = json.dumps(header).encode('utf-8')
-                sock.send(len(header_json).to_bytes(4, 'big'))
-                sock.send(header_json)
+                self._send_header(sock, header)
 
-                # 等待 ACK
+                # 等待 ACK (新版伺服器回應選定的協定版本)
                 response = self._recv_response(sock)
-                if response != RESP_ACK_STRIPPED:
+                wire_version = parse_wire_response(response)
+                if wire_version is None:
                     raise Exception(f"FOLDER_START 未收到確認: {response}")
+                codec = create_codec(wire_version)
 
                 self._log(f"開始發送資料夾: {folder_name} ({total_files} 檔案, {total_size} bytes)")
 
@@ -658,8 +1000,8 @@ class TransferClient:
                         continue
 
                     try:
-                        # 計算檔案 hash
-                        file_hash = self._calculate_file_hash(filepath)
+                        # 計算檔案 hash (對端不支援續傳時不需比對)
+                        file_hash = self._calculate_file_hash(filepath, algo=hash_algo) if caps["resume"] else ""
 
                         # 發送 FOLDER_FILE 標頭
                         file_header = {
@@ -670,12 +1012,10 @@ class TransferClient:
                             "index": idx + 1,
                             "total": total_files
                         }
-                        file_header_json = json.dumps(file_header).encode('utf-8')
-                        sock.send(len(file_header_json).to_bytes(4, 'big'))
-                        sock.send(file_header_json)
+                        codec.send_header(sock, file_header)
 
                         # 等待回應（ACK 或 SKIP）
-                        response = self._recv_response(sock)
+                        response = codec.recv_response(sock)
 
                         if response == RESP_SKIP_STRIPPED:
                             # 檔案已存在且 hash 相同，跳過
@@ -702,6 +1042,7 @@ class TransferClient:
                             with open(filepath, 'rb') as f:
                                 fd = f.fileno()
                                 sock_fd = sock.fileno()
+                                cache = CacheAdvisor(fd, 0, filesize, 'read')
                                 while file_sent < filesize:
                                     if self._cancel_folder_transfer:
                                         raise Exception("傳輸已取消")
@@ -711,8 +1052,11 @@ class TransferClient:
                                         if n == 0:
                                             break
                                         file_sent += n
+                                        cache.advance(file_sent)
 
-                                        # 更新進度
+                                        # 更新進度 (節流，檔案最後一段一定送出)
+                                        if file_sent < filesize and not throttle.ready():
+                                            continue
                                         file_progress = (file_sent / filesize) * 100
                                         overall_progress = ((sent_size + file_sent) / total_size) * 100 if total_size > 0 else 100
 
@@ -732,9 +1076,11 @@ class TransferClient:
                                             self.on_progress(overall_progress, f"({idx + 1}/{total_files}) {rel_path} ({speed_mb:.1f} MB/s, {time_str})")
                                     except BlockingIOError:
                                         continue
+                                cache.finish()
                         else:
                             # Fallback: 普通 read/send
                             with open(filepath, 'rb') as f:
+                                cache = CacheAdvisor(f.fileno(), 0, filesize, 'read')
                                 while file_sent < filesize:
                                     if self._cancel_folder_transfer:
                                         raise Exception("傳輸已取消")
@@ -744,8 +1090,11 @@ class TransferClient:
                                         break
                                     sock.sendall(chunk)
                                     file_sent += len(chunk)
+                                    cache.advance(file_sent)
 
-                                    # 更新進度
+                                    # 更新進度 (節流，檔案最後一段一定送出)
+                                    if file_sent < filesize and not throttle.ready():
+                                        continue
                                     file_progress = (file_sent / filesize) * 100 if filesize > 0 else 100
                                     overall_progress = ((sent_size + file_sent) / total_size) * 100 if total_size > 0 else 100
 
@@ -763,9 +1112,10 @@ class TransferClient:
 
                                     if self.on_progress:
                                         self.on_progress(overall_progress, f"({idx + 1}/{total_files}) {rel_path} ({speed_mb:.1f} MB/s, {time_str})")
+                                cache.finish()
 
                         # 等待檔案傳輸確認
-                        response = self._recv_response(sock)
+                        response = codec.recv_response(sock)
                         if response != RESP_ACK_STRIPPED:
                             raise Exception(f"傳輸確認失敗: {response}")
 
@@ -795,12 +1145,10 @@ class TransferClient:
                     "total_sent": success_count,
                     "total_failed": len(failed_files)
                 }
-                end_header_json = json.dumps(end_header).encode('utf-8')
-                sock.send(len(end_header_json).to_bytes(4, 'big'))
-                sock.send(end_header_json)
+                codec.send_header(sock, end_header)
 
                 # 等待最終確認
-                response = self._recv_response(sock)
+                response = codec.recv_response(sock)
                 sock.close()
 
                 if response == RESP_ACK_STRIPPED:
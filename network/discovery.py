@@ -1,29 +1,51 @@
 """
 網路發現模組
 使用 UDP 廣播自動發現區域網路內的其他 PCPCS 節點
-包含 Ping 測試功能
+包含延遲量測 (見 network.probe) 與其 UDP echo 回應
+多介面主機 (有線 + 無線 / VPN) 在每個介面的網段廣播，訊息附帶節點 id 與本機所有位址；
+同一節點的多個位址合併為一個 PeerInfo，分別量測，傳輸時由 best_address() 選擇路徑
+指定 cache_path 時啟動即量測上次的節點 (見 network.peercache)；廣播被擋時可用 sweep() 主動掃描網段
+發現訊息與 PONG 附帶本機容量 (剩餘空間、進行中的接收數等，見 network.capacity)，供發送端選擇目標與並行數
 """
 import socket
 import json
+import random
 import threading
 import time
-import subprocess
-import platform
-from typing import Dict, Callable, Optional
+import uuid
+from typing import Dict, Callable, List, Optional, Set
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.config import (
-    DISCOVERY_PORT, BROADCAST_INTERVAL, PING_TIMEOUT,
-    MSG_TYPE_DISCOVERY, MSG_TYPE_RESPONSE,
+    DISCOVERY_PORT, BROADCAST_INTERVAL, PING_INTERVAL, PEER_TIMEOUT, PEER_UPDATE_DEBOUNCE,
+    PEER_PHI_WARN, PEER_PHI_SUSPECT, PEER_PHI_DEAD, PEER_CACHE_SAVE_INTERVAL,
+    MSG_TYPE_DISCOVERY, MSG_TYPE_RESPONSE, MSG_TYPE_PING, MSG_TYPE_PONG, MSG_TYPE_PING_REQ, MSG_TYPE_GOSSIP,
+    MEMBERSHIP_MODE, SWEEP_ENABLED, SWEEP_INTERVAL, SWEEP_SUBNETS, SWEEP_MAX_HOSTS, SWEEP_CONFIRM_WAIT,
+    DISCOVERY_MAX_PACKET, CAPACITY_REFRESH,
     get_hostname, get_platform, get_local_ip
 )
+from network.probe import RttProber, pong_message, tcp_sweep
+from network.health import LinkStats, PhiAccrual
+from network.membership import GossipMembership, ALIVE, DEAD, supersedes, STATE_CODES
+from network.peercache import PeerCache
+from network.capacity import PeerCapacity, capacity_field
+from utils.netif import list_interfaces, interface_for, subnet_hosts, KIND_VPN
 
 
 class PeerInfo:
-    """節點資訊類"""
+    """
+    節點資訊類 (由 PeerRegistry 持有，欄位只在登錄表的鎖內修改)
+    ping_ms 為平滑後的 RTT；is_reachable 由故障偵測的懷疑程度 phi 決定，單次量測失敗不會讓節點變成不可達
+    gossip 成員 (state 不為 None) 的可達性則由成員狀態決定 (我們很少直接收到個別成員的訊號)
+    addresses 為節點的所有位址 → 各自的 RTT 統計；ip 為主要位址 (最先發現的位址)，link 為其統計
+    """
+    __slots__ = ("ip", "hostname", "platform", "last_seen", "ping_ms", "is_reachable",
+                 "link", "detector", "phi", "heard_from", "state", "incarnation", "node", "addresses", "caps",
+                 "capacity")
+
     def __init__(self, ip: str, hostname: str, platform_name: str):
         self.ip = ip
         self.hostname = hostname
@@ -31,6 +53,58 @@ class PeerInfo:
         self.last_seen = time.time()
         self.ping_ms: Optional[float] = None
         self.is_reachable = False
+        self.link = LinkStats()
+        self.detector = PhiAccrual()
+        self.phi = 0.0
+        self.heard_from = False     # 是否收到過節點的訊號 (手動加入且量測失敗的節點為 False)
+        self.state: Optional[str] = None    # gossip 成員狀態 (ALIVE / SUSPECT)，非 gossip 對端為 None
+        self.incarnation = 0
+        self.node: Optional[str] = None     # 節點 id (舊版對端不提供)
+        self.addresses: Dict[str, LinkStats] = {ip: self.link}
+        self.caps: Optional[dict] = None    # 最近一次協商後的能力 (供快取與診斷)
+        self.capacity: Optional[PeerCapacity] = None  # 最近一次公告的容量 (舊版對端不提供)
+
+    def heard(self):
+        """收到節點的訊號 (廣播、量測回應、傳入的連接)"""
+        self.last_seen = time.time()
+        self.heard_from = True
+        self.detector.heartbeat()
+
+    def record_rtt(self, rtt: Optional[float], alive: bool = True, address: Optional[str] = None):
+        """
+        記錄一次量測結果 (None 表示無回應)，address 為量測的位址 (預設為主要位址)
+        alive=False 表示只有主機回應 (傳輸端口拒絕連接)，延遲照常記錄，但不算是程式仍在執行的訊號
+        任一位址的回應都算是節點的訊號
+        """
+        self.addresses.get(address, self.link).add(rtt)
+        self.ping_ms = self.link.srtt
+        if rtt is not None and alive:
+            self.heard()
+
+    def evaluate(self) -> float:
+        """重新計算懷疑程度與可達性，返回 phi"""
+        self.phi = self.detector.phi()
+        if self.state is not None:
+            self.is_reachable = self.state == ALIVE
+        else:
+            self.is_reachable = self.heard_from and self.phi < PEER_PHI_SUSPECT
+        return self.phi
+
+    @property
+    def unstable(self) -> bool:
+        """可達但訊號延遲或量測常遺失 (列表顯示為不穩定)"""
+        if self.state is not None:
+            return self.is_reachable and self.link.lossy
+        return self.is_reachable and (self.phi >= PEER_PHI_WARN or self.link.lossy)
+
+    def view(self) -> tuple:
+        """列表上看得到的狀態 (變動時才通知 GUI)"""
+        ping = round(self.ping_ms) if self.ping_ms is not None else None
+        capacity = self.capacity
+        load = (capacity.transfers, capacity.free // 1073741824 if capacity.free is not None else None) \
+            if capacity else None
+        return (self.hostname, self.platform, self.is_reachable, self.unstable, ping,
+                round(self.link.loss_rate * 100), load)
 
     def to_dict(self) -> dict:
         return {
@@ -38,7 +112,25 @@ class PeerInfo:
             "hostname": self.hostname,
             "platform": self.platform,
             "ping_ms": self.ping_ms,
-            "is_reachable": self.is_reachable
+            "is_reachable": self.is_reachable,
+            "phi": self.phi,
+            "link": self.link.to_dict(),
+            "addresses": {address: link.to_dict() for address, link in self.addresses.items()},
+            "caps": self.caps,
+            "capacity": self.capacity.to_dict() if self.capacity else None
+        }
+
+    def cache_entry(self) -> dict:
+        """節點快取項目 (見 network.peercache)"""
+        return {
+            "ip": self.ip,
+            "hostname": self.hostname,
+            "platform": self.platform,
+            "node": self.node,
+            "addresses": list(self.addresses),
+            "rtt": {address: link.srtt for address, link in self.addresses.items()},
+            "caps": self.caps,
+            "last_seen": self.last_seen
         }
 
     def __str__(self):
@@ -46,16 +138,415 @@ class PeerInfo:
         return f"{self.hostname} ({self.ip}) [{self.platform}] - {status}"
 
 
-class NetworkDiscovery:
-    """網路發現服務"""
+class PeerDelta:
+    """
+    一次合併後的節點變動
+    added / updated / removed 為 IP 列表，version 為產生此變動時登錄表的版本
+    """
+    __slots__ = ("version", "added", "updated", "removed")
+
+    def __init__(self, version: int, added: List[str], updated: List[str], removed: List[str]):
+        self.version = version
+        self.added = added
+        self.updated = updated
+        self.removed = removed
+
+    @property
+    def changed(self) -> List[str]:
+        return self.added + self.updated + self.removed
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+
+class PeerRegistry:
+    """
+    執行緒安全的節點登錄表
+    監聽、Ping、GUI 執行緒都透過這裡讀寫節點；每次可見的變動 (新增 / 移除 / PeerInfo.view() 改變)
+    遞增 version 並記錄變動的 IP，由通知執行緒在 debounce 秒內合併成一個 PeerDelta 送給 on_change
+    只更新 last_seen 不算可見變動 (每個廣播封包都會更新，不應觸發 GUI 重繪)
+    節點的次要位址記在 _aliases，以次要位址查詢 / 更新時對應到主要位址的節點
+    """
+
+    def __init__(self, on_change: Optional[Callable] = None, debounce: float = PEER_UPDATE_DEBOUNCE):
+        self.on_change = on_change
+        self.debounce = debounce
+        self.version = 0
+        self._peers: Dict[str, PeerInfo] = {}
+        self._aliases: Dict[str, str] = {}  # 次要位址 → 主要位址
+        self._nodes: Dict[str, str] = {}    # 節點 id → 主要位址
+        self._changed: Set[str] = set()     # 上次 flush 後有變動的 IP
+        self._published: Set[str] = set()   # 已通知過 (存在) 的 IP，用於區分新增與更新
+        self._cond = threading.Condition()
+        self._notifier: Optional[threading.Thread] = None
+
+    # ---------- 讀取 ----------
+
+    def _resolve(self, ip: str) -> str:
+        """位址對應的主要位址 (須持有鎖)"""
+        return ip if ip in self._peers else self._aliases.get(ip, ip)
+
+    def resolve(self, ip: str) -> str:
+        with self._cond:
+            return self._resolve(ip)
+
+    def __contains__(self, ip: str) -> bool:
+        with self._cond:
+            return self._resolve(ip) in self._peers
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._peers)
+
+    def get(self, ip: str) -> Optional[PeerInfo]:
+        with self._cond:
+            return self._peers.get(self._resolve(ip))
+
+    def snapshot(self) -> Dict[str, PeerInfo]:
+        """目前所有節點 (新的 dict，呼叫者可自由迭代)"""
+        with self._cond:
+            return dict(self._peers)
+
+    def ips(self) -> List[str]:
+        with self._cond:
+            return list(self._peers)
+
+    def alias_ips(self) -> List[str]:
+        """所有節點的次要位址"""
+        with self._cond:
+            return list(self._aliases)
+
+    def probe_targets(self) -> List[str]:
+        """所有節點的所有位址 (延遲量測的目標)"""
+        with self._cond:
+            return list(self._peers) + list(self._aliases)
+
+    def paths(self, ip: str) -> Dict[str, LinkStats]:
+        """節點各位址 RTT 統計的快照 (節點不存在時為空)"""
+        with self._cond:
+            peer = self._peers.get(self._resolve(ip))
+            if peer is None:
+                return {}
+            return {address: link.copy() for address, link in peer.addresses.items()}
+
+    def is_member(self, ip: str) -> bool:
+        """是否為 gossip 成員"""
+        with self._cond:
+            peer = self._peers.get(ip)
+            return peer is not None and peer.state is not None
+
+    def member_count(self) -> int:
+        with self._cond:
+            return sum(1 for peer in self._peers.values() if peer.state is not None)
+
+    def member_ips(self, alive: bool = False) -> List[str]:
+        """gossip 成員 (alive=True 時只含存活的成員)"""
+        with self._cond:
+            return [ip for ip, peer in self._peers.items()
+                    if peer.state is not None and (not alive or peer.state == ALIVE)]
+
+    def legacy_ips(self) -> List[str]:
+        """不支援 gossip 的對端 (舊版、廣播模式、手動加入)"""
+        with self._cond:
+            return [ip for ip, peer in self._peers.items() if peer.state is None]
+
+    def cache_entries(self) -> List[dict]:
+        """收到過訊號的節點的快取項目"""
+        with self._cond:
+            return [peer.cache_entry() for peer in self._peers.values() if peer.heard_from]
+
+    def member_entries(self, limit: Optional[int] = None, exclude=()) -> List[list]:
+        """gossip 成員的事件形式 [ip, incarnation, 狀態代碼, 名稱, 平台]，limit 指定時隨機取樣"""
+        with self._cond:
+            members = [peer for ip, peer in self._peers.items() if peer.state is not None and ip not in exclude]
+            if limit is not None and len(members) > limit:
+                members = random.sample(members, limit)
+            return [[peer.ip, peer.incarnation, STATE_CODES[peer.state], peer.hostname, peer.platform]
+                    for peer in members]
+
+    # ---------- 寫入 ----------
+
+    def _mark(self, ip: str):
+        """記錄可見變動並喚醒通知執行緒 (須持有鎖)"""
+        self.version += 1
+        self._changed.add(ip)
+        if self.on_change:
+            if self._notifier is None:
+                self._notifier = threading.Thread(target=self._notify_loop, daemon=True)
+                self._notifier.start()
+            self._cond.notify()
+
+    def _drop(self, ip: str):
+        """移除節點與其次要位址 (須持有鎖)"""
+        del self._peers[ip]
+        for address in [a for a, primary in self._aliases.items() if primary == ip]:
+            del self._aliases[address]
+        for node in [n for n, primary in self._nodes.items() if primary == ip]:
+            del self._nodes[node]
+        self._mark(ip)
+
+    def add(self, peer: PeerInfo, replace: bool = True) -> bool:
+        """加入節點 (replace=False 時已存在則不變)，返回是否有變動"""
+        with self._cond:
+            if not replace and self._resolve(peer.ip) in self._peers:
+                return False
+            self._aliases.pop(peer.ip, None)
+            self._peers[peer.ip] = peer
+            self._mark(peer.ip)
+            return True
+
+    def seen(self, ip: str, hostname: str, platform_name: str) -> bool:
+        """
+        收到節點的發現訊息: 不存在則新增，存在則記錄訊號 (名稱改變時也更新)
+        返回是否為新節點
+        """
+        with self._cond:
+            peer = self._peers.get(ip)
+            if peer is None:
+                peer = self._peers[ip] = PeerInfo(ip, hostname, platform_name)
+                peer.heard()
+                peer.evaluate()
+                self._mark(ip)
+                return True
+            before = peer.view()
+            peer.heard()
+            peer.hostname = hostname
+            peer.platform = platform_name
+            peer.evaluate()
+            if peer.view() != before:
+                self._mark(ip)
+            return False
+
+    def primary(self, node: Optional[str], ip: str) -> str:
+        """發現訊息的發送者對應的主要位址 (已知節點 id 從其他位址發送時返回原本的主要位址)"""
+        with self._cond:
+            primary = self._nodes.get(node) if node else None
+            return primary if primary in self._peers else self._resolve(ip)
+
+    def add_addresses(self, ip: str, node: Optional[str], addresses: List[str]):
+        """
+        記錄節點的節點 id 與其他位址 (發現訊息中的來源位址與公告的本機位址)
+        同一節點先前以其他位址單獨登錄的 (非 gossip) 項目合併進來
+        """
+        with self._cond:
+            peer = self._peers.get(ip)
+            if peer is None:
+                return
+            if node:
+                peer.node = node
+                self._nodes[node] = ip
+            for address in addresses:
+                if not isinstance(address, str) or address in peer.addresses or address.startswith("127."):
+                    continue
+                other = self._peers.get(address)
+                if other is not None:
+                    if other.state is not None or other.node not in (None, node):
+                        continue
+                    self._drop(address)
+                    self._mark(ip)
+                peer.addresses[address] = LinkStats()
+                self._aliases[address] = ip
+
+    def update_ping(self, ip: str, ping_ms: Optional[float], alive: bool = True):
+        """
+        記錄一次延遲量測 (參數同 PeerInfo.record_rtt，ip 可為次要位址)，
+        列表上看得到的狀態改變才算可見變動
+        """
+        with self._cond:
+            primary = self._resolve(ip)
+            peer = self._peers.get(primary)
+            if peer is None:
+                return
+            before = peer.view()
+            peer.record_rtt(ping_ms, alive, ip)
+            peer.evaluate()
+            if peer.view() != before:
+                self._mark(primary)
+
+    def heard(self, ip: str):
+        """收到節點直接送來的訊息 (不含延遲量測)"""
+        with self._cond:
+            ip = self._resolve(ip)
+            peer = self._peers.get(ip)
+            if peer is None:
+                return
+            before = peer.view()
+            peer.heard()
+            peer.evaluate()
+            if peer.view() != before:
+                self._mark(ip)
+
+    def apply_member(self, ip: str, hostname: str, platform_name: str, incarnation: int, state: str) -> bool:
+        """
+        套用 gossip 成員事件 (優先順序見 membership.supersedes)，返回事件是否被接受
+        DEAD 移除節點；未知節點的 ALIVE / SUSPECT 新增節點
+        以次要位址描述的事件套用到同一節點 (incarnation 屬於節點而非位址)
+        """
+        with self._cond:
+            ip = self._resolve(ip)
+            peer = self._peers.get(ip)
+            if peer is None:
+                if state == DEAD:
+                    return False
+                peer = self._peers[ip] = PeerInfo(ip, hostname, platform_name)
+            elif not supersedes(state, incarnation, peer.state, peer.incarnation):
+                return False
+            elif state == DEAD:
+                self._drop(ip)
+                return True
+
+            before = peer.view() if ip in self._published else None
+            peer.state = state
+            peer.incarnation = incarnation
+            if isinstance(hostname, str) and isinstance(platform_name, str):
+                peer.hostname = hostname
+                peer.platform = platform_name
+            peer.evaluate()
+            if peer.view() != before:
+                self._mark(ip)
+            return True
+
+    def set_caps(self, ip: str, caps: Optional[dict]):
+        """記錄協商後的能力 (不是列表上看得到的變動)"""
+        with self._cond:
+            peer = self._peers.get(self._resolve(ip))
+            if peer is not None and caps:
+                peer.caps = caps
+
+    def set_capacity(self, ip: str, field) -> bool:
+        """記錄節點公告的容量 ("cap" 欄位，格式不符時忽略)，返回是否已記錄"""
+        capacity = PeerCapacity.parse(field)
+        if capacity is None:
+            return False
+        with self._cond:
+            peer = self._peers.get(self._resolve(ip))
+            if peer is None:
+                return False
+            before = peer.view()
+            peer.capacity = capacity
+            if peer.view() != before:
+                self._mark(peer.ip)
+            return True
+
+    def capacity(self, ip: str) -> Optional[PeerCapacity]:
+        """節點最近一次公告的容量 (ip 可為次要位址)，未公告或已過期時為 None"""
+        with self._cond:
+            peer = self._peers.get(self._resolve(ip))
+            capacity = peer.capacity if peer else None
+        return capacity if capacity is not None and capacity.fresh else None
+
+    def link(self, ip: str) -> Optional[LinkStats]:
+        """位址 RTT 統計的快照 (供傳輸調整參數，ip 可為次要位址)，節點不存在時為 None"""
+        with self._cond:
+            peer = self._peers.get(self._resolve(ip))
+            return peer.addresses.get(ip, peer.link).copy() if peer else None
+
+    def remove(self, ip: str) -> bool:
+        with self._cond:
+            ip = self._resolve(ip)
+            if ip not in self._peers:
+                return False
+            self._drop(ip)
+            return True
+
+    def check_health(self, max_age: float = PEER_TIMEOUT) -> List[str]:
+        """
+        重新評估非 gossip 對端的懷疑程度: phi 達 PEER_PHI_DEAD 或超過 max_age 秒未出現的節點移除，
+        其餘更新可達性；返回被移除的 IP
+        """
+        cutoff = time.time() - max_age
+        with self._cond:
+            removed = []
+            for ip, peer in list(self._peers.items()):
+                if peer.state is not None:
+                    # gossip 成員由成員事件移除
+                    continue
+                before = peer.view()
+                if peer.evaluate() >= PEER_PHI_DEAD or peer.last_seen < cutoff:
+                    self._drop(ip)
+                    removed.append(ip)
+                elif peer.view() != before:
+                    self._mark(ip)
+            return removed
+
+    def clear(self):
+        with self._cond:
+            for ip in list(self._peers):
+                self._drop(ip)
+
+    # ---------- 變動通知 ----------
+
+    def flush(self) -> PeerDelta:
+        """
+        取出上次 flush 後累積的變動 (之後的通知不會重複包含這些變動)
+        GUI 執行緒自己修改登錄表後可直接呼叫，立即套用而不等待 debounce
+        """
+        with self._cond:
+            added, updated, removed = [], [], []
+            for ip in self._changed:
+                if ip in self._peers:
+                    (updated if ip in self._published else added).append(ip)
+                    self._published.add(ip)
+                elif ip in self._published:
+                    removed.append(ip)
+                    self._published.discard(ip)
+            self._changed.clear()
+            return PeerDelta(self.version, added, updated, removed)
+
+    def publish(self):
+        """立即送出累積的變動 (不等待 debounce，例如啟動時從快取恢復的節點)"""
+        delta = self.flush()
+        if delta and self.on_change:
+            self.on_change(delta)
+
+    def _notify_loop(self):
+        """通知執行緒: 有變動時再等 debounce 秒讓同一波變動合併，然後送出一個 PeerDelta"""
+        while True:
+            with self._cond:
+                while not self._changed:
+                    self._cond.wait()
+            time.sleep(self.debounce)
+            delta = self.flush()
+            if delta and self.on_change:
+                try:
+                    self.on_change(delta)
+                except Exception as e:
+                    print(f"節點更新回調錯誤: {e}")
 
-    def __init__(self, on_peer_update: Optional[Callable] = None):
-        self.peers: Dict[str, PeerInfo] = {}
+
+class NetworkDiscovery:
+    """
+    網路發現服務
+    on_peer_update(PeerDelta) 在節點變動時 (合併後) 呼叫
+    cache_path 指定節點快取檔案 (None 為不使用快取)
+    capacity() 返回本機接收端的 {"free": bytes 或 None, "transfers": 進行中的接收數} (見 TransferServer.capacity)，
+    None 時只公告連結速度與協定能力
+    """
+
+    def __init__(self, on_peer_update: Optional[Callable] = None, mode: str = MEMBERSHIP_MODE,
+                 cache_path: Optional[str] = None, capacity: Optional[Callable] = None):
+        self.registry = PeerRegistry(on_change=self._on_registry_change)
+        self.prober = RttProber()
         self.on_peer_update = on_peer_update
         self.running = False
         self.local_ip = get_local_ip()
         self.hostname = get_hostname()
         self.platform_name = get_platform()
+        # 每個程序一個節點 id: 對端以此合併同一節點從不同介面送出的訊息
+        self.node_id = uuid.uuid4().hex[:12]
+        self.interfaces = list_interfaces()
+        self.local_addresses: Set[str] = set()
+        # gossip 模式的成員管理 (廣播模式為 None)
+        self.membership: Optional[GossipMembership] = None
+        if mode == "gossip":
+            self.membership = GossipMembership(self.registry, self.prober, self.local_ip,
+                                               self.hostname, self.platform_name)
+        self._update_addresses()
+        self.cache = PeerCache(cache_path) if cache_path else None
+        self._next_save = 0.0
+        self.capacity = capacity
+        self._capacity_field: Optional[dict] = None
+        self._capacity_at = 0.0
 
         self._broadcast_thread: Optional[threading.Thread] = None
         self._listen_thread: Optional[threading.Thread] = None
@@ -64,6 +555,14 @@ class NetworkDiscovery:
     def start(self):
         """啟動發現服務"""
         self.running = True
+        self._next_save = time.monotonic() + PEER_CACHE_SAVE_INTERVAL
+
+        # 先量測上次的節點 (與廣播同時進行)
+        if self.cache:
+            threading.Thread(target=self._warm_start, daemon=True).start()
+
+        if SWEEP_ENABLED:
+            threading.Thread(target=self._sweep_loop, daemon=True).start()
 
         # 啟動廣播線程
         self._broadcast_thread = threading.Thread(target=self._broadcast_loop, daemon=True)
@@ -73,30 +572,163 @@ class NetworkDiscovery:
         self._listen_thread = threading.Thread(target=self._listen_loop, daemon=True)
         self._listen_thread.start()
 
-        # 啟動 Ping 測試線程
-        self._ping_thread = threading.Thread(target=self._ping_loop, daemon=True)
+        # 啟動 Ping 測試線程 (gossip 模式為協定週期循環)
+        if self.membership:
+            target, args = self.membership.run, (lambda: self.running,)
+        else:
+            target, args = self._ping_loop, ()
+        self._ping_thread = threading.Thread(target=target, args=args, daemon=True)
         self._ping_thread.start()
 
     def stop(self):
         """停止發現服務"""
         self.running = False
+        self.save_cache()
+
+    # ---------- 節點快取 ----------
+
+    def save_cache(self):
+        if self.cache is None:
+            return
+        try:
+            self.cache.save(self.registry.cache_entries())
+        except OSError as e:
+            print(f"寫入節點快取失敗: {e}")
+
+    def _restore(self, entry: dict, address: str):
+        """快取中的節點在 address 有回應: 加入列表並恢復其他位址與能力"""
+        node = entry.get("node")
+        primary = self.registry.primary(node, address)
+        self.registry.seen(primary, entry.get("hostname", "Unknown"), entry.get("platform", "Unknown"))
+        self.registry.add_addresses(primary, node, entry["addresses"])
+        self.registry.set_caps(primary, entry.get("caps"))
+        self.registry.publish()
+
+    def _warm_start(self):
+        """
+        同時量測快取中所有節點的所有位址: UDP 回應到達即加入列表 (不等整輪結束)，
+        只以 TCP 回應的舊版節點在量測結束後加入；對有回應的節點單播回應訊息，
+        廣播不通時對方也能發現本機
+        位址可能已被 DHCP 分給其他主機，因此只在 PONG 的節點 ID 與快取相符時恢復；
+        TCP 回應無法辨識節點，只用於沒有節點 ID 的舊版項目
+        """
+        by_address: Dict[str, dict] = {}
+        for entry in self.cache.load():
+            for address in entry["addresses"]:
+                if isinstance(address, str) and address not in self.local_addresses:
+                    by_address.setdefault(address, entry)
+        if not by_address:
+            return
+
+        found: Dict[str, str] = {}  # 快取項目的 ip → 回應的位址
+
+        def on_reply(message: dict, ip: str):
+            entry = by_address.get(ip)
+            if (entry is not None and entry["ip"] not in found and not message.get("relay")
+                    and message.get("node") == entry.get("node")):
+                found[entry["ip"]] = ip
+                self._restore(entry, ip)
+                self._on_pong(message, ip)
+
+        via = {}
+        results = self.prober.probe_many(list(by_address), via=via, on_reply=on_reply)
+        for address, ping_ms in results.items():
+            entry = by_address[address]
+            alive = via.get(address) != "refused"
+            if (ping_ms is not None and via.get(address) == "tcp" and not entry.get("node")
+                    and entry["ip"] not in found):
+                found[entry["ip"]] = address
+                self._restore(entry, address)
+            if entry["ip"] in found:
+                self.registry.update_ping(address, ping_ms, alive=alive)
+
+        for address in found.values():
+            self._send_response(address)
+
+    def _on_registry_change(self, delta: PeerDelta):
+        if self.on_peer_update:
+            self.on_peer_update(delta)
+
+    @property
+    def peers(self) -> Dict[str, PeerInfo]:
+        """目前所有節點的快照 (修改請透過 registry)"""
+        return self.registry.snapshot()
+
+    def _update_addresses(self):
+        """依目前的介面更新本機位址集合 (介面可能在執行中增減，例如連上 VPN)"""
+        self.local_addresses = {iface.address for iface in self.interfaces} | {self.local_ip}
+        if self.membership:
+            self.membership.local_addresses = self.local_addresses
+
+    def _broadcast_addresses(self) -> List[str]:
+        """每個介面網段的廣播位址 (無法列舉介面時使用受限廣播，只從預設路由的介面送出)"""
+        addresses = [iface.broadcast for iface in self.interfaces if iface.broadcast]
+        return list(dict.fromkeys(addresses)) or ['<broadcast>']
+
+    def local_capacity(self) -> dict:
+        """本機的 "cap" 欄位 (每 CAPACITY_REFRESH 秒重新計算一次)"""
+        now = time.monotonic()
+        if self._capacity_field is None or now - self._capacity_at >= CAPACITY_REFRESH:
+            free, transfers = None, 0
+            if self.capacity:
+                try:
+                    state = self.capacity()
+                    free, transfers = state.get("free"), state.get("transfers", 0)
+                except Exception as e:
+                    print(f"取得本機容量失敗: {e}")
+            # 連結速度: 最快的非 VPN 介面
+            speeds = [iface.speed for iface in self.interfaces if iface.kind != KIND_VPN]
+            self._capacity_field = capacity_field(free, transfers, max(speeds) if speeds else None)
+            self._capacity_at = now
+        return self._capacity_field
+
+    def _message(self, msg_type: str) -> bytes:
+        """
+        發現 / 回應訊息 (附帶節點 id、本機所有位址與容量；gossip 模式附帶 incarnation 與是否已加入)
+        超過 DISCOVERY_MAX_PACKET 時減少附帶的位址 (對端仍可由各位址送出的廣播得知)
+        """
+        message = {
+            "type": msg_type,
+            "hostname": self.hostname,
+            "platform": self.platform_name,
+            "ip": self.local_ip,
+            "node": self.node_id,
+            "addrs": sorted(self.local_addresses),
+            "cap": self.local_capacity()
+        }
+        if self.membership:
+            message.update(self.membership.announcement())
+        data = json.dumps(message).encode('utf-8')
+        while len(data) > DISCOVERY_MAX_PACKET and message["addrs"]:
+            message["addrs"].pop()
+            data = json.dumps(message).encode('utf-8')
+        return data
 
     def _broadcast_loop(self):
-        """廣播循環 - 定期發送發現訊息"""
+        """
+        廣播循環 - 定期在每個介面的網段發送發現訊息
+        (gossip 模式加入後大多省略，改為單播給不支援 gossip 的對端)
+        """
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         sock.settimeout(1)
 
-        message = json.dumps({
-            "type": MSG_TYPE_DISCOVERY,
-            "hostname": self.hostname,
-            "platform": self.platform_name,
-            "ip": self.local_ip
-        }).encode('utf-8')
-
         while self.running:
             try:
-                sock.sendto(message, ('<broadcast>', DISCOVERY_PORT))
+                self.interfaces = list_interfaces()
+                self._update_addresses()
+                if self.membership is None or self.membership.should_announce():
+                    message = self._message(MSG_TYPE_DISCOVERY)
+                    for address in self._broadcast_addresses():
+                        try:
+                            sock.sendto(message, (address, DISCOVERY_PORT))
+                        except OSError as e:
+                            print(f"廣播到 {address} 失敗: {e}")
+                if self.membership:
+                    self.membership.announce_legacy(sock, self._message(MSG_TYPE_RESPONSE))
+                if self.cache and time.monotonic() >= self._next_save:
+                    self._next_save = time.monotonic() + PEER_CACHE_SAVE_INTERVAL
+                    self.save_cache()
             except Exception as e:
                 print(f"廣播錯誤: {e}")
             time.sleep(BROADCAST_INTERVAL)
@@ -118,8 +750,8 @@ class NetworkDiscovery:
 
         while self.running:
             try:
-                data, addr = sock.recvfrom(1024)
-                self._handle_discovery_message(data, addr[0])
+                data, addr = sock.recvfrom(65535)
+                self._handle_discovery_message(data, addr, sock)
             except socket.timeout:
                 continue
             except Exception as e:
@@ -128,133 +760,172 @@ class NetworkDiscovery:
 
         sock.close()
 
-    def _handle_discovery_message(self, data: bytes, sender_ip: str):
-        """處理發現訊息"""
+    def _handle_discovery_message(self, data: bytes, addr: tuple, sock: socket.socket):
+        """處理發現訊息 (addr 為來源位址，sock 為收到訊息的監聽 socket)"""
+        sender_ip = addr[0]
         try:
             message = json.loads(data.decode('utf-8'))
 
-            # 忽略自己的訊息
-            if sender_ip == self.local_ip:
+            msg_type = message.get("type")
+
+            # 延遲量測: 從監聽 socket 直接回覆到來源端口 (自己發出的也回應，供測試本機)
+            if msg_type == MSG_TYPE_PING:
+                extra = self.membership.on_ping(message, addr) if self.membership else None
+                extra = dict(extra or {}, node=self.node_id, cap=self.local_capacity())
+                sock.sendto(pong_message(message.get("id"), extra), addr)
                 return
 
-            msg_type = message.get("type")
+            if self.membership:
+                if msg_type == MSG_TYPE_PING_REQ:
+                    self.membership.on_ping_req(message, addr, sock)
+                    return
+                if msg_type == MSG_TYPE_PONG:
+                    self.membership.on_pong(message, addr, sock)
+                    return
+                if msg_type == MSG_TYPE_GOSSIP:
+                    self.membership.on_gossip(message, addr)
+                    return
+
+            # 忽略自己的訊息 (多介面時會從每個網段收到自己的廣播)
+            node = message.get("node")
+            if sender_ip in self.local_addresses or (node and node == self.node_id):
+                return
 
             if msg_type in [MSG_TYPE_DISCOVERY, MSG_TYPE_RESPONSE]:
                 hostname = message.get("hostname", "Unknown")
                 platform_name = message.get("platform", "Unknown")
-
-                # 更新或新增節點
-                if sender_ip not in self.peers:
-                    self.peers[sender_ip] = PeerInfo(sender_ip, hostname, platform_name)
+                # 同一節點從其他介面送來的訊息歸到原本的節點，回應則送回收到訊息的位址
+                primary = self.registry.primary(node, sender_ip)
+                addresses = [sender_ip] + [address for address in message.get("addrs") or []
+                                           if address not in self.local_addresses]
+
+                # gossip 成員的公告 (回應與成員同步由成員管理決定)
+                if self.membership and message.get("gossip"):
+                    self.membership.on_announce(message, sender_ip, sock, self._message(MSG_TYPE_RESPONSE),
+                                                member_ip=primary)
+                    self.registry.add_addresses(primary, node, addresses)
+                    self.registry.set_capacity(primary, message.get("cap"))
+                    return
+
+                # 更新或新增節點 (變動由登錄表合併後通知)
+                is_new = self.registry.seen(primary, hostname, platform_name)
+                self.registry.add_addresses(primary, node, addresses)
+                self.registry.set_capacity(primary, message.get("cap"))
+                if is_new:
                     # 發送回應
                     if msg_type == MSG_TYPE_DISCOVERY:
                         self._send_response(sender_ip)
-                else:
-                    self.peers[sender_ip].last_seen = time.time()
-
-                # 觸發更新回調
-                if self.on_peer_update:
-                    self.on_peer_update(self.peers)
 
         except json.JSONDecodeError:
             pass
         except Exception as e:
             print(f"處理訊息錯誤: {e}")
 
-    def _send_response(self, target_ip: str):
-        """發送回應訊息"""
+    def _send_response(self, target_ip: str, msg_type: str = MSG_TYPE_RESPONSE):
+        """發送回應訊息 (msg_type 為 DISCOVERY 時對方會回應)"""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = json.dumps({
-                "type": MSG_TYPE_RESPONSE,
-                "hostname": self.hostname,
-                "platform": self.platform_name,
-                "ip": self.local_ip
-            }).encode('utf-8')
-            sock.sendto(message, (target_ip, DISCOVERY_PORT))
+            sock.sendto(self._message(msg_type), (target_ip, DISCOVERY_PORT))
             sock.close()
         except Exception as e:
             print(f"發送回應錯誤: {e}")
 
+    def sweep(self, subnets: Optional[List[str]] = None) -> List[str]:
+        """
+        主動掃描網段 (預設 SWEEP_SUBNETS，空列表為各介面所在的 /24)，返回新找到的位址
+        傳輸端口接受連接的主機單播發現訊息，對方回應後以名稱加入；
+        SWEEP_CONFIRM_WAIT 秒內未回應 (例如 UDP 也被擋) 的以 IP 為名稱加入，之後由延遲量測維持
+        """
+        hosts = [ip for ip in subnet_hosts(subnets or SWEEP_SUBNETS, self.interfaces, SWEEP_MAX_HOSTS)
+                 if ip not in self.local_addresses and ip not in self.registry]
+        found = tcp_sweep(hosts)
+        for ip in found:
+            self._send_response(ip, MSG_TYPE_DISCOVERY)
+        if found:
+            time.sleep(SWEEP_CONFIRM_WAIT)
+        for ip, ping_ms in found.items():
+            if ip in self.registry:
+                continue
+            peer = PeerInfo(ip, ip, "Unknown")
+            peer.record_rtt(ping_ms)
+            peer.evaluate()
+            self.registry.add(peer, replace=False)
+        return list(found)
+
+    def _sweep_loop(self):
+        """自動掃描循環 (SWEEP_ENABLED)"""
+        while self.running:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"網段掃描錯誤: {e}")
+            deadline = time.monotonic() + SWEEP_INTERVAL
+            while self.running and time.monotonic() < deadline:
+                time.sleep(1)
+
+    def _on_pong(self, message: dict, ip: str):
+        """量測回應附帶的容量 (代為量測轉回的回應不是該節點的)"""
+        if not message.get("relay"):
+            self.registry.set_capacity(ip, message.get("cap"))
+
     def _ping_loop(self):
-        """Ping 測試循環 - 定期測試節點連接狀態"""
+        """延遲量測循環 - 所有節點同時量測 (一輪最多 PING_TIMEOUT 秒，與節點數無關)"""
         while self.running:
-            peers_to_ping = list(self.peers.keys())
-
-            for ip in peers_to_ping:
-                if not self.running:
-                    break
-                if ip in self.peers:
-                    ping_result = self._ping_host(ip)
-                    self.peers[ip].ping_ms = ping_result
-                    self.peers[ip].is_reachable = ping_result is not None
-
-            # 清理超時節點 (超過 30 秒未見)
-            current_time = time.time()
-            expired = [ip for ip, peer in self.peers.items()
-                      if current_time - peer.last_seen > 30]
-            for ip in expired:
-                del self.peers[ip]
-
-            if self.on_peer_update and (peers_to_ping or expired):
-                self.on_peer_update(self.peers)
-
-            time.sleep(5)  # 每 5 秒測試一次
-
-    def _ping_host(self, ip: str) -> Optional[float]:
-        """Ping 指定主機，返回延遲(ms)或 None"""
-        try:
-            system = platform.system().lower()
-
-            if system == "windows":
-                cmd = ["ping", "-n", "1", "-w", str(PING_TIMEOUT * 1000), ip]
-            else:  # Linux/Mac
-                cmd = ["ping", "-c", "1", "-W", str(PING_TIMEOUT), ip]
-
-            start_time = time.time()
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=PING_TIMEOUT + 1
-            )
-            end_time = time.time()
-
-            if result.returncode == 0:
-                # 嘗試從輸出解析實際延遲
-                output = result.stdout.decode('utf-8', errors='ignore')
-
-                # Windows 格式: "時間=XXms" 或 "time=XXms"
-                # Linux 格式: "time=XX.X ms"
-                import re
-                match = re.search(r'[時间time][=<][\s]*([0-9.]+)\s*ms', output, re.IGNORECASE)
-                if match:
-                    return float(match.group(1))
-
-                # 如果無法解析，使用計算的時間
-                return (end_time - start_time) * 1000
-
-            return None
-
-        except subprocess.TimeoutExpired:
-            return None
-        except Exception as e:
-            print(f"Ping 錯誤 {ip}: {e}")
-            return None
+            via = {}
+            results = self.prober.probe_many(self.registry.probe_targets(), via=via, on_reply=self._on_pong)
+            for ip, ping_ms in results.items():
+                # 量測期間被移除的節點由登錄表忽略
+                self.registry.update_ping(ip, ping_ms, alive=via[ip] != "refused")
+
+            # 依懷疑程度更新可達性並移除已離線的節點
+            self.registry.check_health()
+
+            time.sleep(PING_INTERVAL)
 
     def get_peers(self) -> Dict[str, PeerInfo]:
         """取得所有已發現的節點"""
-        return self.peers.copy()
+        return self.registry.snapshot()
+
+    def link_stats(self, ip: str) -> Optional[LinkStats]:
+        """位址 RTT 統計的快照 (尚未量測過的節點也會返回空的統計)"""
+        return self.registry.link(ip)
+
+    def usable_addresses(self, ip: str) -> List[str]:
+        """
+        節點各位址中最近一次量測有回應者，由佳到差排序:
+        (鏈路不穩定, 本機出口介面頻寬由高到低, 平滑 RTT) (不在本機任何網段的位址經由路由，頻寬視為最低)
+        """
+        candidates = []
+        for address, link in self.registry.paths(ip).items():
+            if link.srtt is None or link.last is None:
+                continue
+            iface = interface_for(address, self.interfaces)
+            candidates.append((link.lossy, -(iface.speed if iface else 0), link.srtt, address))
+        return [candidate[3] for candidate in sorted(candidates)]
+
+    def best_address(self, ip: str) -> str:
+        """傳輸使用的位址 (沒有可用的位址，例如未知節點、尚未量測時返回 ip)"""
+        addresses = self.usable_addresses(ip)
+        return addresses[0] if addresses else ip
+
+    def peer_capacity(self, ip: str) -> Optional[PeerCapacity]:
+        """節點最近公告的容量 (未公告或超過 CAPACITY_MAX_AGE 時為 None)"""
+        return self.registry.capacity(ip)
+
+    def remember_capabilities(self, ip: str, caps: dict):
+        """傳輸端協商完成後記錄對端能力 (寫入節點快取)"""
+        self.registry.set_caps(ip, caps)
 
     def manual_ping(self, ip: str) -> Optional[float]:
-        """手動 Ping 指定 IP"""
-        return self._ping_host(ip)
+        """手動 Ping 指定 IP，返回延遲(ms)或 None"""
+        return self.prober.probe(ip)
 
 
 if __name__ == "__main__":
     # 測試代碼
-    def on_update(peers):
-        print(f"\n發現 {len(peers)} 個節點:")
+    def on_update(delta):
+        peers = discovery.get_peers()
+        print(f"\n發現 {len(peers)} 個節點 (版本 {delta.version}, +{len(delta.added)} -{len(delta.removed)}):")
         for ip, peer in peers.items():
             print(f"  - {peer}")
 
@@ -0,0 +1,164 @@
+"""
+節點連線品質統計與故障偵測
+LinkStats: 最近 PEER_RTT_SAMPLES 次量測的環形緩衝區 (遺失記為 None)，
+           提供平滑 RTT (EWMA)、抖動、p50 / p95 與遺失率
+PhiAccrual: phi accrual 故障偵測 (Hayashibara et al.)，依節點過去的訊號 (廣播 / 量測回應) 間隔分佈，
+            把「距上次訊號的時間」換算成懷疑程度 phi (phi = 8 約表示判斷錯誤的機率為 1e-8)；
+            訊號規律的有線節點很快被判定離線，常遺失封包的無線節點則自動放寬
+"""
+import math
+import time
+from collections import deque
+from typing import List, Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    BROADCAST_INTERVAL, PEER_RTT_SAMPLES, PEER_HEARTBEAT_WINDOW, PEER_HEARTBEAT_PAUSE,
+    PEER_PHI_MIN_STD, PEER_LOSSY_RATE
+)
+
+# 間隔短於此秒數的訊號合併為一次 (同時收到廣播與量測回應時不拉低間隔分佈)
+_MIN_INTERVAL = 0.5
+# 常態分佈近似式的輸入範圍 (超出時 exp 溢位 / 下溢)
+_MAX_Y = 20.0
+
+
+class LinkStats:
+    """
+    RTT 統計 (單位 ms)
+    srtt / jitter 依 RFC 6298 的 SRTT (alpha = 1/8) 與 RTTVAR (beta = 1/4) 更新
+    寫入由量測執行緒進行；其他執行緒讀取時請使用 copy() 取得的快照
+    """
+    __slots__ = ("_samples", "srtt", "jitter")
+
+    def __init__(self, size: int = PEER_RTT_SAMPLES):
+        self._samples = deque(maxlen=size)
+        self.srtt: Optional[float] = None
+        self.jitter = 0.0
+
+    def add(self, rtt: Optional[float]):
+        """加入一次量測結果 (None 表示遺失)"""
+        self._samples.append(rtt)
+        if rtt is None:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.jitter = rtt / 2
+        else:
+            self.jitter += (abs(self.srtt - rtt) - self.jitter) / 4
+            self.srtt += (rtt - self.srtt) / 8
+
+    def copy(self) -> "LinkStats":
+        other = LinkStats(self._samples.maxlen)
+        other._samples.extend(self._samples)
+        other.srtt = self.srtt
+        other.jitter = self.jitter
+        return other
+
+    def _received(self) -> List[float]:
+        return sorted(rtt for rtt in list(self._samples) if rtt is not None)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """成功樣本的百分位數 (nearest rank)，沒有樣本時為 None"""
+        received = self._received()
+        if not received:
+            return None
+        rank = max(1, math.ceil(pct / 100 * len(received)))
+        return received[rank - 1]
+
+    @property
+    def p50(self) -> Optional[float]:
+        return self.percentile(50)
+
+    @property
+    def p95(self) -> Optional[float]:
+        return self.percentile(95)
+
+    @property
+    def samples(self) -> int:
+        return len(self._samples)
+
+    @property
+    def last(self) -> Optional[float]:
+        """最近一次量測的結果 (尚未量測或遺失為 None)"""
+        return self._samples[-1] if self._samples else None
+
+    @property
+    def loss_rate(self) -> float:
+        samples = list(self._samples)
+        if not samples:
+            return 0.0
+        return sum(1 for rtt in samples if rtt is None) / len(samples)
+
+    @property
+    def lossy(self) -> bool:
+        """遺失率達 PEER_LOSSY_RATE (無線 / 壅塞鏈路)"""
+        return self.loss_rate >= PEER_LOSSY_RATE
+
+    def to_dict(self) -> dict:
+        return {
+            "srtt": self.srtt,
+            "jitter": self.jitter,
+            "p50": self.p50,
+            "p95": self.p95,
+            "loss_rate": self.loss_rate,
+            "samples": self.samples
+        }
+
+
+class PhiAccrual:
+    """
+    phi accrual 故障偵測
+    heartbeat() 記錄收到節點訊號的時間，phi() 返回目前的懷疑程度
+    間隔分佈以首個預期間隔 (BROADCAST_INTERVAL) 起始，之後以最近 PEER_HEARTBEAT_WINDOW 個間隔估計
+    """
+    __slots__ = ("_intervals", "_sum", "_squares", "_last")
+
+    def __init__(self, first_interval: float = BROADCAST_INTERVAL, window: int = PEER_HEARTBEAT_WINDOW,
+                 now: Optional[float] = None):
+        self._intervals = deque(maxlen=window)
+        self._sum = 0.0
+        self._squares = 0.0
+        self._last = time.monotonic() if now is None else now
+        self._add(first_interval)
+
+    def _add(self, interval: float):
+        if len(self._intervals) == self._intervals.maxlen:
+            old = self._intervals[0]
+            self._sum -= old
+            self._squares -= old * old
+        self._intervals.append(interval)
+        self._sum += interval
+        self._squares += interval * interval
+
+    def heartbeat(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        interval = now - self._last
+        if interval < _MIN_INTERVAL:
+            return
+        self._add(interval)
+        self._last = now
+
+    @property
+    def elapsed(self) -> float:
+        """距上次訊號的秒數"""
+        return time.monotonic() - self._last
+
+    def phi(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        count = len(self._intervals)
+        mean = self._sum / count
+        variance = max(0.0, self._squares / count - mean * mean)
+        std = max(math.sqrt(variance), PEER_PHI_MIN_STD)
+
+        # 以 logistic 近似常態分佈的累積機率 (同 Akka 的實作)，可接受的停頓加在平均間隔上
+        elapsed = now - self._last
+        mean += PEER_HEARTBEAT_PAUSE
+        y = max(-_MAX_Y, min(_MAX_Y, (elapsed - mean) / std))
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
@@ -0,0 +1,395 @@
+"""
+SWIM 式成員管理 (MEMBERSHIP_MODE = "gossip")
+廣播模式下每個節點每 3 秒廣播、新節點收到所有節點的回應、每個節點量測所有節點，流量隨節點數平方成長；
+此模式改為:
+- 加入前照常廣播，加入後 (收到成員的 gossip) 只每 GOSSIP_ANNOUNCE_INTERVAL 秒廣播一次，
+  同一間隔內已聽到 GOSSIP_SUPPRESS 個成員廣播時省略 (Trickle)
+- 新成員的廣播只由約 GOSSIP_FANOUT 個成員回應並同步成員列表
+- 每個週期只量測 GOSSIP_PROBES 個成員，無回應時請 GOSSIP_INDIRECT 個成員代為量測，仍無回應才懷疑
+- 成員事件 (存活 / 懷疑 / 離線，附 incarnation) 附帶在量測封包中傳播；被懷疑的成員遞增 incarnation 反駁
+不支援 gossip 的對端 (舊版或廣播模式) 仍以廣播與直接量測管理，並定期收到單播的公告
+"""
+import json
+import math
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    DISCOVERY_PORT, PING_INTERVAL, PING_TIMEOUT,
+    GOSSIP_PERIOD, GOSSIP_PROBES, GOSSIP_INDIRECT, GOSSIP_FANOUT, GOSSIP_MAX_PACKET, GOSSIP_SAMPLE,
+    GOSSIP_RETRANSMIT_MULT, GOSSIP_SUSPECT_MULT, GOSSIP_ANNOUNCE_INTERVAL, GOSSIP_SUPPRESS,
+    GOSSIP_DEAD_RETENTION, MSG_TYPE_RESPONSE, MSG_TYPE_GOSSIP
+)
+from network.probe import ping_message, pong_message
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+# 封包中的狀態代碼
+STATE_CODES = {ALIVE: "a", SUSPECT: "s", DEAD: "d"}
+_STATES = {code: state for state, code in STATE_CODES.items()}
+
+# 封包中訊息類型、id 與容量欄位 (PONG) 預留的大小
+_HEADER_ROOM = 240
+
+
+def supersedes(state: str, incarnation: int, current_state: Optional[str], current_incarnation: int) -> bool:
+    """
+    SWIM 的事件優先順序: 存活只被較新的 incarnation 取代；
+    懷疑取代同一 incarnation 的存活；離線取代同一或較舊 incarnation 的任何狀態
+    current_state 為 None (尚未以 gossip 管理的節點) 時一律接受
+    """
+    if current_state is None:
+        return True
+    if state == DEAD:
+        return incarnation >= current_incarnation
+    if state == SUSPECT:
+        return incarnation > current_incarnation or (incarnation == current_incarnation and current_state == ALIVE)
+    return incarnation > current_incarnation
+
+
+def _send(sock, data: bytes, addr: tuple):
+    try:
+        sock.sendto(data, addr)
+    except OSError:
+        pass
+
+
+class GossipMembership:
+    """
+    gossip 成員管理 (由 NetworkDiscovery 建立)
+    成員狀態存放在 PeerRegistry 的 PeerInfo (state / incarnation)，此類別負責事件傳播、
+    懷疑計時、量測排程與監聽執行緒收到的 gossip 訊息
+    """
+
+    def __init__(self, registry, prober, local_ip: str, hostname: str, platform_name: str):
+        self.registry = registry
+        self.prober = prober
+        self.local_ip = local_ip
+        self.local_addresses = {local_ip}  # 本機所有介面的位址 (由 NetworkDiscovery 更新)
+        self.hostname = hostname
+        self.platform_name = platform_name
+        # 以啟動時間作為起始 incarnation: 重新啟動的節點不會被舊的離線事件擋住
+        self.incarnation = int(time.time())
+
+        self._events: Dict[str, list] = {}                  # ip → [事件, 剩餘傳送次數]
+        self._suspects: Dict[str, Tuple[int, float]] = {}   # ip → (incarnation, 開始懷疑的時間)
+        self._dead: Dict[str, Tuple[int, float]] = {}       # 墓碑 ip → (incarnation, 判定時間)
+        self._relays: Dict[str, Tuple[tuple, str, float]] = {}  # 代為量測: 轉送 id → (請求者位址, 原 id, 期限)
+        self._relay_seq = 0
+        self._order: List[str] = []     # 本輪量測順序
+        self._next_legacy = 0.0         # 下次量測非 gossip 對端的時間
+        self._joined = False            # 是否已收到成員的 gossip
+
+        # Trickle 公告排程
+        self._interval_start = 0.0
+        self._announce_at = 0.0
+        self._announced = True
+        self._heard = 0
+
+        self._lock = threading.Lock()
+
+    # ==================== 事件 ====================
+
+    def _self_entry(self) -> list:
+        return [self.local_ip, self.incarnation, STATE_CODES[ALIVE], self.hostname, self.platform_name]
+
+    def _retransmits(self) -> int:
+        return GOSSIP_RETRANSMIT_MULT * max(1, math.ceil(math.log10(self.registry.member_count() + 2)))
+
+    def _enqueue(self, entry: list):
+        """加入待傳播事件 (須持有鎖；同一成員只保留最新的事件)"""
+        self._events[entry[0]] = [entry, self._retransmits()]
+
+    def updates_for(self, target: str) -> list:
+        """
+        送往 target 的封包附帶的成員事件 (不超過 GOSSIP_MAX_PACKET)
+        自己的存活資訊在最前，其次是關於 target 本身的事件 (讓被懷疑的成員儘快反駁)，
+        再依剩餘傳送次數多 (較新) 的事件，最後補上少量隨機成員
+        """
+        budget = GOSSIP_MAX_PACKET - _HEADER_ROOM
+        with self._lock:
+            entries = [self._self_entry()]
+            size = len(json.dumps(entries))
+            pending = sorted(self._events.items(), key=lambda item: (item[0] != target, -item[1][1]))
+            for ip, item in pending:
+                entry_size = len(json.dumps(item[0])) + 1
+                if size + entry_size > budget:
+                    break
+                entries.append(item[0])
+                size += entry_size
+                item[1] -= 1
+                if item[1] <= 0:
+                    del self._events[ip]
+
+        included = {entry[0] for entry in entries}
+        for entry in self.registry.member_entries(GOSSIP_SAMPLE, exclude=included):
+            entry_size = len(json.dumps(entry)) + 1
+            if size + entry_size > budget:
+                break
+            entries.append(entry)
+            size += entry_size
+        return entries
+
+    def piggyback(self, target: str) -> Optional[dict]:
+        """附加在送往 target 的量測封包中的欄位 (只送給 gossip 成員)"""
+        if not self.registry.is_member(target):
+            return None
+        return {"updates": self.updates_for(target)}
+
+    def apply(self, updates, sender_ip: Optional[str] = None, announced: bool = False):
+        """
+        套用成員事件，被接受的事件繼續傳播
+        sender_ip 為直接送來此訊息的成員 (本機判定時為 None)；收到成員的 gossip (非廣播) 即視為已加入
+        """
+        if not isinstance(updates, list):
+            return
+        now = time.monotonic()
+        with self._lock:
+            if sender_ip and not announced:
+                self._joined = True
+            for entry in updates:
+                if not isinstance(entry, list) or len(entry) != 5:
+                    continue
+                ip, incarnation, code, hostname, platform_name = entry
+                state = _STATES.get(code)
+                if state is None or not isinstance(incarnation, int):
+                    continue
+
+                if ip in self.local_addresses:
+                    # 自己被懷疑或判定離線: 遞增 incarnation 反駁
+                    if state != ALIVE and incarnation >= self.incarnation:
+                        self.incarnation = incarnation + 1
+                        self._enqueue(self._self_entry())
+                    continue
+
+                tombstone = self._dead.get(ip)
+                if tombstone and incarnation <= tombstone[0]:
+                    continue
+                if not self.registry.apply_member(ip, hostname, platform_name, incarnation, state):
+                    continue
+
+                self._enqueue(entry)
+                if state == SUSPECT:
+                    self._suspects[ip] = (incarnation, now)
+                else:
+                    self._suspects.pop(ip, None)
+                    if state == DEAD:
+                        self._dead[ip] = (incarnation, now)
+
+        # 直接收到的訊息也是發送者存活的訊號
+        if sender_ip:
+            self.registry.heard(sender_ip)
+
+    def _declare(self, ip: str, state: str):
+        """本機判定成員狀態 (量測失敗時懷疑、懷疑逾時後離線)"""
+        peer = self.registry.get(ip)
+        if peer is None or peer.state is None:
+            return
+        self.apply([[ip, peer.incarnation, STATE_CODES[state], peer.hostname, peer.platform]])
+
+    def _expire(self):
+        """懷疑逾時的成員判定離線，清除過期的墓碑與轉送紀錄"""
+        now = time.monotonic()
+        timeout = GOSSIP_SUSPECT_MULT * max(1.0, math.log10(self.registry.member_count() + 1)) * GOSSIP_PERIOD
+        with self._lock:
+            expired = [ip for ip, (_, since) in self._suspects.items() if now - since > timeout]
+            for ip in expired:
+                del self._suspects[ip]
+            for ip, (_, since) in list(self._dead.items()):
+                if now - since > GOSSIP_DEAD_RETENTION:
+                    del self._dead[ip]
+            for relay_id, (_, _, deadline) in list(self._relays.items()):
+                if now > deadline:
+                    del self._relays[relay_id]
+        for ip in expired:
+            self._declare(ip, DEAD)
+
+    # ==================== 量測 ====================
+
+    def _next_targets(self) -> List[str]:
+        """
+        本週期的量測目標: 依打亂後的順序輪流取 GOSSIP_PROBES 個成員，
+        非 gossip 對端與節點的次要位址每 PING_INTERVAL 秒全部量測
+        """
+        members = set(self.registry.member_ips())
+        self._order = [ip for ip in self._order if ip in members]
+        if not self._order:
+            self._order = list(members)
+            random.shuffle(self._order)
+        targets = self._order[:GOSSIP_PROBES]
+        del self._order[:GOSSIP_PROBES]
+
+        now = time.monotonic()
+        if now >= self._next_legacy:
+            self._next_legacy = now + PING_INTERVAL
+            targets += self.registry.legacy_ips() + self.registry.alias_ips()
+        return targets
+
+    def helpers(self, target: str) -> List[str]:
+        """可代為量測 target 的成員 (target 不是 gossip 成員時不做間接量測)"""
+        if not self.registry.is_member(target):
+            return []
+        candidates = [ip for ip in self.registry.member_ips(alive=True) if ip != target]
+        return random.sample(candidates, min(GOSSIP_INDIRECT, len(candidates)))
+
+    def _on_reply(self, message: dict, ip: str):
+        if "updates" in message:
+            self.apply(message["updates"], ip)
+        if not message.get("relay"):
+            self.registry.set_capacity(ip, message.get("cap"))
+
+    def probe_round(self):
+        """一個協定週期的量測"""
+        targets = self._next_targets()
+        if targets:
+            via = {}
+            results = self.prober.probe_many(targets, via=via, piggyback=self.piggyback,
+                                             on_reply=self._on_reply, helpers=self.helpers,
+                                             tcp=lambda ip: not self.registry.is_member(ip))
+            for ip, ping_ms in results.items():
+                if via.get(ip) == "indirect":
+                    # 間接確認: 成員存活，但延遲含轉送時間，不記入統計
+                    self.registry.heard(ip)
+                    continue
+                self.registry.update_ping(ip, ping_ms, alive=via.get(ip) != "refused")
+                # 次要位址不通只代表該路徑不可用，不懷疑成員
+                if ping_ms is None and self.registry.resolve(ip) == ip:
+                    self._declare(ip, SUSPECT)
+        self._expire()
+        # 非 gossip 對端仍依直接觀察判斷
+        self.registry.check_health()
+
+    def run(self, running):
+        """量測循環 (running() 返回 False 時結束)"""
+        while running():
+            start = time.monotonic()
+            self.probe_round()
+            time.sleep(max(0.0, GOSSIP_PERIOD - (time.monotonic() - start)))
+
+    # ==================== 公告 ====================
+
+    @property
+    def joined(self) -> bool:
+        return self._joined and self.registry.member_count() > 0
+
+    def announcement(self) -> dict:
+        """廣播 / 回應訊息中的 gossip 欄位"""
+        return {"gossip": 1, "inc": self.incarnation, "joined": int(self.joined)}
+
+    def should_announce(self) -> bool:
+        """
+        每 BROADCAST_INTERVAL 秒詢問一次是否廣播
+        加入前一律廣播；加入後每個 GOSSIP_ANNOUNCE_INTERVAL 間隔在隨機時間點廣播一次，
+        若此間隔內已聽到 GOSSIP_SUPPRESS 個成員的廣播則省略
+        """
+        if not self.joined:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now - self._interval_start >= GOSSIP_ANNOUNCE_INTERVAL:
+                self._interval_start = now
+                self._announce_at = now + random.uniform(GOSSIP_ANNOUNCE_INTERVAL / 2, GOSSIP_ANNOUNCE_INTERVAL)
+                self._announced = False
+                self._heard = 0
+            if self._announced or now < self._announce_at:
+                return False
+            self._announced = True
+            return self._heard < GOSSIP_SUPPRESS
+
+    def announce_legacy(self, sock, message: bytes):
+        """單播公告給不支援 gossip 的對端 (它們依 PEER_TIMEOUT 判斷離線，需要持續收到訊息)"""
+        for ip in self.registry.legacy_ips():
+            try:
+                sock.sendto(message, (ip, DISCOVERY_PORT))
+            except OSError:
+                pass
+
+    def on_announce(self, message: dict, sender_ip: str, sock, reply: bytes, member_ip: Optional[str] = None):
+        """
+        收到 gossip 成員的廣播或回應 (reply 為本機的回應訊息)
+        member_ip 為成員的主要位址 (多介面成員從其他介面廣播時與 sender_ip 不同)，回應一律送回 sender_ip
+        新成員 (或尚未加入的成員) 的廣播以 GOSSIP_FANOUT / N 的機率回應，並同步成員列表
+        """
+        incarnation = message.get("inc")
+        if not isinstance(incarnation, int):
+            return
+        member_ip = member_ip or sender_ip
+        is_new = not self.registry.is_member(member_ip)
+        self.apply([[member_ip, incarnation, STATE_CODES[ALIVE],
+                     message.get("hostname", "Unknown"), message.get("platform", "Unknown")]],
+                   sender_ip, announced=True)
+
+        if message.get("type") == MSG_TYPE_RESPONSE:
+            return
+        with self._lock:
+            self._heard += 1
+        if not (is_new or not message.get("joined")):
+            return
+        if random.random() >= min(1.0, GOSSIP_FANOUT / max(1, self.registry.member_count())):
+            return
+        _send(sock, reply, (sender_ip, DISCOVERY_PORT))
+        self._sync(sock, (sender_ip, DISCOVERY_PORT))
+
+    def _sync(self, sock, addr: tuple):
+        """把所有成員分成多個封包送給新成員"""
+        budget = GOSSIP_MAX_PACKET - _HEADER_ROOM
+        entries = [self._self_entry()] + self.registry.member_entries()
+        batch, size = [], 2
+        for entry in entries:
+            entry_size = len(json.dumps(entry)) + 1
+            if batch and size + entry_size > budget:
+                _send(sock, json.dumps({"type": MSG_TYPE_GOSSIP, "updates": batch}).encode('utf-8'), addr)
+                batch, size = [], 2
+            batch.append(entry)
+            size += entry_size
+        if batch:
+            _send(sock, json.dumps({"type": MSG_TYPE_GOSSIP, "updates": batch}).encode('utf-8'), addr)
+
+    # ==================== 監聽執行緒收到的量測訊息 ====================
+
+    def on_ping(self, message: dict, addr: tuple) -> Optional[dict]:
+        """收到附帶成員事件的 PING: 套用事件，返回要附加在 PONG 中的欄位"""
+        if "updates" not in message:
+            return None
+        self.apply(message["updates"], addr[0])
+        return {"updates": self.updates_for(addr[0])}
+
+    def on_ping_req(self, message: dict, addr: tuple, sock):
+        """代為量測: 從監聽 socket 送 PING 給 target，收到 PONG 後以原 id 轉回請求者"""
+        self.apply(message.get("updates"), addr[0])
+        target = message.get("target")
+        if not isinstance(target, str):
+            return
+        with self._lock:
+            self._relay_seq += 1
+            relay_id = f"relay-{self._relay_seq}"
+            self._relays[relay_id] = (addr, message.get("id"), time.monotonic() + PING_TIMEOUT)
+        try:
+            sock.sendto(ping_message(relay_id, self.piggyback(target)), (target, DISCOVERY_PORT))
+        except OSError:
+            pass
+
+    def on_pong(self, message: dict, addr: tuple, sock):
+        """監聽 socket 收到的 PONG (代為量測的回應)"""
+        if "updates" in message:
+            self.apply(message["updates"], addr[0])
+        with self._lock:
+            relay = self._relays.pop(message.get("id"), None)
+        if relay is None:
+            return
+        requester, probe_id, _ = relay
+        try:
+            sock.sendto(pong_message(probe_id, {"relay": 1}), requester)
+        except OSError:
+            pass
+
+    def on_gossip(self, message: dict, addr: tuple):
+        self.apply(message.get("updates"), addr[0])
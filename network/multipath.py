@@ -0,0 +1,159 @@
+"""
+多路徑並行傳輸的條帶分配
+對端有多個位址時 (雙網卡、有線 + Thunderbolt 橋接等)，並行連接平均分散到各路徑，
+檔案切成 PARALLEL_STRIPE_SIZE 的條帶放在共用佇列: 連接完成一條帶後再領取下一條，
+吞吐量高的路徑自然分到較多條帶 (依實測吞吐量加權)；
+連接失敗時其條帶放回佇列由其他連接重送，該路徑不再建立新連接，傳輸不中斷
+接收端的同一分塊端口可被重新連接，每條連接依序接收多個條帶 (見 TransferServer._handle_multipath_worker)
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import PARALLEL_STRIPE_SIZE, PARALLEL_STRIPE_MIN
+
+# 條帶: (偏移量, 大小)
+Stripe = Tuple[int, int]
+
+
+def stripe_size(filesize: int, streams: int) -> int:
+    """條帶大小: 每條連接至少分到約 4 條帶 (讓快慢路徑的分配有調整空間)，介於 PARALLEL_STRIPE_MIN 與 PARALLEL_STRIPE_SIZE"""
+    return max(PARALLEL_STRIPE_MIN, min(PARALLEL_STRIPE_SIZE, filesize // max(1, streams * 4)))
+
+
+class PathStats:
+    """單一路徑在本次傳輸中的統計"""
+    __slots__ = ("address", "sent", "seconds", "stripes", "alive")
+
+    def __init__(self, address: str):
+        self.address = address
+        self.sent = 0           # 已完成條帶的字節數
+        self.seconds = 0.0      # 各連接傳送條帶的時間總和
+        self.stripes = 0
+        self.alive = True
+
+    @property
+    def throughput(self) -> float:
+        """單一連接的平均吞吐量 (bytes/s)"""
+        return self.sent / self.seconds if self.seconds > 0 else 0.0
+
+
+class StripePlan:
+    """
+    發送端: 條帶佇列與路徑狀態 (各連接的工作者執行緒共用)
+    佇列已空但仍有條帶在傳送中時 take() 等待，傳送失敗放回的條帶由仍在執行的工作者接手
+    """
+
+    def __init__(self, filesize: int, size: int, addresses: List[str]):
+        self._pending = deque((offset, min(size, filesize - offset)) for offset in range(0, filesize, size))
+        self.total = len(self._pending)
+        self.completed = 0
+        self._inflight = 0
+        self.paths: Dict[str, PathStats] = {address: PathStats(address) for address in addresses}
+        self._order = list(self.paths)
+        self._cond = threading.Condition()
+
+    def assign(self, stream: int) -> Optional[str]:
+        """分塊連接 stream 要使用的路徑 (在仍可用的路徑間輪流)，沒有可用路徑時為 None"""
+        with self._cond:
+            alive = [address for address in self._order if self.paths[address].alive]
+            return alive[stream % len(alive)] if alive else None
+
+    def take(self) -> Optional[Stripe]:
+        """領取下一條帶，所有條帶都已完成 (或無法再完成) 時返回 None"""
+        with self._cond:
+            while not self._pending and self._inflight:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            self._inflight += 1
+            return self._pending.popleft()
+
+    def done(self, stripe: Stripe, address: str, seconds: float):
+        with self._cond:
+            self._inflight -= 1
+            self.completed += 1
+            stats = self.paths[address]
+            stats.sent += stripe[1]
+            stats.seconds += seconds
+            stats.stripes += 1
+            self._cond.notify_all()
+
+    def failed(self, stripe: Optional[Stripe], address: str):
+        """連接失敗: 條帶放回佇列最前面，路徑不再建立新連接"""
+        with self._cond:
+            if stripe is not None:
+                self._inflight -= 1
+                self._pending.appendleft(stripe)
+            self.paths[address].alive = False
+            self._cond.notify_all()
+
+    @property
+    def complete(self) -> bool:
+        with self._cond:
+            return self.completed == self.total
+
+    def summary(self) -> str:
+        parts = []
+        with self._cond:
+            for stats in self.paths.values():
+                state = f"{stats.sent / 1048576:.0f}MB, {stats.throughput / 1048576:.1f} MB/s/連接"
+                parts.append(f"{stats.address} ({state}{'' if stats.alive else ', 已停用'})")
+        return "; ".join(parts)
+
+
+class StripeReceipt:
+    """
+    接收端: 已完成的條帶 (以偏移量記錄，重送的條帶只算一次)
+    wait() 在全部完成時返回 True，已停止或超過 idle_timeout 秒沒有收到任何資料時返回 False
+    """
+
+    def __init__(self, filesize: int):
+        self.filesize = filesize
+        self._done: Dict[int, int] = {}
+        self._received = 0
+        self._stopped = False
+        self.last_activity = time.monotonic()
+        self._cond = threading.Condition()
+
+    def valid(self, offset, size) -> bool:
+        return (isinstance(offset, int) and isinstance(size, int) and offset >= 0 and size > 0
+                and offset + size <= self.filesize)
+
+    def touch(self):
+        """收到資料 (屬性賦值，不需要鎖)"""
+        self.last_activity = time.monotonic()
+
+    def add(self, offset: int, size: int):
+        with self._cond:
+            if offset not in self._done:
+                self._done[offset] = size
+                self._received += size
+            self._cond.notify_all()
+
+    @property
+    def complete(self) -> bool:
+        return self._received >= self.filesize
+
+    @property
+    def finished(self) -> bool:
+        """已完成或已停止 (工作者據此結束)"""
+        return self._stopped or self.complete
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def wait(self, idle_timeout: float) -> bool:
+        with self._cond:
+            while not self.complete:
+                if self._stopped or time.monotonic() - self.last_activity > idle_timeout:
+                    return False
+                self._cond.wait(1.0)
+            return True
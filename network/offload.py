@@ -0,0 +1,234 @@
+"""
+CPU 密集工作卸載 (完整檔案 hash、區段 digest、壓縮)
+傳輸執行緒共用一個 GIL，大輸入交給程序池在其他核心計算；
+工作程序以 mmap 直接讀取檔案，呼叫端只傳遞路徑與偏移量 (檔案內容不經過 pickle)
+輸入小於 OFFLOAD_MIN_SIZE、單核心或程序池無法使用時，同樣的函式直接在呼叫端執行
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import BrokenExecutor, Executor
+from typing import Iterator, List, Optional, Tuple
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import OFFLOAD_WORKERS, OFFLOAD_MIN_SIZE, OFFLOAD_BLOCK_SIZE
+from network.capabilities import new_hash
+
+# zlib 串流標頭 (壓縮等級 1，與 zlib.compressobj(1) 產生的相同) 與 deflate 窗口大小
+_ZLIB_HEADER_FAST = b'\x78\x01'
+_DEFLATE_WINDOW = 32768
+_ADLER_BASE = 65521
+
+
+# ==================== 工作函式 (程序池與呼叫端共用) ====================
+
+class _MappedRange:
+    """以 mmap 映射檔案的 [offset, offset + length)，view 為該區段的 memoryview"""
+
+    def __init__(self, path: str, offset: int, length: int):
+        # mmap 的偏移量必須對齊 ALLOCATIONGRANULARITY
+        aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), length + offset - aligned,
+                                  offset=aligned, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        self._base = memoryview(self._map)
+        self.view = self._base[offset - aligned:]
+
+    def __enter__(self) -> "_MappedRange":
+        return self
+
+    def __exit__(self, *exc):
+        # memoryview 必須先釋放，mmap 才能關閉
+        self.view.release()
+        self._base.release()
+        self._map.close()
+        self._file.close()
+
+
+def _digest_range(path: str, offset: int, length: int, algo: str) -> str:
+    """檔案區段的 hash (length 為 0 時為空資料的 hash)"""
+    hasher = new_hash(algo)
+    if length > 0:
+        with _MappedRange(path, offset, length) as mapped:
+            hasher.update(mapped.view)
+    return hasher.hexdigest()
+
+
+def _deflate_range(path: str, offset: int, length: int, level: int, last: bool) -> Tuple[bytes, int]:
+    """
+    以 raw deflate 壓縮檔案區段，返回 (壓縮資料, 區段的 adler32)
+    以前一個窗口 (32KB) 的原始資料作為字典，非最後區段以 Z_SYNC_FLUSH 結束 (位元組對齊)，
+    因此各區段的輸出依序串接即是一個完整的 deflate 串流 (同 pigz 的做法)
+    """
+    dict_start = max(0, offset - _DEFLATE_WINDOW)
+    with _MappedRange(path, dict_start, offset + length - dict_start) as mapped:
+        zdict = mapped.view[:offset - dict_start]
+        data = mapped.view[offset - dict_start:]
+        if zdict:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=bytes(zdict))
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        out = compressor.compress(data)
+        out += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        checksum = zlib.adler32(data)
+        zdict.release()
+        data.release()
+    return out, checksum
+
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """合併兩段資料的 adler32 (同 zlib 的 adler32_combine，len2 為第二段長度)"""
+    rem = len2 % _ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % _ADLER_BASE
+    sum1 += (adler2 & 0xffff) + _ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + _ADLER_BASE - rem
+    if sum1 >= _ADLER_BASE:
+        sum1 -= _ADLER_BASE
+    if sum1 >= _ADLER_BASE:
+        sum1 -= _ADLER_BASE
+    if sum2 >= _ADLER_BASE << 1:
+        sum2 -= _ADLER_BASE << 1
+    if sum2 >= _ADLER_BASE:
+        sum2 -= _ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+# ==================== 卸載層 ====================
+
+class CpuOffload:
+    """
+    CPU 密集工作的卸載層
+    executor 可替換為任何 concurrent.futures.Executor (預設為 spawn 啟動的程序池，首次使用時才建立)；
+    workers <= 1 表示不卸載，所有工作在呼叫端執行
+    """
+
+    def __init__(self, workers: int = OFFLOAD_WORKERS, min_size: int = OFFLOAD_MIN_SIZE,
+                 block_size: int = OFFLOAD_BLOCK_SIZE, executor: Optional[Executor] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        self.block_size = block_size
+        self.offloaded = 0      # 交給程序池的工作數
+        self.inline = 0         # 在呼叫端執行的工作數
+        self._executor = executor
+        self._lock = threading.Lock()
+
+    def _pool(self, size: int) -> Optional[Executor]:
+        """大輸入返回程序池，小輸入或不可用時返回 None (在呼叫端計算)"""
+        if size < self.min_size or (self._executor is None and self.workers <= 1):
+            return None
+        with self._lock:
+            if self._executor is None:
+                # 程序池模組在首次卸載時才載入 (不拖慢啟動)
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn: 不複製呼叫端的執行緒與 GUI 狀態
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _disable(self):
+        """程序池損壞 (例如工作程序被終止): 之後一律在呼叫端計算"""
+        with self._lock:
+            self.workers = 1
+            self._executor = None
+
+    def _run(self, size: int, fn, *args):
+        pool = self._pool(size)
+        if pool is not None:
+            try:
+                result = pool.submit(fn, *args).result()
+                self.offloaded += 1
+                return result
+            except BrokenExecutor:
+                self._disable()
+        self.inline += 1
+        return fn(*args)
+
+    def file_digest(self, path: str, algo: str = "md5") -> str:
+        """整個檔案的 hash"""
+        size = os.path.getsize(path)
+        return self._run(size, _digest_range, path, 0, size, algo)
+
+    def range_digests(self, path: str, ranges: List[Tuple[int, int]], algo: str = "md5") -> List[str]:
+        """多個區段 [(offset, length), ...] 的 hash (分塊 digest)，大區段在程序池中並行計算"""
+        pool = self._pool(max((length for _, length in ranges), default=0))
+        if pool is not None:
+            try:
+                futures = [pool.submit(_digest_range, path, offset, length, algo) for offset, length in ranges]
+                results = [future.result() for future in futures]
+                self.offloaded += len(futures)
+                return results
+            except BrokenExecutor:
+                self._disable()
+        self.inline += len(ranges)
+        return [_digest_range(path, offset, length, algo) for offset, length in ranges]
+
+    def can_offload(self, size: int) -> bool:
+        """此大小的輸入是否會交給程序池 (呼叫端據此選擇串流壓縮或區塊壓縮)"""
+        return self._pool(size) is not None
+
+    def zlib_stream(self, path: str, size: int, level: int = 1) -> Iterator[Tuple[int, bytes]]:
+        """
+        以程序池平行壓縮檔案，依序產生 (已壓縮的原始字節數, zlib 串流片段)
+        輸出與 zlib.compressobj(level) 的串流格式相容，接收端以一般的 decompressobj 解壓
+        同時進行的區塊數以 workers * 2 為上限 (限制記憶體用量)；提前結束迭代時取消未開始的區塊
+        """
+        pool = self._pool(size)
+        if pool is None or level != 1:
+            raise ValueError("此輸入不使用程序池壓縮")
+
+        blocks = [(offset, min(self.block_size, size - offset))
+                  for offset in range(0, size, self.block_size)]
+        in_flight = deque()
+        next_block = 0
+        checksum = 1
+        done = 0
+
+        yield 0, _ZLIB_HEADER_FAST
+        try:
+            while next_block < len(blocks) or in_flight:
+                while next_block < len(blocks) and len(in_flight) < self.workers * 2:
+                    offset, length = blocks[next_block]
+                    last = next_block == len(blocks) - 1
+                    in_flight.append((length, pool.submit(_deflate_range, path, offset, length, level, last)))
+                    next_block += 1
+                length, future = in_flight.popleft()
+                data, block_checksum = future.result()
+                self.offloaded += 1
+                checksum = adler32_combine(checksum, block_checksum, length)
+                done += length
+                yield done, data
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+        yield done, struct.pack('>I', checksum)
+
+
+_offload: Optional[CpuOffload] = None
+_offload_lock = threading.Lock()
+
+
+def get_offload() -> CpuOffload:
+    """程序共用的卸載層"""
+    global _offload
+    with _offload_lock:
+        if _offload is None:
+            _offload = CpuOffload()
+        return _offload
+
+
+def set_offload(offload: CpuOffload):
+    """替換程序共用的卸載層 (例如改用其他 Executor，或以 workers=1 停用卸載)"""
+    global _offload
+    with _offload_lock:
+        _offload = offload
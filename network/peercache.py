@@ -0,0 +1,61 @@
+"""
+節點快取 (warm start)
+把最近收到訊號的節點 (所有位址、平滑 RTT、協商後的能力) 存到本地 JSON，
+下次啟動時同時量測這些節點，有回應的立即出現在列表上，不必等待廣播；
+廣播被網路擋住 (不同 VLAN、AP 隔離) 時也能以單播找回先前的節點
+"""
+import json
+import time
+from typing import List
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import PEER_CACHE_MAX_AGE, PEER_CACHE_SIZE
+
+
+def _valid(entry) -> bool:
+    return (isinstance(entry, dict) and isinstance(entry.get("ip"), str)
+            and isinstance(entry.get("addresses"), list) and isinstance(entry.get("last_seen"), (int, float)))
+
+
+class PeerCache:
+    """
+    節點快取檔案
+    save() 與檔案中的舊項目合併 (本次未出現的節點保留到 max_age 秒)，依最後出現時間保留最新的 max_entries 個
+    """
+
+    def __init__(self, path: str, max_age: float = PEER_CACHE_MAX_AGE, max_entries: int = PEER_CACHE_SIZE):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+
+    def load(self) -> List[dict]:
+        """未過期的項目 (最近出現的在前)，檔案不存在或損壞時為空"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if not isinstance(entries, list):
+            return []
+        cutoff = time.time() - self.max_age
+        entries = [entry for entry in entries if _valid(entry) and entry["last_seen"] >= cutoff]
+        entries.sort(key=lambda entry: entry["last_seen"], reverse=True)
+        return entries[:self.max_entries]
+
+    def save(self, entries: List[dict]):
+        """寫入目前的節點 (先寫暫存檔再取代，程式中途結束不會留下損壞的快取)"""
+        current = {address for entry in entries for address in entry["addresses"]}
+        merged = list(entries)
+        for old in self.load():
+            if old["ip"] not in current and not current.intersection(old["addresses"]):
+                merged.append(old)
+        merged.sort(key=lambda entry: entry["last_seen"], reverse=True)
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(merged[:self.max_entries], f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,192 @@
+"""
+接收管線 (網路 → 磁碟雙緩衝)
+網路階段以 recv_into 填滿預先分配的緩衝區，獨立的寫入執行緒把緩衝區寫到磁碟
+磁碟慢時不再阻塞 recv (TCP 窗口不會因此縮小)，並以等待計數判斷瓶頸在網路或磁碟
+"""
+import socket
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import PIPELINE_BUFFERS, PIPELINE_BUFFER_SIZE
+from utils.fileio import write_at
+from network.resources import get_buffer_pool
+
+# 寫入執行緒的控制訊號
+_DRAIN = object()   # 本檔案的緩衝區已全部送出，寫完後通知網路階段
+_STOP = object()    # 結束寫入執行緒
+
+
+class PipelineStats:
+    """
+    管線等待統計
+    disk_*: 網路階段等不到空閒緩衝區 (磁碟寫入跟不上)
+    net_*: 寫入階段等不到已填滿的緩衝區 (網路接收跟不上)
+    """
+    __slots__ = ("bytes", "buffers", "disk_stalls", "disk_wait", "net_stalls", "net_wait")
+
+    def __init__(self):
+        self.bytes = 0
+        self.buffers = 0
+        self.disk_stalls = 0
+        self.disk_wait = 0.0
+        self.net_stalls = 0
+        self.net_wait = 0.0
+
+    def merge(self, other: "PipelineStats"):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def bottleneck(self) -> str:
+        """等待時間較多的一方即為瓶頸的另一方"""
+        if self.disk_wait > self.net_wait:
+            return "disk"
+        return "network"
+
+    def summary(self) -> str:
+        return (f"{self.bytes / 1048576:.1f} MB / {self.buffers} 緩衝區, "
+                f"磁碟等待 {self.disk_stalls} 次 ({self.disk_wait:.2f}s), "
+                f"網路等待 {self.net_stalls} 次 ({self.net_wait:.2f}s), "
+                f"瓶頸: {self.bottleneck()}")
+
+
+class ReceivePipeline:
+    """
+    單一連接的接收管線 (可連續接收多個檔案，例如資料夾傳輸)
+    緩衝區環大小固定，記憶體用量為 buffers * buffer_size (即 memory_size())，
+    緩衝區取自程序共用的緩衝區池，close() 時歸還
+    使用完畢必須呼叫 close()
+    """
+
+    def __init__(self, buffers: int = PIPELINE_BUFFERS, buffer_size: int = PIPELINE_BUFFER_SIZE):
+        self.stats = PipelineStats()
+        self._pool = get_buffer_pool()
+        self._buffers = [self._pool.acquire(buffer_size) for _ in range(max(2, buffers))]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for buf in self._buffers:
+            self._free.put(buf)
+
+        # 目前檔案的寫入狀態 (只在網路階段等待排空後才會更換)
+        self._fd = None
+        self._cache = None
+        self._sync = None
+        self._flow = None
+        self._written = 0
+        self._error: Optional[BaseException] = None
+        self._active = False
+        self._drained = threading.Event()
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        """寫入階段: 取出已填滿的緩衝區寫入磁碟，再放回空閒佇列"""
+        while True:
+            try:
+                item = self._filled.get_nowait()
+            except queue.Empty:
+                start = time.perf_counter()
+                item = self._filled.get()
+                if self._active and item is not _DRAIN:
+                    self.stats.net_stalls += 1
+                    self.stats.net_wait += time.perf_counter() - start
+
+            if item is _STOP:
+                return
+            if item is _DRAIN:
+                self._drained.set()
+                continue
+
+            buf, length, offset = item
+            if self._error is None:
+                try:
+                    # 有 I/O 排程時先取得寫入名額 (等待名額也算在磁碟等待內)
+                    with self._flow.io(length) if self._flow else nullcontext():
+                        write_at(self._fd, memoryview(buf)[:length], offset)
+                    self._written += length
+                    if self._cache:
+                        self._cache.advance(self._written)
+                    if self._sync:
+                        self._sync.add(length)
+                except OSError as e:
+                    self._error = e
+            self._free.put(buf)
+
+    def _take_free(self) -> bytearray:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            buf = self._free.get()
+            self.stats.disk_stalls += 1
+            self.stats.disk_wait += time.perf_counter() - start
+            return buf
+
+    def receive(self, sock: socket.socket, fd: int, offset: int, size: int,
+                on_progress: Optional[Callable] = None, cache=None, sync=None, flow=None):
+        """
+        從 sock 接收 size bytes 寫入 fd 的 [offset, offset + size)
+        返回前等待所有緩衝區寫入完成；連接中斷或寫入失敗時拋出例外
+        on_progress(已接收字節數) 在每個緩衝區填滿後呼叫
+        cache 為 CacheAdvisor、sync 為 RangeSync、flow 為 IOFlow (皆可省略)，由寫入執行緒使用
+        """
+        self._fd = fd
+        self._cache = cache
+        self._sync = sync
+        self._flow = flow
+        self._written = 0
+        self._error = None
+        self._active = True
+        received = 0
+
+        try:
+            while received < size and self._error is None:
+                buf = self._take_free()
+                view = memoryview(buf)
+                want = min(len(buf), size - received)
+                filled = 0
+                try:
+                    while filled < want:
+                        n = sock.recv_into(view[filled:want])
+                        if n == 0:
+                            raise Exception("連接中斷")
+                        filled += n
+                except BaseException:
+                    self._free.put(buf)
+                    raise
+
+                self._filled.put((buf, filled, offset + received))
+                received += filled
+                self.stats.buffers += 1
+                if on_progress:
+                    on_progress(received)
+        finally:
+            # 等待寫入階段排空，之後才能更換檔案或回應確認
+            self._drained.clear()
+            self._filled.put(_DRAIN)
+            self._drained.wait()
+            self._active = False
+
+        self.stats.bytes += received
+        if self._error is not None:
+            raise self._error
+
+    @staticmethod
+    def memory_size(buffers: int = PIPELINE_BUFFERS, buffer_size: int = PIPELINE_BUFFER_SIZE) -> int:
+        """一條管線佔用的緩衝區記憶體 (供准入時預留預算)"""
+        return max(2, buffers) * buffer_size
+
+    def close(self):
+        """結束寫入執行緒並歸還緩衝區"""
+        self._filled.put(_STOP)
+        self._writer.join()
+        for buf in self._buffers:
+            self._pool.release(buf)
+        self._buffers = []
@@ -0,0 +1,335 @@
+"""
+節點延遲 (RTT) 量測
+在程序內以單一 selector 迴圈同時量測多個主機，不啟動外部 ping 程式，也不需要 root (不使用 ICMP)
+每個目標先送 UDP echo 到對端的發現端口 (對端監聽執行緒原樣帶回 id)；
+PROBE_FALLBACK_DELAY 秒內無回應 (舊版對端或 UDP 被擋) 時，改以非阻塞 TCP connect 到傳輸端口量測，
+連接成功或被拒 (RST) 都代表主機可達；
+gossip 模式另外請其他成員代為量測 (PING_REQ)，並在量測封包中附帶成員事件 (見 network.membership)
+tcp_sweep() 以同樣的方式掃描整個網段的傳輸端口 (廣播被擋時的主動發現)
+"""
+import errno
+import json
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    DISCOVERY_PORT, TRANSFER_PORT, PING_TIMEOUT, PROBE_FALLBACK_DELAY, PROBE_MAX_INFLIGHT,
+    SWEEP_TIMEOUT, SWEEP_RATE, SWEEP_MAX_INFLIGHT,
+    MSG_TYPE_PING, MSG_TYPE_PONG, MSG_TYPE_PING_REQ
+)
+
+# 非阻塞 connect 的「進行中」與「被拒」錯誤碼 (Windows 為 WSA 錯誤碼)
+_CONNECT_PENDING = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                    getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+_CONNECT_REFUSED = {errno.ECONNREFUSED, getattr(errno, 'WSAECONNREFUSED', errno.ECONNREFUSED)}
+
+
+class _Probe:
+    """單一目標的量測狀態"""
+    __slots__ = ("ip", "id", "sent", "sock", "connect_start", "tcp_failed", "rtt", "via")
+
+    def __init__(self, ip: str, probe_id: str):
+        self.ip = ip
+        self.id = probe_id
+        self.sent: Optional[float] = None           # UDP echo 送出時間 (送出失敗為 None)
+        self.sock: Optional[socket.socket] = None   # 進行中的 TCP connect
+        self.connect_start = 0.0
+        self.tcp_failed = False
+        self.rtt: Optional[float] = None            # 結果 (ms)
+        self.via = ""                               # "udp" / "tcp" / "refused" / "indirect"
+
+    @property
+    def finished(self) -> bool:
+        return self.rtt is not None or (self.sent is None and self.tcp_failed)
+
+
+def _encode(msg_type: str, probe_id, extra: Optional[dict]) -> bytes:
+    message = {"type": msg_type, "id": probe_id}
+    if extra:
+        message.update(extra)
+    return json.dumps(message).encode('utf-8')
+
+
+def ping_message(probe_id: str, extra: Optional[dict] = None) -> bytes:
+    return _encode(MSG_TYPE_PING, probe_id, extra)
+
+
+def pong_message(probe_id, extra: Optional[dict] = None) -> bytes:
+    return _encode(MSG_TYPE_PONG, probe_id, extra)
+
+
+class RttProber:
+    """
+    並行 RTT 量測
+    probe_many() 一輪最多花 timeout 秒 (與目標數無關)；可由多個執行緒同時呼叫 (每次呼叫使用自己的 socket)
+    上次只有 TCP 回應的主機記在 _tcp_only，下次一開始就同時發起 TCP connect，不等 UDP 的回退延遲
+    """
+
+    def __init__(self, udp_port: int = DISCOVERY_PORT, tcp_port: int = TRANSFER_PORT,
+                 timeout: float = PING_TIMEOUT, fallback_delay: float = PROBE_FALLBACK_DELAY,
+                 max_inflight: int = PROBE_MAX_INFLIGHT):
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.timeout = timeout
+        self.fallback_delay = fallback_delay
+        self.max_inflight = max(1, max_inflight)
+        self._tcp_only: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def probe(self, ip: str, timeout: Optional[float] = None) -> Optional[float]:
+        """量測單一主機，返回延遲(ms)或 None"""
+        return self.probe_many([ip], timeout)[ip]
+
+    def probe_many(self, ips: Iterable[str], timeout: Optional[float] = None, via: Optional[dict] = None,
+                   piggyback: Optional[Callable] = None, on_reply: Optional[Callable] = None,
+                   helpers: Optional[Callable] = None, tcp: Optional[Callable] = None) -> Dict[str, Optional[float]]:
+        """
+        同時量測多個主機，返回 {ip: 延遲(ms) 或 None}
+        via 不為 None 時填入各主機的回應方式 ("udp" / "tcp" / "indirect"，間接確認的延遲含轉送時間；
+        "refused" 表示主機可達但傳輸端口沒有程式在監聽)
+        piggyback(ip) 返回要附加在送往 ip 的 PING / PING_REQ 中的欄位 (或 None)，
+        on_reply(message, ip) 在收到每個 PONG 時呼叫，helpers(ip) 返回可代為量測 ip 的主機列表，
+        tcp(ip) 返回 False 的主機不以 TCP 量測 (例如 gossip 成員: 主機可達不代表程式仍在執行)
+        """
+        timeout = self.timeout if timeout is None else timeout
+        targets = list(dict.fromkeys(ips))
+        results: Dict[str, Optional[float]] = {}
+        for start in range(0, len(targets), self.max_inflight):
+            results.update(self._probe_batch(targets[start:start + self.max_inflight], timeout,
+                                             via, piggyback, on_reply, helpers, tcp))
+        return results
+
+    # ---------- 單批量測 ----------
+
+    def _probe_batch(self, ips: List[str], timeout: float, via: Optional[dict], piggyback: Optional[Callable],
+                     on_reply: Optional[Callable], helpers: Optional[Callable],
+                     tcp: Optional[Callable]) -> Dict[str, Optional[float]]:
+        nonce = random.getrandbits(32)
+        probes = {}
+        with self._lock:
+            tcp_first = self._tcp_only.intersection(ips)
+        no_tcp = {ip for ip in ips if not tcp(ip)} if tcp else set()
+
+        sel = selectors.DefaultSelector()
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp.setblocking(False)
+            sel.register(udp, selectors.EVENT_READ)
+
+            start = time.perf_counter()
+            for index, ip in enumerate(ips):
+                probe = _Probe(ip, f"{nonce:08x}-{index}")
+                probe.tcp_failed = ip in no_tcp
+                probes[probe.id] = probe
+                try:
+                    udp.sendto(ping_message(probe.id, piggyback(ip) if piggyback else None),
+                               (ip, self.udp_port))
+                    probe.sent = time.perf_counter()
+                except OSError:
+                    # 無路由、位址無效等: 直接改用 TCP
+                    pass
+                if (probe.sent is None or ip in tcp_first) and not probe.tcp_failed:
+                    self._connect(sel, probe)
+
+            remaining = sum(1 for probe in probes.values() if not probe.finished)
+            deadline = start + timeout
+            fallback_at: Optional[float] = start + self.fallback_delay
+
+            while remaining:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                if fallback_at is not None and now >= fallback_at:
+                    fallback_at = None
+                    for probe in probes.values():
+                        if probe.rtt is None and probe.sock is None and not probe.tcp_failed:
+                            self._connect(sel, probe)
+                        if probe.rtt is None and helpers:
+                            self._request_indirect(udp, probe, helpers(probe.ip), piggyback)
+                    remaining = sum(1 for probe in probes.values() if not probe.finished)
+                    continue
+
+                wake = deadline if fallback_at is None else min(deadline, fallback_at)
+                for key, _ in sel.select(wake - now):
+                    if key.data is None:
+                        remaining -= self._read_pongs(udp, probes, on_reply)
+                    elif self._connected(sel, key.data):
+                        remaining -= 1
+        finally:
+            for probe in probes.values():
+                self._close_tcp(sel, probe)
+            sel.close()
+            udp.close()
+
+        with self._lock:
+            for probe in probes.values():
+                if via is not None:
+                    via[probe.ip] = probe.via
+                if probe.via in ("tcp", "refused"):
+                    self._tcp_only.add(probe.ip)
+                elif probe.via == "udp":
+                    self._tcp_only.discard(probe.ip)
+
+        return {probe.ip: probe.rtt for probe in probes.values()}
+
+    def _request_indirect(self, udp: socket.socket, probe: _Probe, helpers: List[str],
+                          piggyback: Optional[Callable]):
+        """請其他主機代為量測 (對方以相同 id 轉回 PONG)"""
+        if probe.sent is None:
+            return
+        for helper in helpers:
+            extra = dict(piggyback(helper) or {}) if piggyback else {}
+            extra["target"] = probe.ip
+            try:
+                udp.sendto(_encode(MSG_TYPE_PING_REQ, probe.id, extra), (helper, self.udp_port))
+            except OSError:
+                pass
+
+    def _read_pongs(self, udp: socket.socket, probes: Dict[str, _Probe], on_reply: Optional[Callable]) -> int:
+        """讀取所有已到達的 UDP 回應，返回因此完成的目標數"""
+        completed = 0
+        while True:
+            try:
+                data, addr = udp.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return completed
+            except ConnectionResetError:
+                # Windows: 先前送往未監聽端口所收到的 ICMP 錯誤
+                continue
+            except OSError:
+                return completed
+
+            now = time.perf_counter()
+            try:
+                message = json.loads(data.decode('utf-8'))
+            except (ValueError, UnicodeDecodeError):
+                continue
+            if not isinstance(message, dict) or message.get("type") != MSG_TYPE_PONG:
+                continue
+            if on_reply:
+                on_reply(message, addr[0])
+            probe = probes.get(message.get("id"))
+            if probe is None or probe.rtt is not None or probe.sent is None:
+                continue
+
+            was_finished = probe.finished
+            probe.rtt = (now - probe.sent) * 1000
+            probe.via = "indirect" if message.get("relay") else "udp"
+            if not was_finished:
+                completed += 1
+
+    def _connect(self, sel: selectors.BaseSelector, probe: _Probe):
+        """發起非阻塞 TCP connect (本機位址等情況可能立即完成)"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        probe.connect_start = time.perf_counter()
+        try:
+            err = sock.connect_ex((probe.ip, self.tcp_port))
+        except OSError as e:
+            err = e.errno
+
+        if err in _CONNECT_PENDING:
+            probe.sock = sock
+            sel.register(sock, selectors.EVENT_WRITE, probe)
+            return
+
+        sock.close()
+        self._tcp_result(probe, err)
+
+    def _connected(self, sel: selectors.BaseSelector, probe: _Probe) -> bool:
+        """TCP connect 完成 (成功或失敗)，返回目標是否因此完成"""
+        err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._close_tcp(sel, probe)
+        was_finished = probe.finished
+        self._tcp_result(probe, err)
+        return probe.finished and not was_finished
+
+    def _tcp_result(self, probe: _Probe, err: int):
+        if err == 0 or err in _CONNECT_REFUSED:
+            if probe.rtt is None:
+                probe.rtt = (time.perf_counter() - probe.connect_start) * 1000
+                probe.via = "tcp" if err == 0 else "refused"
+        else:
+            probe.tcp_failed = True
+
+    @staticmethod
+    def _close_tcp(sel: selectors.BaseSelector, probe: _Probe):
+        """關閉 TCP socket (已連上的以 FIN 正常關閉，對端伺服器視為空連接直接結束)"""
+        if probe.sock is None:
+            return
+        sel.unregister(probe.sock)
+        probe.sock.close()
+        probe.sock = None
+
+
+def tcp_sweep(ips: Iterable[str], port: int = TRANSFER_PORT, timeout: float = SWEEP_TIMEOUT,
+              rate: float = SWEEP_RATE, max_inflight: int = SWEEP_MAX_INFLIGHT) -> Dict[str, float]:
+    """
+    以單一 selector 迴圈對大量主機發起非阻塞 TCP connect，返回接受連接的主機 {ip: 連接時間(ms)}
+    每秒最多發起 rate 個 (平均分散，不一次湧出)、同時最多 max_inflight 個，
+    每個最多等待 timeout 秒；被拒 (主機存在但未執行本程式) 與逾時都不列入結果
+    """
+    pending = deque(dict.fromkeys(ips))
+    interval = 1.0 / rate if rate > 0 else 0.0
+    inflight: Dict[socket.socket, tuple] = {}   # 依發起順序 → (ip, 發起時間)，最早的最先逾時
+    results: Dict[str, float] = {}
+    sel = selectors.DefaultSelector()
+    next_start = time.perf_counter()
+
+    def finish(sock: socket.socket):
+        sel.unregister(sock)
+        del inflight[sock]
+        sock.close()
+
+    try:
+        while pending or inflight:
+            now = time.perf_counter()
+            while pending and len(inflight) < max_inflight and now >= next_start:
+                ip = pending.popleft()
+                next_start += interval
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex((ip, port))
+                except OSError as e:
+                    err = e.errno
+                if err in _CONNECT_PENDING:
+                    sel.register(sock, selectors.EVENT_WRITE, ip)
+                    inflight[sock] = (ip, now)
+                    continue
+                if err == 0:
+                    results[ip] = (time.perf_counter() - now) * 1000
+                sock.close()
+
+            # 逾時的連接 (依發起順序檢查，遇到未逾時的即停止)
+            for sock, (ip, started) in list(inflight.items()):
+                if now - started < timeout:
+                    break
+                finish(sock)
+
+            if not pending and not inflight:
+                break
+            wake = now + timeout
+            if inflight:
+                wake = min(wake, next(iter(inflight.values()))[1] + timeout)
+            if pending and len(inflight) < max_inflight:
+                wake = min(wake, next_start)
+            for key, _ in sel.select(max(0.0, wake - now)):
+                sock = key.fileobj
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    results[key.data] = (time.perf_counter() - inflight[sock][1]) * 1000
+                finish(sock)
+    finally:
+        for sock in list(inflight):
+            finish(sock)
+        sel.close()
+    return results
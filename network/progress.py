@@ -0,0 +1,79 @@
+"""
+傳輸進度彙整
+各串流 (單檔為 1 條，並行傳輸為每個分塊 1 條) 只更新自己的計數，不需要鎖；
+回呼合併後以最高每 PROGRESS_INTERVAL 秒一次送出，傳輸結束時 finish() 立即送出最終值
+"""
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import PROGRESS_INTERVAL
+
+
+class RateLimit:
+    """時間節流: ready() 距上次返回 True 已超過 interval 秒時返回 True"""
+    __slots__ = ("interval", "_next")
+
+    def __init__(self, interval: float = PROGRESS_INTERVAL):
+        self.interval = interval
+        self._next = 0.0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        return True
+
+
+class ProgressTracker:
+    """
+    一次傳輸的進度
+    listener(已完成字節數, 總字節數, 速度 bytes/s, 剩餘秒數)
+    set(stream, value) 由該串流唯一的寫入執行緒呼叫 (列表元素賦值在 GIL 下是原子操作)；
+    多個串流同時到達送出時間時只有一個送出，其餘直接返回 (不等待)
+    """
+
+    def __init__(self, total: int, listener: Optional[Callable] = None, streams: int = 1,
+                 interval: float = PROGRESS_INTERVAL):
+        self.total = total
+        self._listener = listener
+        self._counters = [0] * max(1, streams)
+        self._limit = RateLimit(interval)
+        self._emit_lock = threading.Lock()
+        self._start = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return sum(self._counters)
+
+    def rate(self) -> Tuple[float, float]:
+        """(目前平均速度 bytes/s, 預估剩餘秒數)"""
+        done = self.done
+        elapsed = time.monotonic() - self._start
+        speed = done / elapsed if elapsed > 0 else 0
+        remaining = (self.total - done) / speed if speed > 0 else 0
+        return speed, remaining
+
+    def set(self, stream: int, value: int):
+        """回報串流的累計字節數"""
+        self._counters[stream] = value
+        if self._listener and self._limit.ready() and self._emit_lock.acquire(False):
+            try:
+                self._emit()
+            finally:
+                self._emit_lock.release()
+
+    def finish(self):
+        """立即送出最終進度 (不受節流限制)"""
+        if self._listener:
+            with self._emit_lock:
+                self._emit()
+
+    def _emit(self):
+        speed, remaining = self.rate()
+        self._listener(self.done, self.total, speed, remaining)
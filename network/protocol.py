@@ -0,0 +1,377 @@
+"""
+傳輸協定編碼層
+JSON 協定 (版本 0，相容舊版) 與精簡二進位協定 (版本 1)
+二進位協定使用 struct 固定欄位、varint 與路徑前綴字典，減少大量小檔案時的 CPU 與流量
+"""
+import socket
+import json
+import struct
+from typing import Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    MSG_TYPE_TEXT, MSG_TYPE_FILE, MSG_TYPE_FOLDER_FILE, MSG_TYPE_FOLDER_END,
+    RESP_LENGTH, RESP_ACK_STRIPPED, RESP_SKIP_STRIPPED, RESP_ERROR_STRIPPED,
+    RESP_WIRE_PREFIX, WIRE_VERSION_JSON, WIRE_VERSION_BINARY, WIRE_VERSIONS, HEADER_MAX_SIZE
+)
+
+
+def recv_exact_into(sock: socket.socket, view: memoryview) -> bool:
+    """以 recv_into 收滿呼叫者提供的緩衝區 (熱路徑重複使用同一塊，不配置新物件)，連接關閉時返回 False"""
+    size = len(view)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return False
+        received += n
+    return True
+
+
+def recv_exact(sock: socket.socket, size: int, limit: Optional[int] = None) -> Optional[bytearray]:
+    """
+    精確接收指定大小的數據 (預先分配一次並以 recv_into 填入，直接返回該緩衝區，不再複製成 bytes)
+    size 來自對端時須指定 limit: 緩衝區在收到數據前就依 size 配置，超過 limit 時拋出 ValueError
+    """
+    if limit is not None and size > limit:
+        raise ValueError(f"數據長度 {size} bytes 超過上限 {limit} bytes")
+    buf = bytearray(size)
+    return buf if recv_exact_into(sock, memoryview(buf)) else None
+
+
+# ==================== 版本協商 ====================
+
+def choose_wire_version(offered) -> int:
+    """從對端提供的版本中選出雙方都支援的最高版本"""
+    try:
+        common = set(int(v) for v in offered) & set(WIRE_VERSIONS)
+    except (TypeError, ValueError):
+        return WIRE_VERSION_JSON
+    return max(common) if common else WIRE_VERSION_JSON
+
+
+def wire_response(version: int) -> str:
+    """協商結果的固定長度回應 (JSON 版本仍回 ACK，舊版客戶端可直接理解)"""
+    if version == WIRE_VERSION_JSON:
+        return RESP_ACK_STRIPPED.ljust(RESP_LENGTH, '_')
+    return f"{RESP_WIRE_PREFIX}{version}".ljust(RESP_LENGTH, '_')
+
+
+def parse_wire_response(response: str) -> Optional[int]:
+    """解析協商回應，返回選定版本；非確認回應返回 None"""
+    if response == RESP_ACK_STRIPPED:
+        return WIRE_VERSION_JSON
+    if response.startswith(RESP_WIRE_PREFIX):
+        try:
+            return int(response[len(RESP_WIRE_PREFIX):])
+        except ValueError:
+            return None
+    return None
+
+
+def create_codec(version: int):
+    """依協商版本建立編碼器 (每條連接一個，二進位版本帶有路徑字典狀態)"""
+    if version == WIRE_VERSION_BINARY:
+        return BinaryCodec()
+    return JsonCodec()
+
+
+# ==================== JSON 協定 (版本 0) ====================
+
+class JsonCodec:
+    """舊版協定: 4 bytes 長度 + JSON 標頭，回應為 8 bytes 填充字串"""
+
+    version = WIRE_VERSION_JSON
+
+    def encode_message(self, header: dict) -> bytes:
+        return json.dumps(header).encode('utf-8')
+
+    def decode_message(self, data: bytes) -> dict:
+        return json.loads(data.decode('utf-8'))
+
+    def send_header(self, sock: socket.socket, header: dict):
+        data = self.encode_message(header)
+        sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+    def recv_header(self, sock: socket.socket) -> Optional[dict]:
+        length_data = recv_exact(sock, 4)
+        if not length_data:
+            return None
+        data = recv_exact(sock, int.from_bytes(length_data, 'big'), HEADER_MAX_SIZE)
+        if not data:
+            return None
+        return self.decode_message(data)
+
+    def send_response(self, sock: socket.socket, response: str):
+        sock.sendall(response.encode('utf-8'))
+
+    def recv_response(self, sock: socket.socket) -> str:
+        try:
+            data = recv_exact(sock, RESP_LENGTH)
+            if data:
+                return data.decode('utf-8').rstrip('_')
+            return ""
+        except:
+            return ""
+
+
+# ==================== 二進位協定 (版本 1) ====================
+
+# 訊息代碼
+_CODE_TEXT = 1
+_CODE_FILE = 2
+_CODE_FOLDER_FILE = 3
+_CODE_FOLDER_END = 4
+_CODE_GENERIC = 127     # 其他訊息: 代碼 + JSON
+
+# 回應代碼 (1 byte)
+_RESP_CODES = {RESP_ACK_STRIPPED: 1, RESP_SKIP_STRIPPED: 2, RESP_ERROR_STRIPPED: 3}
+_RESP_NAMES = {v: k for k, v in _RESP_CODES.items()}
+
+# 標頭長度: 2 bytes，0xFFFF 表示後接 4 bytes 長度
+_LEN16 = struct.Struct('!H')
+_LEN32 = struct.Struct('!I')
+_LEN_ESCAPE = 0xFFFF
+
+# FOLDER_FILE 固定欄位: 代碼 + index + total + size + hash 類型
+_FOLDER_FILE = struct.Struct('!BIIQB')
+
+# hash 欄位類型
+_HASH_NONE = 0
+_HASH_HEX = 1       # 十六進位字串以原始 bytes 傳送 (長度減半)
+_HASH_TEXT = 2
+
+
+def _put_varint(out: bytearray, value: int):
+    """寫入無號 varint (LEB128)"""
+    if value < 0x80:
+        out.append(value)
+        return
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _put_str(out: bytearray, text: str):
+    data = text.encode('utf-8')
+    _put_varint(out, len(data))
+    out += data
+
+
+class _Reader:
+    """從 bytes 依序解析欄位"""
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self) -> int:
+        b = self.data[self.pos]
+        if b < 0x80:
+            self.pos += 1
+            return b
+        result = 0
+        shift = 0
+        while True:
+            b = self.data[self.pos]
+            self.pos += 1
+            result |= (b & 0x7F) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def raw(self) -> bytes:
+        length = self.varint()
+        value = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return bytes(value)
+
+    def str(self) -> str:
+        return self.raw().decode('utf-8')
+
+    def rest(self) -> bytes:
+        return bytes(self.data[self.pos:])
+
+
+def _split_path(rel_path: str) -> tuple:
+    """拆成 (目錄前綴, 檔名)，同時支援 / 與 \\ 分隔符"""
+    cut = max(rel_path.rfind('/'), rel_path.rfind('\\'))
+    if cut < 0:
+        return "", rel_path
+    return rel_path[:cut + 1], rel_path[cut + 1:]
+
+
+class BinaryCodec(JsonCodec):
+    """
+    精簡二進位協定
+    標頭: 2 bytes 長度 + 1 byte 訊息代碼 + 欄位 (struct 固定欄位 / varint / 長度前綴字串)
+    回應: 1 byte
+    路徑前綴在連接內只傳一次，之後以編號引用
+    """
+
+    version = WIRE_VERSION_BINARY
+
+    def __init__(self):
+        self._prefix_ids = {}       # 發送端: 前綴 -> 編號
+        self._prefixes = []         # 接收端: 編號 -> 前綴
+
+    # ---------- 路徑前綴字典 ----------
+
+    def _put_path(self, out: bytearray, rel_path: str):
+        prefix, name = _split_path(rel_path)
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            prefix_id = len(self._prefix_ids)
+            self._prefix_ids[prefix] = prefix_id
+            _put_varint(out, (prefix_id << 1) | 1)  # 最低位 1: 新前綴，後接內容
+            _put_str(out, prefix)
+        else:
+            _put_varint(out, prefix_id << 1)
+        _put_str(out, name)
+
+    def _get_path(self, reader: _Reader) -> str:
+        tag = reader.varint()
+        if tag & 1:
+            self._prefixes.append(reader.str())
+        prefix = self._prefixes[tag >> 1]
+        return prefix + reader.str()
+
+    # ---------- 訊息編碼 ----------
+
+    def encode_message(self, header: dict) -> bytes:
+        msg_type = header.get("type")
+        out = bytearray()
+
+        if msg_type == MSG_TYPE_FOLDER_FILE:
+            file_hash = header.get("hash", "")
+            hash_type = _HASH_NONE
+            raw = b''
+            if file_hash:
+                try:
+                    raw = bytes.fromhex(file_hash)
+                    hash_type = _HASH_HEX if raw.hex() == file_hash else _HASH_TEXT
+                except ValueError:
+                    hash_type = _HASH_TEXT
+                if hash_type == _HASH_TEXT:
+                    raw = file_hash.encode('utf-8')
+            out += _FOLDER_FILE.pack(_CODE_FOLDER_FILE, header.get("index", 0),
+                                     header.get("total", 0), header.get("size", 0), hash_type)
+            if hash_type != _HASH_NONE:
+                _put_varint(out, len(raw))
+                out += raw
+            self._put_path(out, header.get("rel_path", ""))
+
+        elif msg_type == MSG_TYPE_FOLDER_END:
+            out.append(_CODE_FOLDER_END)
+            _put_varint(out, header.get("total_sent", 0))
+            _put_varint(out, header.get("total_failed", 0))
+            _put_str(out, header.get("folder_name", ""))
+
+        elif msg_type == MSG_TYPE_TEXT:
+            out.append(_CODE_TEXT)
+            _put_varint(out, header.get("length", 0))
+
+        elif msg_type == MSG_TYPE_FILE:
+            out.append(_CODE_FILE)
+            _put_varint(out, header.get("filesize", 0))
+            _put_str(out, header.get("filename", ""))
+            _put_str(out, header.get("compression", ""))
+
+        else:
+            out.append(_CODE_GENERIC)
+            out += json.dumps(header).encode('utf-8')
+
+        return bytes(out)
+
+    def decode_message(self, data: bytes) -> dict:
+        reader = _Reader(data)
+        code = reader.byte()
+
+        if code == _CODE_FOLDER_FILE:
+            _code, index, total, size, hash_type = _FOLDER_FILE.unpack_from(data)
+            reader.pos = _FOLDER_FILE.size
+            if hash_type == _HASH_HEX:
+                file_hash = reader.raw().hex()
+            elif hash_type == _HASH_TEXT:
+                file_hash = reader.str()
+            else:
+                file_hash = ""
+            return {
+                "type": MSG_TYPE_FOLDER_FILE,
+                "index": index,
+                "total": total,
+                "size": size,
+                "hash": file_hash,
+                "rel_path": self._get_path(reader)
+            }
+
+        if code == _CODE_FOLDER_END:
+            total_sent = reader.varint()
+            total_failed = reader.varint()
+            return {
+                "type": MSG_TYPE_FOLDER_END,
+                "total_sent": total_sent,
+                "total_failed": total_failed,
+                "folder_name": reader.str()
+            }
+
+        if code == _CODE_TEXT:
+            return {"type": MSG_TYPE_TEXT, "length": reader.varint()}
+
+        if code == _CODE_FILE:
+            filesize = reader.varint()
+            header = {"type": MSG_TYPE_FILE, "filesize": filesize, "filename": reader.str()}
+            compression = reader.str()
+            if compression:
+                header["compression"] = compression
+            return header
+
+        return json.loads(reader.rest().decode('utf-8'))
+
+    # ---------- 標頭與回應 ----------
+
+    def send_header(self, sock: socket.socket, header: dict):
+        data = self.encode_message(header)
+        if len(data) < _LEN_ESCAPE:
+            prefix = _LEN16.pack(len(data))
+        else:
+            prefix = _LEN16.pack(_LEN_ESCAPE) + _LEN32.pack(len(data))
+        sock.sendall(prefix + data)
+
+    def recv_header(self, sock: socket.socket) -> Optional[dict]:
+        length_data = recv_exact(sock, _LEN16.size)
+        if not length_data:
+            return None
+        length = _LEN16.unpack(length_data)[0]
+        if length == _LEN_ESCAPE:
+            length_data = recv_exact(sock, _LEN32.size)
+            if not length_data:
+                return None
+            length = _LEN32.unpack(length_data)[0]
+        data = recv_exact(sock, length, HEADER_MAX_SIZE)
+        if not data:
+            return None
+        return self.decode_message(data)
+
+    def send_response(self, sock: socket.socket, response: str):
+        code = _RESP_CODES[response.rstrip('_')]
+        sock.sendall(bytes((code,)))
+
+    def recv_response(self, sock: socket.socket) -> str:
+        try:
+            data = recv_exact(sock, 1)
+            if data:
+                return _RESP_NAMES.get(data[0], "")
+            return ""
+        except:
+            return ""
@@ -0,0 +1,342 @@
+"""
+程序層級的傳輸資源
+記憶體預算 (以字節計數的號誌)、可重複使用的緩衝區池、共用執行緒池
+大量同時傳輸時新傳輸會排隊等待預算，而不是讓記憶體用量無上限成長
+多個發送端同時傳輸時，磁碟寫入名額與寫入池工作依發送端公平分配
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    TRANSFER_MEMORY_BUDGET, BUFFER_POOL_IDLE_MAX,
+    RECV_CHUNK_SIZE, FOLDER_WRITER_THREADS,
+    IO_SCHED_SLOTS, IO_SCHED_SMALL_TRANSFER, IO_SCHED_SMALL_WEIGHT
+)
+
+
+class MemoryBudget:
+    """
+    以字節計數的號誌
+    單一請求超過上限時，只要目前沒有其他使用者即放行 (避免永久等待)
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waits = 0          # 需要排隊的請求數
+        self.rejected = 0       # 等待逾時的請求數
+        self._cond = threading.Condition()
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.used + nbytes <= self.limit or self.used == 0
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None) -> bool:
+        """取得 nbytes 預算，逾時返回 False"""
+        with self._cond:
+            if not self._fits(nbytes):
+                self.waits += 1
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._fits(nbytes):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int, timeout: Optional[float] = None):
+        """
+        with budget.reserve(n) as ok: 在區塊內持有 n bytes 預算
+        ok 為 False 表示等待逾時 (未取得預算，離開時也不歸還)
+        """
+        ok = self.acquire(nbytes, timeout)
+        try:
+            yield ok
+        finally:
+            if ok:
+                self.release(nbytes)
+
+
+class BufferPool:
+    """
+    依大小分類的緩衝區池 (slab)
+    使用中的緩衝區由呼叫者先向 MemoryBudget 取得預算；
+    歸還後的閒置緩衝區最多保留 idle_max bytes 供下次重複使用，超過的交給 GC
+    """
+
+    def __init__(self, idle_max: int = BUFFER_POOL_IDLE_MAX):
+        self.idle_max = idle_max
+        self.idle_bytes = 0
+        self.allocated = 0      # 累計新配置次數
+        self.reused = 0         # 累計重複使用次數
+        self._free: Dict[int, List[bytearray]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                self.idle_bytes -= size
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buf: bytearray):
+        size = len(buf)
+        with self._lock:
+            if self.idle_bytes + size > self.idle_max:
+                return
+            self._free.setdefault(size, []).append(buf)
+            self.idle_bytes += size
+
+    def trim(self):
+        """丟棄所有閒置緩衝區"""
+        with self._lock:
+            self._free.clear()
+            self.idle_bytes = 0
+
+
+class IOFlow:
+    """
+    一次傳輸在 I/O 排程器中的身分 (由 IOScheduler.open_flow 建立，結束時 close)
+    同一發送端的傳輸共用一個佇列，小型傳輸另有一個權重較高的佇列
+    """
+    __slots__ = ("scheduler", "key", "weight", "waited")
+
+    def __init__(self, scheduler: "IOScheduler", key: Tuple[str, bool], weight: float):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+        self.waited = 0.0       # 排隊等待寫入名額的累計秒數
+
+    @contextmanager
+    def io(self, nbytes: int):
+        """with flow.io(n): 在區塊內持有一個磁碟寫入名額 (n 為這次寫入的字節數)"""
+        self.scheduler._acquire(self, nbytes)
+        try:
+            yield
+        finally:
+            self.scheduler._release()
+
+    def close(self):
+        self.scheduler._close(self)
+
+
+class IOScheduler:
+    """
+    接收端磁碟寫入排程 (start-time fair queuing)
+    最多 slots 個寫入同時進行；名額用完時，等待中的寫入依虛擬開始時間取得名額
+    每個佇列的虛擬時間以「寫入量 / 權重」前進，各佇列取得的寫入頻寬因此與權重成正比:
+    單一發送端開再多並行連接也只是在自己的佇列裡排隊，小型傳輸以較高權重先完成
+    """
+
+    def __init__(self, slots: int = IO_SCHED_SLOTS):
+        self.slots = max(1, slots)
+        self.active = 0
+        self.waits = 0                              # 需要排隊的寫入數
+        self._vtime = 0.0
+        self._finish: Dict[Tuple[str, bool], float] = {}   # 各佇列最後一次寫入的虛擬結束時間
+        self._flows: Dict[Tuple[str, bool], int] = {}      # 各佇列開啟中的傳輸數
+        self._weights: Dict[str, float] = {}               # 發送端的權重倍數
+        self._waiting = []                                 # heap: (虛擬開始時間, 序號, Event)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def set_weight(self, sender: str, weight: float):
+        """設定發送端的優先權 (權重倍數，預設 1)，之後開啟的傳輸生效"""
+        with self._lock:
+            self._weights[sender] = max(0.01, weight)
+
+    @property
+    def open_flows(self) -> int:
+        """開啟中的傳輸數 (即進行中的接收數)"""
+        with self._lock:
+            return sum(self._flows.values())
+
+    def open_flow(self, sender: str, total_size: int) -> IOFlow:
+        """登記一次來自 sender、總大小 total_size 的傳輸"""
+        small = total_size <= IO_SCHED_SMALL_TRANSFER
+        key = (sender, small)
+        with self._lock:
+            weight = (IO_SCHED_SMALL_WEIGHT if small else 1) * self._weights.get(sender, 1)
+            self._flows[key] = self._flows.get(key, 0) + 1
+        return IOFlow(self, key, weight)
+
+    def _close(self, flow: IOFlow):
+        with self._lock:
+            remaining = self._flows.get(flow.key, 0) - 1
+            if remaining > 0:
+                self._flows[flow.key] = remaining
+            else:
+                # 佇列已無傳輸: 之後再來的傳輸從目前虛擬時間開始，不累積閒置期間的額度
+                self._flows.pop(flow.key, None)
+                self._finish.pop(flow.key, None)
+
+    def _acquire(self, flow: IOFlow, nbytes: int):
+        with self._lock:
+            start = max(self._vtime, self._finish.get(flow.key, 0.0))
+            self._finish[flow.key] = start + max(1, nbytes) / flow.weight
+            if self.active < self.slots and not self._waiting:
+                self.active += 1
+                self._vtime = max(self._vtime, start)
+                return
+            event = threading.Event()
+            self._seq += 1
+            heapq.heappush(self._waiting, (start, self._seq, event))
+            self.waits += 1
+
+        begin = time.perf_counter()
+        event.wait()
+        flow.waited += time.perf_counter() - begin
+
+    def _release(self):
+        with self._lock:
+            if self._waiting:
+                # 名額直接轉交給虛擬開始時間最早的等待者
+                start, _, event = heapq.heappop(self._waiting)
+                self._vtime = max(self._vtime, start)
+                event.set()
+            else:
+                self.active -= 1
+
+
+class FairExecutor:
+    """
+    依鍵輪流取出工作的執行緒池
+    ThreadPoolExecutor 依提交順序執行，一個發送端湧入的大量小檔案會讓其他發送端排在後面；
+    這裡每個鍵 (IOFlow.key) 一個佇列，工作者輪流從各佇列取出工作，執行緒依需要才建立
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self.max_workers = max(1, max_workers)
+        self.name = name
+        self._queues: "OrderedDict[object, deque]" = OrderedDict()
+        self._threads: List[threading.Thread] = []
+        self._idle = 0
+        self._cond = threading.Condition()
+
+    def submit(self, key, fn, *args) -> Future:
+        future = Future()
+        with self._cond:
+            self._queues.setdefault(key, deque()).append((future, fn, args))
+            if self._idle == 0 and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"pcpcs-{self.name}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._cond.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                # 取出第一個佇列的工作後把該佇列移到最後 (輪到下一個鍵)
+                key, queue = self._queues.popitem(last=False)
+                future, fn, args = queue.popleft()
+                if queue:
+                    self._queues[key] = queue
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+# ==================== 程序層級單例 ====================
+
+_lock = threading.Lock()
+_budget: Optional[MemoryBudget] = None
+_pool: Optional[BufferPool] = None
+_scheduler: Optional[IOScheduler] = None
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_fair_executors: Dict[str, FairExecutor] = {}
+
+# 共用執行緒池的大小
+# 並行分塊工作者會阻塞在 accept / recv 上，數量須足以容納預算內所有已准入傳輸的分塊，
+# 否則已准入的分塊會排在其他傳輸後面而逾時
+_EXECUTOR_SIZES = {
+    "chunk": max(1, TRANSFER_MEMORY_BUDGET // RECV_CHUNK_SIZE),
+}
+_FAIR_EXECUTOR_SIZES = {
+    "writer": FOLDER_WRITER_THREADS,
+}
+
+
+def get_memory_budget() -> MemoryBudget:
+    global _budget
+    with _lock:
+        if _budget is None:
+            _budget = MemoryBudget(TRANSFER_MEMORY_BUDGET)
+        return _budget
+
+
+def set_memory_budget(limit: int):
+    """重設程序共用的記憶體預算上限 (多程序接收時每個工作程序分得一份)，須在傳輸開始前呼叫"""
+    global _budget
+    with _lock:
+        _budget = MemoryBudget(limit)
+
+
+def get_buffer_pool() -> BufferPool:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = BufferPool()
+        return _pool
+
+
+def get_io_scheduler() -> IOScheduler:
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = IOScheduler()
+        return _scheduler
+
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """取得共用執行緒池 ("chunk": 並行分塊接收)，執行緒依需要才建立"""
+    with _lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=_EXECUTOR_SIZES[name],
+                                          thread_name_prefix=f"pcpcs-{name}")
+            _executors[name] = executor
+        return executor
+
+
+def get_fair_executor(name: str) -> FairExecutor:
+    """取得共用的公平執行緒池 ("writer": 資料夾小檔案寫入，依傳輸輪流執行)"""
+    with _lock:
+        executor = _fair_executors.get(name)
+        if executor is None:
+            executor = FairExecutor(_FAIR_EXECUTOR_SIZES[name], name)
+            _fair_executors[name] = executor
+        return executor
@@ -5,26 +5,52 @@ TCP 接收伺服器
 import socket
 import json
 import threading
+import time
 import os
-from typing import Callable, Optional
+import zlib
+from functools import partial
+from typing import Callable, Dict, Optional
 
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.config import (
-    TRANSFER_PORT, BUFFER_SIZE, FILE_CHUNK_SIZE, RECEIVE_DIR,
+    TRANSFER_PORT, RECEIVE_DIR,
     MSG_TYPE_TEXT, MSG_TYPE_FILE, MSG_TYPE_FILE_CHUNK, MSG_TYPE_FILE_END,
     MSG_TYPE_FOLDER_START, MSG_TYPE_FOLDER_FILE, MSG_TYPE_FOLDER_END,
     MSG_TYPE_PARALLEL_FILE, MSG_TYPE_PARALLEL_CHUNK, MSG_TYPE_PARALLEL_DONE,
+    MSG_TYPE_SESSION, SESSION_FRAME_SIZE, SESSION_WINDOW_SIZE, SESSION_IDLE_TIMEOUT,
     RESP_ACK, RESP_SKIP, RESP_ERROR, RESP_LENGTH,
+    RESP_ACK_STRIPPED, RESP_ERROR_STRIPPED, WIRE_VERSION_JSON,
     SOCKET_SEND_BUFFER, SOCKET_RECV_BUFFER,
-    PARALLEL_CONNECTIONS, PARALLEL_PORT_START
+    PARALLEL_CONNECTIONS, PARALLEL_PORT_START,
+    FOLDER_SMALL_FILE_SIZE, FOLDER_WRITE_BUFFER, DURABILITY_MODE,
+    RECV_CHUNK_SIZE, ADMISSION_TIMEOUT,
+    SERVER_MAX_CONNECTIONS, SERVER_MAX_PER_PEER, SERVER_BACKLOG, SERVER_BACKLOG_MAX,
+    HEADER_TIMEOUT, HEADER_MAX_SIZE, TEXT_MAX_SIZE, DATA_TIMEOUT, REAPER_INTERVAL, SERVER_PROCESSES
 )
-
-# 高速接收緩衝區大小 (256KB - 減少系統調用次數)
-RECV_CHUNK_SIZE = 262144
-from concurrent.futures import ThreadPoolExecutor
-import hashlib
+from network.protocol import (
+    recv_exact, choose_wire_version, wire_response, create_codec
+)
+from network.capabilities import local_capabilities, new_hash, HASH_FACTORIES
+from network.session import (
+    recv_frame, send_frame, WINDOW_UPDATE,
+    FRAME_OPEN, FRAME_DATA, FRAME_END, FRAME_ACK, FRAME_WINDOW,
+    FRAME_PING, FRAME_PONG, FRAME_CLOSE, FRAME_HELLO
+)
+from utils.fileio import (
+    CacheAdvisor, ensure_free_space, free_space, preallocate, open_for_write, write_at,
+    GroupCommitter, RangeSync, durability_level, DURABILITY_SESSION, DURABILITY_FILE, DURABILITY_RANGE
+)
+from network.pipeline import ReceivePipeline, PipelineStats
+from network.resources import (
+    MemoryBudget, get_memory_budget, get_buffer_pool, get_executor, get_fair_executor, get_io_scheduler
+)
+from network.shards import ShardedReceiver, HAS_REUSEPORT
+from network.offload import get_offload
+from network.progress import ProgressTracker, RateLimit
+from network.multipath import StripeReceipt
+from concurrent.futures import wait as wait_futures
 
 
 def optimize_socket(sock: socket.socket):
@@ -36,6 +62,27 @@ def optimize_socket(sock: socket.socket):
     sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
+def _system_backlog_limit() -> int:
+    """系統允許的最大 listen backlog (Linux somaxconn)，超過的值會被核心截斷"""
+    try:
+        with open('/proc/sys/net/core/somaxconn') as f:
+            return max(1, int(f.read().strip()))
+    except (OSError, ValueError):
+        return SERVER_BACKLOG_MAX
+
+
+class _Connection:
+    """伺服器追蹤中的連接 (准入計數與閒置回收)"""
+    __slots__ = ("sock", "peer", "phase", "deadline", "since")
+
+    def __init__(self, sock: socket.socket, peer: str):
+        self.sock = sock
+        self.peer = peer
+        self.phase = "header"
+        self.since = time.time()
+        self.deadline: Optional[float] = self.since + HEADER_TIMEOUT  # 超過即由回收執行緒關閉
+
+
 class TransferServer:
     """傳輸接收伺服器"""
 
@@ -46,7 +93,9 @@ class TransferServer:
                  on_progress: Optional[Callable] = None,
                  on_folder_progress: Optional[Callable] = None,
                  on_status: Optional[Callable] = None,
-                 on_transfer_start: Optional[Callable] = None):
+                 on_transfer_start: Optional[Callable] = None,
+                 processes: int = SERVER_PROCESSES,
+                 reuse_port: bool = False):
         self.on_text_received = on_text_received
         self.on_file_received = on_file_received
         self.on_folder_received = on_folder_received  # (sender_ip, sender_name, folder_path, total_files, total_size)
@@ -57,20 +106,63 @@ class TransferServer:
 
         self.running = False
         self.server_socket: Optional[socket.socket] = None
-        self._server_thread: Optional[threading.Thread] = None
 
-        # 確保接收目錄存在
-        os.makedirs(RECEIVE_DIR, exist_ok=True)
+        # 多程序接收: processes > 1 時由工作程序接收，本程序只轉送回呼
+        # reuse_port 為工作程序自身的設定 (與其他工作程序共用監聽端口)
+        self.processes = processes
+        self.reuse_port = reuse_port
+        self._shards: Optional[ShardedReceiver] = None
+
+        # 接收管線累計等待統計 (判斷瓶頸在網路或磁碟)
+        self.pipeline_stats = PipelineStats()
+        self._stats_lock = threading.Lock()
+
+        # 持久性模式 (none / session / file / range) 與共用的批次 fsync
+        self.durability = DURABILITY_MODE
+        self._committer = GroupCommitter()
+
+        # 連接管理: 目前連接、各對端連接數與統計計數
+        self.counters = {
+            "accepted": 0,          # 已准入並送出標頭的連接
+            "probes": 0,            # 未送出標頭即關閉的連接 (TCP 延遲量測、網段掃描)
+            "rejected_global": 0,   # 超過全域上限而拒絕
+            "rejected_peer": 0,     # 超過單一對端上限而拒絕
+            "rejected_header": 0,   # 標頭過大而拒絕
+            "timeouts": 0,          # 傳輸中超過 DATA_TIMEOUT 未收到資料
+            "reaped": 0,            # 超過階段期限被回收 (例如慢速標頭)
+            "session_idle": 0,      # 會話閒置關閉
+            "peak": 0,              # 同時連接數峰值
+            "backlog": 0,           # 目前 listen backlog
+            "backlog_grows": 0,     # backlog 因連接突增而倍增的次數
+        }
+        self._connections = set()
+        self._peer_connections: Dict[str, int] = {}
+        self._conn_lock = threading.Lock()
+        self._server_thread: Optional[threading.Thread] = None
+        self._reaper_thread: Optional[threading.Thread] = None
 
     def start(self):
-        """啟動伺服器"""
+        """啟動伺服器 (建構時不存取檔案系統，接收目錄在此建立)"""
+        os.makedirs(RECEIVE_DIR, exist_ok=True)
         self.running = True
+        if self.processes > 1:
+            if HAS_REUSEPORT:
+                self._shards = ShardedReceiver(self, self.processes)
+                self._shards.start(RECEIVE_DIR)
+                self._log(f"多程序接收: {self.processes} 個工作程序共用端口 {TRANSFER_PORT}")
+                return
+            self._log("此平台的 SO_REUSEPORT 不分散連接，改用單一程序接收")
         self._server_thread = threading.Thread(target=self._server_loop, daemon=True)
         self._server_thread.start()
+        self._reaper_thread = threading.Thread(target=self._reaper_loop, daemon=True)
+        self._reaper_thread.start()
 
     def stop(self):
         """停止伺服器"""
         self.running = False
+        if self._shards:
+            self._shards.stop()
+            self._shards = None
         if self.server_socket:
             try:
                 self.server_socket.close()
@@ -88,23 +180,56 @@ class TransferServer:
         """伺服器主循環"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # backlog 從 SERVER_BACKLOG 開始，連接突增時倍增 (不超過系統上限)
+        backlog_limit = min(SERVER_BACKLOG_MAX, _system_backlog_limit())
+        backlog = min(SERVER_BACKLOG, backlog_limit)
+        burst_start = time.time()
+        burst_count = 0
 
         try:
             self.server_socket.bind(('', TRANSFER_PORT))
-            self.server_socket.listen(5)
+            self.server_socket.listen(backlog)
             self.server_socket.settimeout(1)
+            self.counters["backlog"] = backlog
             self._log(f"傳輸伺服器已啟動，監聽端口 {TRANSFER_PORT}")
 
             while self.running:
                 try:
                     client_socket, addr = self.server_socket.accept()
+
+                    # 一秒內的連接數達 backlog 一半時加大 backlog (Linux 可對監聽中的 socket 再次 listen)
+                    now = time.time()
+                    if now - burst_start >= 1:
+                        burst_start = now
+                        burst_count = 0
+                    burst_count += 1
+                    if burst_count >= backlog // 2 and backlog < backlog_limit:
+                        backlog = min(backlog * 2, backlog_limit)
+                        self.server_socket.listen(backlog)
+                        with self._conn_lock:
+                            self.counters["backlog"] = backlog
+                            self.counters["backlog_grows"] += 1
+
+                    conn = self._register(client_socket, addr[0])
+                    if conn is None:
+                        # 先回覆錯誤再關閉，讓發送端分辨「忙碌」與「舊版伺服器」(後者不回覆直接關閉)
+                        try:
+                            client_socket.send(RESP_ERROR.encode())
+                        except OSError:
+                            pass
+                        client_socket.close()
+                        continue
+
                     optimize_socket(client_socket)  # 優化接收端 socket
-                    self._log(f"接受來自 {addr[0]} 的連接")
+                    client_socket.settimeout(HEADER_TIMEOUT)
 
                     # 為每個客戶端創建新線程
                     client_thread = threading.Thread(
                         target=self._handle_client,
-                        args=(client_socket, addr[0]),
+                        args=(conn, client_socket, addr[0]),
                         daemon=True
                     )
                     client_thread.start()
@@ -121,15 +246,94 @@ class TransferServer:
             if self.server_socket:
                 self.server_socket.close()
 
-    def _handle_client(self, client_socket: socket.socket, client_ip: str):
+    # ==================== 連接管理 ====================
+
+    def get_counters(self) -> dict:
+        """連接管理統計 (含目前連接數、各對端連接數與進行中的接收數；多程序接收時為各工作程序的合計)"""
+        if self._shards:
+            return self._shards.counters()
+        with self._conn_lock:
+            counters = dict(self.counters)
+            counters["active"] = len(self._connections)
+            counters["per_peer"] = dict(self._peer_connections)
+        counters["transfers"] = get_io_scheduler().open_flows
+        return counters
+
+    def capacity(self) -> dict:
+        """發現訊息公告的容量: 接收目錄剩餘空間 (無法查詢時為 None) 與進行中的接收數"""
+        return {"free": free_space(RECEIVE_DIR), "transfers": self.get_counters().get("transfers", 0)}
+
+    def _count(self, name: str):
+        with self._conn_lock:
+            self.counters[name] += 1
+
+    def _register(self, sock: socket.socket, peer: str) -> Optional[_Connection]:
+        """准入新連接，超過全域或單一對端上限時返回 None"""
+        with self._conn_lock:
+            if len(self._connections) >= SERVER_MAX_CONNECTIONS:
+                self.counters["rejected_global"] += 1
+                reason = "全域連接數已達上限"
+            elif self._peer_connections.get(peer, 0) >= SERVER_MAX_PER_PEER:
+                self.counters["rejected_peer"] += 1
+                reason = "該對端連接數已達上限"
+            else:
+                conn = _Connection(sock, peer)
+                self._connections.add(conn)
+                self._peer_connections[peer] = self._peer_connections.get(peer, 0) + 1
+                self.counters["peak"] = max(self.counters["peak"], len(self._connections))
+                return conn
+        self._log(f"拒絕來自 {peer} 的連接: {reason}")
+        return None
+
+    def _unregister(self, conn: _Connection):
+        with self._conn_lock:
+            self._connections.discard(conn)
+            count = self._peer_connections.get(conn.peer, 0) - 1
+            if count > 0:
+                self._peer_connections[conn.peer] = count
+            else:
+                self._peer_connections.pop(conn.peer, None)
+
+    def _set_phase(self, conn: _Connection, phase: str, timeout: float):
+        """進入新階段: 取消階段期限，改以 socket 超時限制兩次收到資料的間隔"""
+        conn.phase = phase
+        conn.deadline = None
+        conn.sock.settimeout(timeout)
+
+    def _reaper_loop(self):
+        """閒置回收: 關閉超過階段期限的連接 (socket 超時只能發現完全沒有資料的情況)"""
+        while self.running:
+            time.sleep(REAPER_INTERVAL)
+            now = time.time()
+            with self._conn_lock:
+                expired = [c for c in self._connections if c.deadline is not None and now > c.deadline]
+            for conn in expired:
+                conn.deadline = None
+                try:
+                    # shutdown 會讓阻塞中的 recv 立即返回
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._count("reaped")
+                self._log(f"回收逾時連接: {conn.peer} ({conn.phase}, {now - conn.since:.0f}s)")
+
+    def _handle_client(self, conn: _Connection, client_socket: socket.socket, client_ip: str):
         """處理客戶端連接"""
         try:
-            # 接收標頭
+            # 接收標頭 (HEADER_TIMEOUT 內必須送完)
             header_data = self._recv_exact(client_socket, 4)
             if not header_data:
+                # 延遲量測與網段掃描只連上就關閉: 不記錄日誌 (每個量測週期都會發生)
+                self._count("probes")
                 return
+            self._count("accepted")
+            self._log(f"接受來自 {client_ip} 的連接")
 
             header_length = int.from_bytes(header_data, 'big')
+            if header_length > HEADER_MAX_SIZE:
+                self._count("rejected_header")
+                self._log(f"拒絕來自 {client_ip} 的連接: 標頭過大 ({header_length} bytes)")
+                return
             header_json = self._recv_exact(client_socket, header_length)
             if not header_json:
                 return
@@ -137,33 +341,63 @@ class TransferServer:
             header = json.loads(header_json.decode('utf-8'))
             msg_type = header.get("type")
 
+            # 進入傳輸階段 (會話允許較長的閒置)
+            if msg_type == MSG_TYPE_SESSION:
+                self._set_phase(conn, "session", SESSION_IDLE_TIMEOUT)
+            else:
+                self._set_phase(conn, "transfer", DATA_TIMEOUT)
+
             if msg_type == MSG_TYPE_TEXT:
                 self._handle_text(client_socket, header, client_ip)
                 client_socket.send(b"OK")
             elif msg_type == MSG_TYPE_FILE:
-                self._handle_file(client_socket, header, client_ip)
-                client_socket.send(b"OK")
+                # 失敗時回應 ERROR (舊版客戶端只認 b"OK" 為成功)
+                if self._handle_file(client_socket, header, client_ip):
+                    client_socket.send(b"OK")
+                else:
+                    client_socket.send(RESP_ERROR.encode('utf-8'))
             elif msg_type == MSG_TYPE_PARALLEL_FILE:
                 self._handle_parallel_file(client_socket, header, client_ip)
                 # parallel handler sends its own responses
             elif msg_type == MSG_TYPE_FOLDER_START:
                 self._handle_folder(client_socket, header, client_ip)
                 # folder handler sends its own responses
+            elif msg_type == MSG_TYPE_SESSION:
+                self._handle_session(client_socket, header, client_ip)
+                # session handler sends its own responses
 
+        except socket.timeout:
+            self._count("timeouts")
+            self._log(f"連接逾時: {client_ip} ({conn.phase})")
         except Exception as e:
             self._log(f"處理客戶端錯誤: {e}")
         finally:
             client_socket.close()
+            self._unregister(conn)
+
+    def _recv_exact(self, sock: socket.socket, size: int, limit: Optional[int] = None) -> Optional[bytearray]:
+        """精確接收指定大小的數據 (預先分配一次，避免逐塊串接；size 來自對端時以 limit 限制)"""
+        return recv_exact(sock, size, limit)
+
+    def _admit(self, nbytes: int, what: str) -> bool:
+        """向程序共用的記憶體預算申請 nbytes，不足時排隊最多 ADMISSION_TIMEOUT 秒"""
+        if get_memory_budget().acquire(nbytes, ADMISSION_TIMEOUT):
+            return True
+        self._log(f"記憶體預算不足，拒絕接收: {what}")
+        return False
+
+    def _release(self, nbytes: int):
+        get_memory_budget().release(nbytes)
 
-    def _recv_exact(self, sock: socket.socket, size: int) -> Optional[bytes]:
-        """精確接收指定大小的數據"""
-        data = b''
-        while len(data) < size:
-            chunk = sock.recv(min(size - len(data), BUFFER_SIZE))
-            if not chunk:
-                return None
-            data += chunk
-        return data
+    def _unique_filepath(self, safe_filename: str) -> str:
+        """取得接收目錄中不重複的檔案路徑 (已存在時添加編號)"""
+        filepath = os.path.join(RECEIVE_DIR, safe_filename)
+        base, ext = os.path.splitext(safe_filename)
+        counter = 1
+        while os.path.exists(filepath):
+            filepath = os.path.join(RECEIVE_DIR, f"{base}_{counter}{ext}")
+            counter += 1
+        return filepath
 
     def _handle_text(self, sock: socket.socket, header: dict, sender_ip: str):
         """處理文字訊息"""
@@ -171,7 +405,7 @@ class TransferServer:
         sender_name = header.get("sender", sender_ip)
         sender_platform = header.get("platform", "Unknown")
 
-        text_data = self._recv_exact(sock, text_length)
+        text_data = self._recv_exact(sock, text_length, TEXT_MAX_SIZE)
         if text_data:
             text = text_data.decode('utf-8')
             self._log(f"收到來自 {sender_name} 的文字訊息")
@@ -179,8 +413,8 @@ class TransferServer:
             if self.on_text_received:
                 self.on_text_received(sender_ip, sender_name, text, sender_platform)
 
-    def _handle_file(self, sock: socket.socket, header: dict, sender_ip: str):
-        """處理檔案傳輸"""
+    def _handle_file(self, sock: socket.socket, header: dict, sender_ip: str) -> bool:
+        """處理檔案傳輸，返回是否接收成功 (由呼叫者回應發送端)"""
         filename = header.get("filename", "unknown_file")
         filesize = header.get("filesize", 0)
         sender_name = header.get("sender", sender_ip)
@@ -188,14 +422,19 @@ class TransferServer:
 
         # 安全處理檔名，避免路徑穿越攻擊
         safe_filename = os.path.basename(filename)
-        filepath = os.path.join(RECEIVE_DIR, safe_filename)
+        filepath = self._unique_filepath(safe_filename)
 
-        # 如果檔案已存在，添加編號
-        base, ext = os.path.splitext(safe_filename)
-        counter = 1
-        while os.path.exists(filepath):
-            filepath = os.path.join(RECEIVE_DIR, f"{base}_{counter}{ext}")
-            counter += 1
+        # 空間不足時在排隊與讀取任何數據前回應錯誤
+        try:
+            ensure_free_space(RECEIVE_DIR, filesize)
+        except OSError as e:
+            self._log(f"檔案接收失敗: {e}")
+            return False
+
+        # 預算不足時排隊 (發送端的數據暫時留在 TCP 緩衝區)
+        memory = ReceivePipeline.memory_size()
+        if not self._admit(memory, safe_filename):
+            return False
 
         self._log(f"開始接收檔案: {safe_filename} ({filesize} bytes)")
 
@@ -204,32 +443,69 @@ class TransferServer:
             self.on_transfer_start(filesize)
 
         received = 0
+        flow = get_io_scheduler().open_flow(sender_ip, filesize)
         try:
-            with open(filepath, 'wb') as f:
-                while received < filesize:
-                    chunk_size = min(FILE_CHUNK_SIZE, filesize - received)
-                    chunk = self._recv_exact(sock, chunk_size)
-                    if not chunk:
-                        raise Exception("連接中斷")
+            def on_received(done, total, speed, remaining):
+                # 更新進度
+                if self.on_progress:
+                    progress = (done / total) * 100 if total > 0 else 100
+                    self.on_progress(progress, f"接收中: {safe_filename}")
+            tracker = ProgressTracker(filesize, on_received)
 
-                    f.write(chunk)
-                    received += len(chunk)
+            with open(filepath, 'wb') as f:
+                preallocate(f.fileno(), filesize)
+                cache = CacheAdvisor(f.fileno(), 0, filesize, 'write')
+                pipeline = ReceivePipeline()
+                try:
+                    pipeline.receive(sock, f.fileno(), 0, filesize, partial(tracker.set, 0), cache,
+                                     self._range_sync(f.fileno()), flow)
+                finally:
+                    pipeline.close()
+                    self._record_pipeline(pipeline)
+                cache.finish()
+            tracker.finish()
 
-                    # 更新進度
-                    if self.on_progress:
-                        progress = (received / filesize) * 100
-                        self.on_progress(progress, f"接收中: {safe_filename}")
+            self._make_durable([filepath])
 
             self._log(f"檔案接收完成: {filepath}")
 
             if self.on_file_received:
                 self.on_file_received(sender_ip, sender_name, filepath, filesize, sender_platform)
+            return True
 
         except Exception as e:
+            # 含落盤失敗 (數據已收齊但未能同步到磁碟)，發送端不可視為已送達
             self._log(f"檔案接收失敗: {e}")
+            if isinstance(e, socket.timeout):
+                self._count("timeouts")
             # 刪除不完整的檔案
             if os.path.exists(filepath):
                 os.remove(filepath)
+            return False
+        finally:
+            flow.close()
+            self._release(memory)
+
+    def _durability_at_least(self, mode: str) -> bool:
+        return durability_level(self.durability) >= durability_level(mode)
+
+    def _range_sync(self, fd: int):
+        """range 模式下的區段同步器 (其他模式返回 None)"""
+        if self._durability_at_least(DURABILITY_RANGE):
+            return RangeSync(fd)
+        return None
+
+    def _make_durable(self, paths, dirs=()):
+        """session 以上模式: 以 group commit 將檔案與目錄落盤 (失敗時拋出 OSError)"""
+        if self._durability_at_least(DURABILITY_SESSION):
+            self._committer.sync(paths, dirs)
+
+    def _record_pipeline(self, pipeline: ReceivePipeline):
+        """累計接收管線統計並記錄本次的瓶頸"""
+        with self._stats_lock:
+            self.pipeline_stats.merge(pipeline.stats)
+        if pipeline.stats.buffers:
+            self._log(f"接收管線: {pipeline.stats.summary()}")
 
     def _recv_response_stripped(self, sock: socket.socket) -> str:
         """接收固定長度回應並去除填充"""
@@ -241,29 +517,63 @@ class TransferServer:
         except:
             return ""
 
-    def _handle_parallel_chunk_worker(self, port: int, filepath: str,
-                                      chunk_info: dict, progress_dict: dict,
-                                      lock: threading.Lock) -> bool:
+    def _create_chunk_listener(self, port: int) -> socket.socket:
+        """建立並行分塊的監聽 socket"""
+        chunk_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        chunk_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        optimize_socket(chunk_sock)
+        try:
+            chunk_sock.bind(('', port))
+            chunk_sock.listen(1)
+        except OSError:
+            chunk_sock.close()
+            raise
+        chunk_sock.settimeout(30)
+        return chunk_sock
+
+    def _receive_range(self, conn: socket.socket, view: memoryview, fd: int, filesize: int,
+                       offset: int, size: int, on_received: Callable,
+                       sync: Optional[RangeSync] = None, flow=None):
+        """
+        以 recv_into 零拷貝接收 [offset, offset + size) 並依偏移量寫入共用 fd
+        on_received(累計字節數) 於每次寫入後呼叫
+        """
+        received = 0
+        cache = CacheAdvisor(fd, offset, size, 'write', filesize=filesize)
+        while received < size:
+            # 使用 recv_into 直接寫入緩衝區，避免記憶體分配
+            bytes_read = conn.recv_into(view[:min(len(view), size - received)])
+            if bytes_read == 0:
+                raise Exception("連接中斷")
+            # 依偏移量直接寫入共用 fd (不需重新開檔或 seek)；
+            # 所有分塊共用一個排程佇列，分塊再多也不會多佔其他發送端的寫入名額
+            with flow.io(bytes_read):
+                write_at(fd, view[:bytes_read], offset + received)
+            received += bytes_read
+            if sync:
+                sync.add(bytes_read)
+            cache.advance(received)
+            on_received(received)
+        cache.finish()
+
+    def _handle_parallel_chunk_worker(self, chunk_sock: socket.socket, fd: int, filesize: int,
+                                      chunk_info: dict, tracker: ProgressTracker,
+                                      sync: Optional[RangeSync] = None, flow=None) -> bool:
         """
         處理單個並行分塊的接收 (優化版 - 使用 recv_into 零拷貝)
+        chunk_sock 為已綁定的監聽 socket，fd 為所有工作者共用的已預留空間檔案
+        sync 為 range 模式下所有工作者共用的區段同步器，flow 為整個檔案共用的 I/O 排程身分
         """
         chunk_id = chunk_info["chunk_id"]
         expected_offset = chunk_info["offset"]
         expected_size = chunk_info["size"]
+        buf = None
 
         try:
-            # 創建監聽 socket
-            chunk_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            chunk_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            optimize_socket(chunk_sock)
-            chunk_sock.bind(('', port))
-            chunk_sock.listen(1)
-            chunk_sock.settimeout(30)
-
             # 等待連接
             conn, addr = chunk_sock.accept()
             optimize_socket(conn)
-            conn.settimeout(300)
+            conn.settimeout(DATA_TIMEOUT)
 
             # 接收分塊標頭
             header_len_data = self._recv_exact(conn, 4)
@@ -271,7 +581,7 @@ class TransferServer:
                 raise Exception("未收到標頭")
 
             header_length = int.from_bytes(header_len_data, 'big')
-            header_json = self._recv_exact(conn, header_length)
+            header_json = self._recv_exact(conn, header_length, HEADER_MAX_SIZE)
             header = json.loads(header_json.decode('utf-8'))
 
             if header.get("type") != MSG_TYPE_PARALLEL_CHUNK:
@@ -283,37 +593,73 @@ class TransferServer:
             # 發送 ACK
             conn.send(RESP_ACK.encode('utf-8'))
 
-            # 使用 recv_into 零拷貝接收 - 直接寫入預分配的緩衝區
-            received = 0
-            # 使用較大的緩衝區減少系統調用次數
-            buf = bytearray(RECV_CHUNK_SIZE)
-            view = memoryview(buf)
-
-            with open(filepath, 'r+b') as f:
-                f.seek(expected_offset)
-                while received < expected_size:
-                    # 計算這次要接收的大小
-                    to_recv = min(RECV_CHUNK_SIZE, expected_size - received)
-                    # 使用 recv_into 直接寫入緩衝區，避免記憶體分配
-                    bytes_read = conn.recv_into(view[:to_recv])
-                    if bytes_read == 0:
-                        raise Exception("連接中斷")
-                    # 直接寫入檔案
-                    f.write(view[:bytes_read])
-                    received += bytes_read
-
-                    with lock:
-                        progress_dict[chunk_id] = received
+            # 使用較大的緩衝區減少系統調用次數 (取自共用緩衝區池)
+            buf = get_buffer_pool().acquire(RECV_CHUNK_SIZE)
+            self._receive_range(conn, memoryview(buf), fd, filesize, expected_offset, expected_size,
+                                partial(tracker.set, chunk_id), sync, flow)
 
             # 發送完成確認
             conn.send(RESP_ACK.encode('utf-8'))
             conn.close()
-            chunk_sock.close()
             return True
 
         except Exception as e:
             self._log(f"分塊 {chunk_id} 接收失敗: {e}")
             return False
+        finally:
+            chunk_sock.close()
+            if buf is not None:
+                get_buffer_pool().release(buf)
+
+    def _handle_multipath_worker(self, listener: socket.socket, fd: int, filesize: int, stream: int,
+                                 receipt: StripeReceipt, tracker: ProgressTracker,
+                                 sync: Optional[RangeSync] = None, flow=None):
+        """
+        多路徑並行傳輸的單個分塊端口
+        同一端口可被重新連接 (發送端的路徑失敗後改走其他路徑)，每條連接依序接收多個條帶，
+        直到整個檔案完成；連接中斷只丟棄進行中的條帶 (發送端會重送)，不使傳輸失敗
+        """
+        buf = get_buffer_pool().acquire(RECV_CHUNK_SIZE)
+        view = memoryview(buf)
+        base = 0    # 本端口已完成條帶的字節數 (進度)
+
+        def on_received(received):
+            receipt.touch()
+            tracker.set(stream, base + received)
+
+        try:
+            while not receipt.finished:
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    continue
+                optimize_socket(conn)
+                conn.settimeout(DATA_TIMEOUT)
+                try:
+                    while True:
+                        header_len_data = self._recv_exact(conn, 4)
+                        if not header_len_data:
+                            # 發送端已沒有條帶可送
+                            break
+                        header = json.loads(self._recv_exact(conn, int.from_bytes(header_len_data, 'big'),
+                                                             HEADER_MAX_SIZE))
+                        offset, size = header.get("offset"), header.get("size")
+                        if header.get("type") != MSG_TYPE_PARALLEL_CHUNK or not receipt.valid(offset, size):
+                            raise Exception(f"無效的條帶: {offset} + {size}")
+
+                        conn.send(RESP_ACK.encode('utf-8'))
+                        self._receive_range(conn, view, fd, filesize, offset, size, on_received, sync, flow)
+                        receipt.add(offset, size)
+                        base += size
+                        conn.send(RESP_ACK.encode('utf-8'))
+                except Exception as e:
+                    tracker.set(stream, base)
+                    self._log(f"分塊端口 {stream} 的連接中斷 ({addr[0]}): {e}")
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+            get_buffer_pool().release(buf)
 
     def _handle_parallel_file(self, sock: socket.socket, header: dict, sender_ip: str):
         """處理並行檔案傳輸"""
@@ -326,14 +672,13 @@ class TransferServer:
 
         # 安全處理檔名
         safe_filename = os.path.basename(filename)
-        filepath = os.path.join(RECEIVE_DIR, safe_filename)
+        filepath = self._unique_filepath(safe_filename)
 
-        # 如果檔案已存在，添加編號
-        base, ext = os.path.splitext(safe_filename)
-        counter = 1
-        while os.path.exists(filepath):
-            filepath = os.path.join(RECEIVE_DIR, f"{base}_{counter}{ext}")
-            counter += 1
+        # 每個分塊一個接收緩衝區，預算不足時排隊 (逾時則回應 ERROR)
+        memory = max(1, len(chunks)) * RECV_CHUNK_SIZE
+        if not self._admit(memory, safe_filename):
+            sock.send(RESP_ERROR.encode('utf-8'))
+            return
 
         self._log(f"開始並行接收檔案: {safe_filename} ({filesize} bytes, {num_chunks} 連接)")
 
@@ -341,47 +686,76 @@ class TransferServer:
         if self.on_transfer_start:
             self.on_transfer_start(filesize)
 
+        fd = None
+        flow = get_io_scheduler().open_flow(sender_ip, filesize)
         try:
-            # 預先創建檔案並分配空間
-            with open(filepath, 'wb') as f:
-                f.seek(filesize - 1)
-                f.write(b'\0')
+            # 預先創建檔案並預留空間 (空間不足時在發送準備好信號前失敗)
+            ensure_free_space(RECEIVE_DIR, filesize)
+            fd = open_for_write(filepath, filesize)
+
+            # 先綁定所有分塊端口，再發送準備好信號 (避免發送端連接被拒)
+            listeners = []
+            try:
+                for chunk in chunks:
+                    listeners.append(self._create_chunk_listener(chunk["port"]))
+            except OSError:
+                for listener in listeners:
+                    listener.close()
+                raise
 
             # 發送準備好信號
             sock.send(RESP_ACK.encode('utf-8'))
 
-            # 進度追蹤
-            progress_dict = {i: 0 for i in range(num_chunks)}
-            lock = threading.Lock()
-
-            # 啟動並行接收工作者
-            with ThreadPoolExecutor(max_workers=num_chunks) as executor:
-                futures = []
-                for chunk in chunks:
+            # 進度追蹤 (每個分塊一個計數，工作者各自更新)
+            def on_received(done, total, speed, remaining):
+                if self.on_progress:
+                    progress = (done / total) * 100 if total > 0 else 100
+                    self.on_progress(progress, f"接收中: {safe_filename}")
+            tracker = ProgressTracker(filesize, on_received, streams=len(chunks))
+
+            # 啟動並行接收工作者 (程序共用的執行緒池)
+            sync = self._range_sync(fd)
+            executor = get_executor("chunk")
+            futures = []
+            if header.get("multipath"):
+                # 多路徑: 分塊端口不對應固定範圍，條帶全部收齊即完成
+                receipt = StripeReceipt(filesize)
+                for chunk, listener in zip(chunks, listeners):
+                    listener.settimeout(1)
+                    futures.append(executor.submit(
+                        self._handle_multipath_worker, listener, fd, filesize, chunk["chunk_id"],
+                        receipt, tracker, sync, flow))
+                complete = receipt.wait(DATA_TIMEOUT)
+                # 等待工作者結束後才能關閉 fd (可能仍有重送的條帶正在寫入)
+                receipt.stop()
+                wait_futures(futures)
+                if not complete:
+                    raise Exception("部分條帶未收到")
+            else:
+                for chunk, listener in zip(chunks, listeners):
                     future = executor.submit(
                         self._handle_parallel_chunk_worker,
-                        chunk["port"],
-                        filepath,
+                        listener,
+                        fd,
+                        filesize,
                         chunk,
-                        progress_dict,
-                        lock
+                        tracker,
+                        sync,
+                        flow
                     )
                     futures.append(future)
 
-                # 等待所有分塊完成，同時更新進度
-                while not all(f.done() for f in futures):
-                    with lock:
-                        total_received = sum(progress_dict.values())
-                    if self.on_progress:
-                        progress = (total_received / filesize) * 100
-                        self.on_progress(progress, f"接收中: {safe_filename}")
-                    import time
-                    time.sleep(0.1)
-
+                # 等待所有分塊完成 (最後一個分塊完成時立即返回，進度由工作者回報)
+                wait_futures(futures)
                 results = [f.result() for f in futures]
 
-            if not all(results):
-                raise Exception("部分分塊接收失敗")
+                if not all(results):
+                    raise Exception("部分分塊接收失敗")
+            tracker.finish()
+
+            os.close(fd)
+            fd = None
+            self._make_durable([filepath])
 
             # 等待完成信號
             header_len_data = self._recv_exact(sock, 4)
@@ -389,7 +763,7 @@ class TransferServer:
                 raise Exception("未收到完成信號")
 
             header_length = int.from_bytes(header_len_data, 'big')
-            done_json = self._recv_exact(sock, header_length)
+            done_json = self._recv_exact(sock, header_length, HEADER_MAX_SIZE)
             done_header = json.loads(done_json.decode('utf-8'))
 
             if done_header.get("type") != MSG_TYPE_PARALLEL_DONE:
@@ -405,16 +779,23 @@ class TransferServer:
 
         except Exception as e:
             self._log(f"並行檔案接收失敗: {e}")
+            if isinstance(e, socket.timeout):
+                self._count("timeouts")
             sock.send(RESP_ERROR.encode('utf-8'))
+            if fd is not None:
+                os.close(fd)
             # 刪除不完整的檔案
             if os.path.exists(filepath):
                 os.remove(filepath)
+        finally:
+            flow.close()
+            self._release(memory)
 
-    def _calculate_file_hash(self, filepath: str, quick: bool = True) -> str:
+    def _calculate_file_hash(self, filepath: str, quick: bool = True, algo: str = "md5") -> str:
         """
-        計算檔案的 hash
+        計算檔案的 hash (algo 為協商的演算法，舊版對端為 md5)
         quick=True: 只讀取檔案頭尾各 64KB + 檔案大小，速度快但不完全精確
-        quick=False: 完整 MD5 hash，精確但慢
+        quick=False: 完整 hash，精確但慢
         """
         filesize = os.path.getsize(filepath)
 
@@ -428,14 +809,31 @@ class TransferServer:
                 if filesize > 65536:
                     f.seek(-65536, 2)
                     hash_data += f.read(65536)
-            return hashlib.md5(hash_data).hexdigest()
+            hasher = new_hash(algo)
+            hasher.update(hash_data)
+            return hasher.hexdigest()
         else:
-            # 完整 MD5
-            hash_md5 = hashlib.md5()
-            with open(filepath, 'rb') as f:
-                for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+            # 完整 hash (大檔案交給程序池，以 mmap 讀取)
+            return get_offload().file_digest(filepath, algo)
+
+    def _calculate_data_hash(self, data: bytes, algo: str = "md5") -> str:
+        """以記憶體中的檔案內容計算與 _calculate_file_hash(quick=True) 相同的 hash"""
+        hash_data = str(len(data)).encode() + data[:65536]
+        if len(data) > 65536:
+            hash_data += data[-65536:]
+        hasher = new_hash(algo)
+        hasher.update(hash_data)
+        return hasher.hexdigest()
+
+    def _write_small_file(self, filepath: str, data: bytes, flow):
+        """寫入池工作: 將已接收並驗證的小檔案寫入磁碟，失敗時刪除不完整的檔案"""
+        try:
+            with flow.io(len(data)), open(filepath, 'wb') as f:
+                f.write(data)
+        except OSError:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise
 
     def _handle_folder(self, sock: socket.socket, header: dict, sender_ip: str):
         """處理資料夾傳輸"""
@@ -448,6 +846,35 @@ class TransferServer:
         # 安全處理資料夾名稱
         safe_folder_name = os.path.basename(folder_name)
 
+        # 空間不足時在建立資料夾與接收任何數據前拒絕
+        try:
+            ensure_free_space(RECEIVE_DIR, total_size)
+        except OSError as e:
+            self._log(f"資料夾接收失敗: {e}")
+            sock.send(RESP_ERROR.encode('utf-8'))
+            return
+
+        # 接收管線 + 小檔案寫入緩衝，預算不足時排隊 (逾時則回應 ERROR)
+        memory = ReceivePipeline.memory_size() + FOLDER_WRITE_BUFFER
+        if not self._admit(memory, safe_folder_name):
+            sock.send(RESP_ERROR.encode('utf-8'))
+            return
+
+        flow = get_io_scheduler().open_flow(sender_ip, total_size)
+        try:
+            self._receive_folder(sock, header, sender_ip, safe_folder_name, flow)
+        finally:
+            flow.close()
+            self._release(memory)
+
+    def _receive_folder(self, sock: socket.socket, header: dict, sender_ip: str, safe_folder_name: str,
+                        flow):
+        """資料夾傳輸主體 (已通過空間檢查與記憶體准入，flow 為本傳輸的 I/O 排程身分)"""
+        total_files = header.get("total_files", 0)
+        total_size = header.get("total_size", 0)
+        sender_name = header.get("sender", sender_ip)
+        sender_platform = header.get("platform", "Unknown")
+
         # 建立接收資料夾
         folder_path = os.path.join(RECEIVE_DIR, safe_folder_name)
 
@@ -466,30 +893,71 @@ class TransferServer:
         if self.on_transfer_start:
             self.on_transfer_start(total_size)
 
-        # 發送 ACK
-        sock.send(RESP_ACK.encode('utf-8'))
+        # 檔案比對用的 hash 演算法 (舊版客戶端不帶此欄位，使用 md5)
+        hash_algo = header.get("hash_algo", "md5")
+        if hash_algo not in HASH_FACTORIES:
+            hash_algo = "md5"
+
+        # 協商協定版本並發送確認 (舊版客戶端不帶 wire 欄位，回應普通 ACK)
+        wire_version = choose_wire_version(header.get("wire", [WIRE_VERSION_JSON]))
+        codec = create_codec(wire_version)
+        sock.send(wire_response(wire_version).encode('utf-8'))
 
         received_size = 0
         received_files = 0
 
+        # 整個資料夾共用一條接收管線 (寫入執行緒與緩衝區只建立一次)
+        pipeline = ReceivePipeline()
+
+        # 小檔案寫入池: 逐檔 ACK 表示已接收並通過驗證，
+        # FOLDER_END 的 ACK 則要等所有寫入完成且成功才送出
+        # 寫入池為程序共用並依傳輸輪流執行，本傳輸只追蹤自己尚未完成的寫入；
+        # 尚未寫入的資料以 FOLDER_WRITE_BUFFER 為上限 (已包含在准入預留的記憶體中)
+        writer = get_fair_executor("writer")
+        write_buffer = MemoryBudget(FOLDER_WRITE_BUFFER)
+        pending_writes = set()
+        write_failures = []
+
+        # 持久性: file 以上模式每個檔案在確認前落盤 (小檔案因此不經過寫入池)，
+        # session 模式則在 FOLDER_END 確認前以一批 fsync 全部落盤
+        sync_each_file = self._durability_at_least(DURABILITY_FILE)
+        unsynced = []
+        new_dirs = {os.path.dirname(folder_path)}   # 目錄項目有變動、需要同步的目錄
+
+        def on_written(rel_path, filepath, size, future):
+            pending_writes.discard(future)
+            write_buffer.release(size)
+            error = future.exception()
+            if error:
+                write_failures.append(rel_path)
+                self._log(f"檔案寫入失敗: {rel_path} - {error}")
+            else:
+                unsynced.append(filepath)
+
+        # 已確認存在的目錄 (避免每個檔案都呼叫 exists / makedirs)
+        known_dirs = {folder_path}
+
+        # 檔案接收中的進度回呼節流 (每個檔案的完成 / 跳過事件不受影響)
+        throttle = RateLimit()
+
         try:
             while True:
                 # 接收下一個標頭
-                header_len_data = self._recv_exact(sock, 4)
-                if not header_len_data:
+                file_header = codec.recv_header(sock)
+                if not file_header:
                     raise Exception("連接中斷")
 
-                header_length = int.from_bytes(header_len_data, 'big')
-                header_json = self._recv_exact(sock, header_length)
-                if not header_json:
-                    raise Exception("連接中斷")
-
-                file_header = json.loads(header_json.decode('utf-8'))
                 msg_type = file_header.get("type")
 
                 if msg_type == MSG_TYPE_FOLDER_END:
+                    # 等待寫入池完成本傳輸的所有小檔案
+                    wait_futures(list(pending_writes))
+                    if write_failures:
+                        raise Exception(f"{len(write_failures)} 個檔案寫入失敗")
+                    self._make_durable(unsynced, new_dirs)
+
                     # 資料夾傳輸完成
-                    sock.send(RESP_ACK.encode('utf-8'))
+                    codec.send_response(sock, RESP_ACK)
                     self._log(f"資料夾接收完成: {folder_path}")
 
                     if self.on_folder_received:
@@ -514,15 +982,21 @@ class TransferServer:
 
                     # 確保子目錄存在
                     file_dir = os.path.dirname(filepath)
-                    if file_dir and not os.path.exists(file_dir):
+                    if file_dir and file_dir not in known_dirs:
                         os.makedirs(file_dir, exist_ok=True)
+                        known_dirs.add(file_dir)
+                        # 新建的各層子目錄都需同步其上層目錄
+                        parent = file_dir
+                        while parent != folder_path and parent.startswith(folder_path):
+                            parent = os.path.dirname(parent)
+                            new_dirs.add(parent)
 
                     # 檢查檔案是否已存在且 hash 相同（用於續傳）
                     if os.path.exists(filepath) and file_hash:
-                        existing_hash = self._calculate_file_hash(filepath)
+                        existing_hash = self._calculate_file_hash(filepath, algo=hash_algo)
                         if existing_hash == file_hash:
                             # 檔案已存在且相同，跳過
-                            sock.send(RESP_SKIP.encode('utf-8'))
+                            codec.send_response(sock, RESP_SKIP)
                             received_size += filesize
                             received_files += 1
 
@@ -533,65 +1007,321 @@ class TransferServer:
                             self._log(f"跳過 (已存在): {safe_rel_path}")
                             continue
 
-                    # 發送 ACK，準備接收檔案
-                    sock.send(RESP_ACK.encode('utf-8'))
-
-                    # 接收檔案內容
-                    file_received = 0
-                    try:
-                        with open(filepath, 'wb') as f:
-                            while file_received < filesize:
-                                chunk_size = min(FILE_CHUNK_SIZE, filesize - file_received)
-                                chunk = self._recv_exact(sock, chunk_size)
-                                if not chunk:
-                                    raise Exception("連接中斷")
-
-                                f.write(chunk)
-                                file_received += len(chunk)
+                    def on_received(file_received):
+                        # 更新進度 (檔案最後一段一定送出)
+                        if file_received < filesize and not throttle.ready():
+                            return
+                        file_progress = (file_received / filesize) * 100 if filesize > 0 else 100
+                        overall_progress = ((received_size + file_received) / total_size) * 100 if total_size > 0 else 100
 
-                                # 更新進度
-                                file_progress = (file_received / filesize) * 100 if filesize > 0 else 100
-                                overall_progress = ((received_size + file_received) / total_size) * 100 if total_size > 0 else 100
-
-                                if self.on_folder_progress:
-                                    self.on_folder_progress(file_index, file_total, safe_rel_path, file_progress, overall_progress, "receiving")
-
-                                if self.on_progress:
-                                    self.on_progress(overall_progress, f"({file_index}/{file_total}) {safe_rel_path}")
+                        if self.on_folder_progress:
+                            self.on_folder_progress(file_index, file_total, safe_rel_path, file_progress, overall_progress, "receiving")
+
+                        if self.on_progress:
+                            self.on_progress(overall_progress, f"({file_index}/{file_total}) {safe_rel_path}")
+
+                    if filesize <= FOLDER_SMALL_FILE_SIZE and not sync_each_file:
+                        # 小檔案: 收進記憶體並驗證，交給寫入池 (連接執行緒不等待開檔/寫入/關檔)
+                        codec.send_response(sock, RESP_ACK)
+                        data = recv_exact(sock, filesize) if filesize else b''
+                        if data is None:
+                            raise Exception("連接中斷")
+                        on_received(filesize)
+
+                        if file_hash and self._calculate_data_hash(data, algo=hash_algo) != file_hash:
+                            raise Exception(f"檔案 {safe_rel_path} hash 驗證失敗")
+
+                        write_buffer.acquire(filesize)
+                        future = writer.submit(flow.key, self._write_small_file, filepath, data, flow)
+                        pending_writes.add(future)
+                        future.add_done_callback(partial(on_written, safe_rel_path, filepath, filesize))
+
+                    else:
+                        # 建立檔案並預留空間，失敗時回應 ERROR (發送端跳過此檔案)
+                        try:
+                            f = open(filepath, 'wb')
+                        except OSError as e:
+                            self._log(f"無法建立檔案 (跳過): {safe_rel_path} - {e}")
+                            codec.send_response(sock, RESP_ERROR)
+                            continue
+                        try:
+                            preallocate(f.fileno(), filesize)
+                        except OSError as e:
+                            f.close()
+                            os.remove(filepath)
+                            self._log(f"無法預留空間 (跳過): {safe_rel_path} - {e}")
+                            codec.send_response(sock, RESP_ERROR)
+                            continue
 
-                        # 驗證 hash
-                        if file_hash:
-                            received_hash = self._calculate_file_hash(filepath)
-                            if received_hash != file_hash:
+                        # 發送 ACK，準備接收檔案
+                        codec.send_response(sock, RESP_ACK)
+
+                        # 接收檔案內容
+                        try:
+                            with f:
+                                cache = CacheAdvisor(f.fileno(), 0, filesize, 'write')
+                                pipeline.receive(sock, f.fileno(), 0, filesize, on_received, cache,
+                                                 self._range_sync(f.fileno()), flow)
+                                cache.finish()
+
+                            # 驗證 hash
+                            if file_hash:
+                                received_hash = self._calculate_file_hash(filepath, algo=hash_algo)
+                                if received_hash != file_hash:
+                                    raise Exception(f"檔案 {safe_rel_path} hash 驗證失敗")
+
+                            if sync_each_file:
+                                self._committer.sync([filepath], new_dirs)
+                                new_dirs.clear()
+                            else:
+                                unsynced.append(filepath)
+
+                        except Exception as e:
+                            # 刪除不完整的檔案
+                            if os.path.exists(filepath):
                                 os.remove(filepath)
-                                raise Exception(f"檔案 {safe_rel_path} hash 驗證失敗")
+                            raise e
 
-                        # 發送檔案接收確認
-                        sock.send(RESP_ACK.encode('utf-8'))
+                    # 發送檔案接收確認
+                    codec.send_response(sock, RESP_ACK)
 
-                        received_size += filesize
-                        received_files += 1
+                    received_size += filesize
+                    received_files += 1
 
-                        overall_progress = (received_size / total_size) * 100 if total_size > 0 else 100
-                        if self.on_folder_progress:
-                            self.on_folder_progress(file_index, file_total, safe_rel_path, 100, overall_progress, "completed")
+                    overall_progress = (received_size / total_size) * 100 if total_size > 0 else 100
+                    if self.on_folder_progress:
+                        self.on_folder_progress(file_index, file_total, safe_rel_path, 100, overall_progress, "completed")
 
-                        self._log(f"接收完成 ({file_index}/{file_total}): {safe_rel_path}")
-
-                    except Exception as e:
-                        # 刪除不完整的檔案
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                        raise e
+                    self._log(f"接收完成 ({file_index}/{file_total}): {safe_rel_path}")
 
                 else:
                     # 未知訊息類型
                     self._log(f"未知訊息類型: {msg_type}")
-                    sock.send(RESP_ERROR.encode('utf-8'))
+                    codec.send_response(sock, RESP_ERROR)
 
         except Exception as e:
             self._log(f"資料夾接收失敗: {e}")
-            sock.send(RESP_ERROR.encode('utf-8'))
+            if isinstance(e, socket.timeout):
+                self._count("timeouts")
+            codec.send_response(sock, RESP_ERROR)
+        finally:
+            wait_futures(list(pending_writes))
+            pipeline.close()
+            self._record_pipeline(pipeline)
+
+    def _handle_session(self, sock: socket.socket, header: dict, sender_ip: str):
+        """
+        處理持久多工會話
+        一條連接上交錯承載多條串流，每條串流結束時回送 FRAME_ACK
+        """
+        sender_name = header.get("sender", sender_ip)
+        sender_platform = header.get("platform", "Unknown")
+
+        wire_version = choose_wire_version(header.get("wire", [WIRE_VERSION_JSON]))
+        codec = create_codec(wire_version)
+
+        sock.send(wire_response(wire_version).encode('utf-8'))
+
+        send_lock = threading.Lock()
+        streams = {}
+        consumed = 0  # 已處理但尚未歸還給發送端的窗口
+        # 串流資料收進同一塊緩衝區 (每框處理完才收下一框，不需每框配置)
+        data_buffer = memoryview(bytearray(SESSION_FRAME_SIZE))
+
+        try:
+            while self.running:
+                try:
+                    frame = recv_frame(sock, data_buffer)
+                except socket.timeout:
+                    self._count("session_idle")
+                    self._log(f"會話閒置逾時，關閉: {sender_name}")
+                    break
+                except ValueError as e:
+                    # 與首個標頭相同: 長度超過上限時不配置緩衝區，直接關閉會話
+                    self._count("rejected_header")
+                    self._log(f"關閉來自 {sender_ip} 的會話: {e}")
+                    break
+                if frame is None:
+                    break
+
+                stream_id, frame_type, _flags, payload = frame
+
+                if frame_type == FRAME_OPEN:
+                    meta = codec.decode_message(payload)
+                    stream = self._session_open_stream(meta, sender_ip, sender_name)
+                    streams[stream_id] = stream
+                    if stream["error"]:
+                        # 提前回應錯誤 (例如空間不足)，發送端可立即停止送出資料
+                        send_frame(sock, send_lock, stream_id, FRAME_ACK, RESP_ERROR_STRIPPED.encode('utf-8'))
+
+                elif frame_type == FRAME_DATA:
+                    stream = streams.get(stream_id)
+                    if stream:
+                        self._session_stream_data(stream, payload)
+
+                    # 流量控制: 處理完一半窗口即歸還
+                    consumed += len(payload)
+                    if consumed >= SESSION_WINDOW_SIZE // 2:
+                        send_frame(sock, send_lock, 0, FRAME_WINDOW, WINDOW_UPDATE.pack(consumed))
+                        consumed = 0
+
+                elif frame_type == FRAME_END:
+                    stream = streams.pop(stream_id, None)
+                    result = RESP_ERROR_STRIPPED
+                    if stream:
+                        result = self._session_finish_stream(stream, sender_ip, sender_name, sender_platform)
+                    send_frame(sock, send_lock, stream_id, FRAME_ACK, result.encode('utf-8'))
+
+                elif frame_type == FRAME_PING:
+                    send_frame(sock, send_lock, stream_id, FRAME_PONG)
+
+                elif frame_type == FRAME_HELLO:
+                    # 傳輸參數由發送端依雙方能力選擇，接收端只需回覆本機能力
+                    send_frame(sock, send_lock, stream_id, FRAME_HELLO,
+                               json.dumps(local_capabilities()).encode('utf-8'))
+
+                elif frame_type == FRAME_CLOSE:
+                    break
+
+        finally:
+            # 刪除未完成的檔案
+            for stream in streams.values():
+                self._session_abort_stream(stream)
+
+    def _session_open_stream(self, meta: dict, sender_ip: str, sender_name: str) -> dict:
+        """建立會話串流的接收狀態"""
+        kind = meta.get("type")
+        stream = {"kind": kind, "meta": meta, "error": None}
+
+        if kind == MSG_TYPE_TEXT:
+            stream["buf"] = bytearray()
+
+        elif kind == MSG_TYPE_FILE:
+            filename = meta.get("filename", "unknown_file")
+            filesize = meta.get("filesize", 0)
+            safe_filename = os.path.basename(filename)
+            filepath = self._unique_filepath(safe_filename)
+
+            self._log(f"開始接收檔案: {safe_filename} ({filesize} bytes)")
+            if self.on_transfer_start:
+                self.on_transfer_start(filesize)
+
+            stream.update(safe_filename=safe_filename, filepath=filepath,
+                          filesize=filesize, received=0, file=None, inflate=None, sync=None,
+                          flow=get_io_scheduler().open_flow(sender_ip, filesize),
+                          progress=ProgressTracker(filesize, partial(self._session_progress, safe_filename)))
+
+            compression = meta.get("compression", "none")
+            if compression == "zlib":
+                stream["inflate"] = zlib.decompressobj()
+            elif compression != "none":
+                stream["error"] = f"不支援的壓縮方式: {compression}"
+                return stream
+
+            try:
+                ensure_free_space(RECEIVE_DIR, filesize)
+                stream["file"] = open(filepath, 'wb')
+                preallocate(stream["file"].fileno(), filesize)
+                stream["cache"] = CacheAdvisor(stream["file"].fileno(), 0, filesize, 'write')
+                stream["sync"] = self._range_sync(stream["file"].fileno())
+            except OSError as e:
+                stream["error"] = str(e)
+                if stream["file"]:
+                    stream["file"].close()
+                    stream["file"] = None
+
+        else:
+            stream["error"] = f"未知串流類型: {kind}"
+
+        return stream
+
+    def _session_stream_data(self, stream: dict, payload: memoryview):
+        """寫入會話串流資料 (payload 為共用接收緩衝區的切片，不可保留)"""
+        if stream["error"]:
+            return
+
+        if stream["kind"] == MSG_TYPE_TEXT:
+            stream["buf"] += payload
+            return
+
+        try:
+            if stream["inflate"]:
+                payload = stream["inflate"].decompress(payload)
+            with stream["flow"].io(len(payload)):
+                stream["file"].write(payload)
+        except (OSError, zlib.error) as e:
+            stream["error"] = str(e)
+            return
+
+        stream["received"] += len(payload)
+        stream["cache"].advance(stream["received"])
+        if stream["sync"]:
+            stream["sync"].add(len(payload))
+        stream["progress"].set(0, stream["received"])
+
+    def _session_progress(self, safe_filename: str, done: int, total: int, speed: float, remaining: float):
+        """會話串流的進度回呼 (由 ProgressTracker 節流)"""
+        if self.on_progress and total > 0:
+            self.on_progress((done / total) * 100, f"接收中: {safe_filename}")
+
+    def _session_finish_stream(self, stream: dict, sender_ip: str, sender_name: str,
+                               sender_platform: str) -> str:
+        """串流結束: 交付內容並返回回應字串"""
+        if stream["kind"] == MSG_TYPE_TEXT:
+            if stream["error"]:
+                return RESP_ERROR_STRIPPED
+            text = stream["buf"].decode('utf-8')
+            self._log(f"收到來自 {sender_name} 的文字訊息")
+            if self.on_text_received:
+                self.on_text_received(sender_ip, sender_name, text, sender_platform)
+            return RESP_ACK_STRIPPED
+
+        filepath = stream.get("filepath")
+        if stream["file"]:
+            if stream["inflate"] and not stream["error"]:
+                tail = stream["inflate"].flush()
+                stream["file"].write(tail)
+                stream["received"] += len(tail)
+            stream["file"].flush()
+            stream["cache"].finish()
+            stream["file"].close()
+            stream["file"] = None
+
+        if stream["error"] or stream.get("received") != stream.get("filesize"):
+            self._log(f"檔案接收失敗: {stream['error'] or '大小不符'}")
+            self._session_abort_stream(stream)
+            return RESP_ERROR_STRIPPED
+
+        # 會話中每條串流都是一次獨立的傳輸: session 以上模式在確認前落盤
+        try:
+            self._make_durable([filepath])
+        except OSError as e:
+            self._log(f"檔案接收失敗: {e}")
+            self._session_abort_stream(stream)
+            return RESP_ERROR_STRIPPED
+
+        self._session_close_flow(stream)
+        stream["progress"].finish()
+        self._log(f"檔案接收完成: {filepath}")
+        if self.on_file_received:
+            self.on_file_received(sender_ip, sender_name, filepath, stream["filesize"], sender_platform)
+        return RESP_ACK_STRIPPED
+
+    def _session_close_flow(self, stream: dict):
+        """結束串流在 I/O 排程器中的登記 (可重複呼叫)"""
+        flow = stream.pop("flow", None)
+        if flow:
+            flow.close()
+
+    def _session_abort_stream(self, stream: dict):
+        """放棄串流並刪除不完整的檔案"""
+        self._session_close_flow(stream)
+        if stream.get("file"):
+            stream["file"].close()
+            stream["file"] = None
+        filepath = stream.get("filepath")
+        if filepath and os.path.exists(filepath):
+            os.remove(filepath)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+"""
+持久多工會話
+每個對端維持一條長連接，以資料框 (frame) 承載多條串流 (文字、控制、小檔案、確認)
+避免每則訊息都要重新建立 TCP 連接
+"""
+import socket
+import json
+import struct
+import zlib
+import threading
+import itertools
+import time
+from typing import Callable, Dict, Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import (
+    SESSION_FRAME_SIZE, SESSION_WINDOW_SIZE, SESSION_ACK_TIMEOUT, HEADER_MAX_SIZE
+)
+from network.protocol import recv_exact, recv_exact_into, JsonCodec
+from utils.fileio import CacheAdvisor
+from network.offload import get_offload
+from network.progress import ProgressTracker
+
+# 資料框標頭: stream_id (4) + 類型 (1) + 旗標 (1) + 負載長度 (4)
+FRAME_HEADER = struct.Struct('!IBBI')
+
+# 資料框類型
+FRAME_OPEN = 1      # 開啟串流 (負載為以協商協定編碼的串流標頭)
+FRAME_DATA = 2      # 串流資料
+FRAME_END = 3       # 串流結束
+FRAME_ACK = 4       # 串流確認 (負載為回應字串)
+FRAME_WINDOW = 5    # 流量控制窗口更新 (負載為 4 bytes 增量)
+FRAME_PING = 6      # 控制: 延遲測試
+FRAME_PONG = 7      # 控制: 延遲測試回應
+FRAME_CLOSE = 8     # 關閉會話
+FRAME_HELLO = 9     # 控制: 能力交換 (負載為 JSON)
+
+WINDOW_UPDATE = struct.Struct('!I')
+
+
+def send_frame(sock: socket.socket, lock: threading.Lock, stream_id: int,
+               frame_type: int, payload: bytes = b'', flags: int = 0):
+    """發送單一資料框 (整框在鎖內送出，確保多執行緒寫入不會交錯)"""
+    header = FRAME_HEADER.pack(stream_id, frame_type, flags, len(payload))
+    with lock:
+        sock.sendall(header + payload)
+
+
+def recv_frame(sock: socket.socket, data_buffer: Optional[memoryview] = None) -> Optional[tuple]:
+    """
+    接收單一資料框，返回 (stream_id, frame_type, flags, payload) 或 None
+    提供 data_buffer 時 FRAME_DATA 的負載直接收進該緩衝區 (返回其切片，下次呼叫前有效)
+    負載長度來自對端: FRAME_DATA 超過 SESSION_FRAME_SIZE、其他資料框超過 HEADER_MAX_SIZE 時拋出 ValueError
+    """
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if not header:
+        return None
+    stream_id, frame_type, flags, length = FRAME_HEADER.unpack(header)
+    limit = SESSION_FRAME_SIZE if frame_type == FRAME_DATA else HEADER_MAX_SIZE
+    if length > limit:
+        raise ValueError(f"資料框過大: {length} bytes (類型 {frame_type}，上限 {limit} bytes)")
+    payload = b''
+    if length:
+        if frame_type == FRAME_DATA and data_buffer is not None and length <= len(data_buffer):
+            payload = data_buffer[:length]
+            if not recv_exact_into(sock, payload):
+                return None
+        else:
+            payload = recv_exact(sock, length)
+            if payload is None:
+                return None
+    return stream_id, frame_type, flags, payload
+
+
+class _PendingStream:
+    """等待確認的串流"""
+    __slots__ = ("event", "result")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = ""
+
+
+class SessionClosed(Exception):
+    """會話已關閉 (unsent 為 True 表示本串流尚未送出任何資料框，可在新會話重送)"""
+
+    def __init__(self, message: str = "", unsent: bool = False):
+        super().__init__(message)
+        self.unsent = unsent
+
+
+class SessionTimeout(Exception):
+    """等待確認超時 (對端可能仍在處理，例如落盤較慢；重送會造成重複接收)"""
+
+
+class PeerSession:
+    """
+    發送端的持久會話
+    socket 由呼叫者建立並完成 SESSION 握手後交給本類別
+    串流標頭以握手時協商的協定 (codec) 編碼
+    """
+
+    def __init__(self, sock: socket.socket, target_ip: str, codec=None):
+        self.sock = sock
+        self.target_ip = target_ip
+        self.codec = codec or JsonCodec()
+        self.alive = True
+        self.last_used = time.time()
+
+        self._send_lock = threading.Lock()
+        self._window = threading.Condition()
+        self._credit = SESSION_WINDOW_SIZE
+        self._pending: Dict[int, _PendingStream] = {}
+        self._pending_lock = threading.Lock()
+        self._stream_ids = itertools.count(1)
+
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        """讀取對端送回的確認、窗口更新與控制資料框"""
+        try:
+            while self.alive:
+                frame = recv_frame(self.sock)
+                if frame is None:
+                    break
+                stream_id, frame_type, _flags, payload = frame
+
+                if frame_type in (FRAME_ACK, FRAME_PONG, FRAME_HELLO):
+                    with self._pending_lock:
+                        pending = self._pending.pop(stream_id, None)
+                    if pending:
+                        pending.result = payload.decode('utf-8', errors='replace')
+                        pending.event.set()
+                elif frame_type == FRAME_WINDOW:
+                    increment = WINDOW_UPDATE.unpack(payload)[0]
+                    with self._window:
+                        self._credit += increment
+                        self._window.notify_all()
+                elif frame_type == FRAME_CLOSE:
+                    break
+        except (OSError, struct.error, ValueError):
+            pass
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        """標記會話失效並喚醒所有等待者"""
+        self.alive = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for p in pending:
+            p.event.set()
+        with self._window:
+            self._window.notify_all()
+
+    def _new_stream(self) -> tuple:
+        stream_id = next(self._stream_ids)
+        pending = _PendingStream()
+        with self._pending_lock:
+            self._pending[stream_id] = pending
+        return stream_id, pending
+
+    def _send(self, stream_id: int, frame_type: int, payload: bytes = b''):
+        if not self.alive:
+            raise SessionClosed("會話已關閉")
+        try:
+            send_frame(self.sock, self._send_lock, stream_id, frame_type, payload)
+        except OSError as e:
+            self._shutdown()
+            raise SessionClosed(str(e))
+        self.last_used = time.time()
+
+    def _send_data(self, stream_id: int, data: bytes):
+        """送出串流資料 (切成不超過 SESSION_FRAME_SIZE 的資料框，接收端拒絕更大的資料框)"""
+        view = memoryview(data)
+        for start in range(0, len(data), SESSION_FRAME_SIZE):
+            piece = view[start:start + SESSION_FRAME_SIZE]
+            self._acquire_credit(len(piece))
+            self._send(stream_id, FRAME_DATA, piece)
+
+    def _acquire_credit(self, size: int):
+        """流量控制: 等待對端釋出足夠的窗口"""
+        with self._window:
+            while self._credit < size:
+                if not self.alive:
+                    raise SessionClosed("會話已關閉")
+                self._window.wait(1)
+            self._credit -= size
+
+    def _wait(self, stream_id: int, pending: _PendingStream, timeout: float) -> str:
+        if not pending.event.wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(stream_id, None)
+            raise SessionTimeout("等待確認超時")
+        if not pending.result and not self.alive:
+            raise SessionClosed("會話已關閉")
+        return pending.result
+
+    def _open(self, header: dict) -> tuple:
+        stream_id, pending = self._new_stream()
+        try:
+            self._send(stream_id, FRAME_OPEN, self.codec.encode_message(header))
+        except SessionClosed as e:
+            # 串流標頭未送達 (不完整的資料框會隨會話一起被丟棄)，可安全重送
+            e.unsent = True
+            raise
+        return stream_id, pending
+
+    def send_bytes(self, header: dict, data: bytes,
+                   timeout: float = SESSION_ACK_TIMEOUT) -> str:
+        """以單一串流發送一段資料並等待確認，返回回應字串"""
+        stream_id, pending = self._open(header)
+        self._send_data(stream_id, data)
+        self._send(stream_id, FRAME_END)
+        return self._wait(stream_id, pending, timeout)
+
+    def send_file(self, header: dict, filepath: str, filesize: int,
+                  on_progress_callback: Optional[Callable] = None,
+                  timeout: float = SESSION_ACK_TIMEOUT) -> str:
+        """
+        以單一串流發送檔案並等待確認，返回回應字串
+        header 含 "compression": "zlib" 時資料框以 zlib 串流壓縮 (大檔案交給程序池平行壓縮)
+        """
+        stream_id, pending = self._open(header)
+        if header.get("compression") == "zlib" and get_offload().can_offload(filesize):
+            self._send_offloaded_zlib(stream_id, pending, filepath, filesize, on_progress_callback)
+            self._send(stream_id, FRAME_END)
+            return self._wait(stream_id, pending, timeout)
+
+        compressor = zlib.compressobj(1) if header.get("compression") == "zlib" else None
+        sent = 0
+        tracker = ProgressTracker(filesize, on_progress_callback)
+        with open(filepath, 'rb') as f:
+            cache = CacheAdvisor(f.fileno(), 0, filesize, 'read')
+            while sent < filesize:
+                # 接收端已提前回應 (例如空間不足)，停止送出資料
+                if pending.event.is_set():
+                    break
+                piece = f.read(min(SESSION_FRAME_SIZE, filesize - sent))
+                if not piece:
+                    break
+                sent += len(piece)
+                cache.advance(sent)
+                if compressor:
+                    # 壓縮輸出可能大於輸入 (內部緩衝一次吐出)，由 _send_data 切框
+                    piece = compressor.compress(piece)
+                self._send_data(stream_id, piece)
+                tracker.set(0, sent)
+            cache.finish()
+        if compressor:
+            self._send_data(stream_id, compressor.flush())
+        tracker.finish()
+        self._send(stream_id, FRAME_END)
+        return self._wait(stream_id, pending, timeout)
+
+    def _send_offloaded_zlib(self, stream_id: int, pending, filepath: str, filesize: int,
+                             on_progress_callback: Optional[Callable] = None):
+        """以程序池平行壓縮的 zlib 串流發送檔案資料 (接收端與一般 zlib 串流相同處理)"""
+        tracker = ProgressTracker(filesize, on_progress_callback)
+        stream = get_offload().zlib_stream(filepath, filesize)
+        try:
+            for sent, data in stream:
+                # 接收端已提前回應 (例如空間不足)，停止送出資料
+                if pending.event.is_set():
+                    break
+                self._send_data(stream_id, data)
+                tracker.set(0, sent)
+        finally:
+            stream.close()
+        tracker.finish()
+
+    def hello(self, capabilities: dict, timeout: float = 5) -> Optional[dict]:
+        """交換能力資訊，返回對端能力；對端不回應時返回 None"""
+        stream_id, pending = self._new_stream()
+        try:
+            self._send(stream_id, FRAME_HELLO, json.dumps(capabilities).encode('utf-8'))
+            result = self._wait(stream_id, pending, timeout)
+            return json.loads(result)
+        except (SessionClosed, SessionTimeout, ValueError):
+            return None
+
+    def ping(self, timeout: float = 5) -> Optional[float]:
+        """透過控制串流測試來回延遲(ms)"""
+        stream_id, pending = self._new_stream()
+        start = time.time()
+        try:
+            self._send(stream_id, FRAME_PING)
+            self._wait(stream_id, pending, timeout)
+        except (SessionClosed, SessionTimeout):
+            return None
+        return (time.time() - start) * 1000
+
+    def close(self):
+        """主動關閉會話"""
+        if self.alive:
+            try:
+                send_frame(self.sock, self._send_lock, 0, FRAME_CLOSE)
+            except OSError:
+                pass
+        self._shutdown()
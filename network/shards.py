@@ -0,0 +1,174 @@
+"""
+多程序接收 (SO_REUSEPORT 分片)
+10 GbE 以上時單一 Python 程序受 GIL 限制，hash 與寫入跟不上網路；
+此模式啟動 N 個工作程序，各自以 SO_REUSEPORT 監聽同一個 TRANSFER_PORT，
+由核心把新連接分散到各程序 (每條連接 / 每個會話完整地由同一個程序處理)
+工作程序的 GUI 回呼經由管道轉送回主程序執行
+"""
+import socket
+import sys
+import threading
+from typing import Dict
+
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import TRANSFER_MEMORY_BUDGET, REAPER_INTERVAL
+
+# 只有 Linux 的 SO_REUSEPORT 會把連接分散到各監聽 socket (BSD / macOS 只交給其中一個)
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux')
+
+# 由工作程序轉送到主程序的回呼
+RELAYED_CALLBACKS = (
+    "on_text_received", "on_file_received", "on_folder_received",
+    "on_progress", "on_folder_progress", "on_status", "on_transfer_start",
+)
+
+# 管道控制訊息
+_COUNTERS = "__counters__"  # 工作程序 → 主程序: 定期回報連接統計
+_STOP = "__stop__"          # 主程序 → 工作程序: 停止接收並結束
+
+# 本程序是否為工作程序 (工作程序內不可再啟動分片，否則會遞迴產生程序)
+_in_worker = False
+
+
+class _Relay:
+    """工作程序端: 把回呼與參數送回主程序 (多個處理執行緒共用管道，需加鎖)"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, name: str, args: tuple):
+        with self._lock:
+            try:
+                self._conn.send((name, args))
+            except (OSError, EOFError):
+                # 主程序已結束
+                pass
+
+    def callback(self, name: str):
+        return lambda *args: self.send(name, args)
+
+
+def _worker_main(index: int, conn, receive_dir: str, durability: str, memory_budget: int):
+    """工作程序入口 (spawn 啟動，只匯入網路模組，不載入 GUI)"""
+    global _in_worker
+    import network.server as server_module
+    from network.resources import set_memory_budget
+
+    _in_worker = True
+    server_module.RECEIVE_DIR = receive_dir
+    set_memory_budget(memory_budget)
+
+    relay = _Relay(conn)
+    callbacks = {name: relay.callback(name) for name in RELAYED_CALLBACKS}
+    # processes=1: 工作程序自己接收 (預設值 SERVER_PROCESSES 會讓每個工作程序再啟動分片)
+    server = server_module.TransferServer(processes=1, reuse_port=True, **callbacks)
+    server.durability = durability
+    server.start()
+
+    # 主執行緒定期回報統計，收到停止指令或管道關閉 (主程序已結束) 時退出
+    try:
+        while True:
+            if conn.poll(REAPER_INTERVAL) and conn.recv() == _STOP:
+                break
+            relay.send(_COUNTERS, (index, server.get_counters()))
+    except (OSError, EOFError):
+        pass
+    finally:
+        server.stop()
+
+
+class ShardedReceiver:
+    """
+    主程序端: 啟動工作程序並在轉送執行緒中呼叫 server 上的回呼
+    記憶體預算平分給各工作程序 (合計仍為 TRANSFER_MEMORY_BUDGET)；
+    連接上限、I/O 排程與批次 fsync 則各程序獨立
+    """
+
+    def __init__(self, server, processes: int):
+        self.server = server
+        self.processes = processes
+        self._workers = []                      # [(Process, Connection)]
+        self._counters: Dict[int, dict] = {}    # 各工作程序最近一次回報的統計
+        self._thread = None
+
+    def start(self, receive_dir: str):
+        if _in_worker:
+            raise RuntimeError("工作程序內不可再啟動多程序接收")
+        # multiprocessing 只在啟用多程序接收時載入
+        import multiprocessing
+        # spawn: 不複製主程序的 Tk 與執行緒狀態 (fork 在多執行緒程序中並不安全)
+        ctx = multiprocessing.get_context('spawn')
+        budget = max(1, TRANSFER_MEMORY_BUDGET // self.processes)
+        for index in range(self.processes):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(index, child_conn, receive_dir, self.server.durability, budget),
+                name=f"pcpcs-receiver-{index}",
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+
+        self._thread = threading.Thread(target=self._relay_loop, daemon=True)
+        self._thread.start()
+
+    def _relay_loop(self):
+        """轉送執行緒: 接收各工作程序的回呼並在主程序執行，所有工作程序結束後退出"""
+        from multiprocessing.connection import wait as wait_connections
+        conns = [conn for _, conn in self._workers]
+        while conns:
+            for conn in wait_connections(conns):
+                try:
+                    name, args = conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    conn.close()
+                    continue
+
+                if name == _COUNTERS:
+                    index, counters = args
+                    self._counters[index] = counters
+                    continue
+
+                callback = getattr(self.server, name, None)
+                if not callback:
+                    continue
+                try:
+                    callback(*args)
+                except Exception as e:
+                    # 回呼錯誤不能中斷轉送 (否則其他工作程序的回呼也會停擺)
+                    if name != "on_status":
+                        self.server._log(f"回呼錯誤 ({name}): {e}")
+
+    def counters(self) -> dict:
+        """合計各工作程序的連接統計"""
+        total = {}
+        per_peer = {}
+        for counters in list(self._counters.values()):
+            for name, value in counters.items():
+                if name == "per_peer":
+                    for peer, count in value.items():
+                        per_peer[peer] = per_peer.get(peer, 0) + count
+                else:
+                    total[name] = total.get(name, 0) + value
+        total["per_peer"] = per_peer
+        total["processes"] = len(self._workers)
+        return total
+
+    def stop(self, timeout: float = 3):
+        """通知工作程序停止並等待結束 (逾時則強制終止)"""
+        for _, conn in self._workers:
+            try:
+                conn.send(_STOP)
+            except (OSError, EOFError):
+                pass
+        for process, _ in self._workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
@@ -14,6 +14,58 @@ DISCOVERY_PORT = 52525          # UDP 廣播端口
 TRANSFER_PORT = 52526           # TCP 傳輸端口
 BROADCAST_INTERVAL = 3          # 廣播間隔(秒)
 PING_TIMEOUT = 2                # Ping 超時(秒)
+PEER_TIMEOUT = 30               # 節點超過此秒數未出現一定移除 (通常由下方的故障偵測更早判定)
+PEER_UPDATE_DEBOUNCE = 0.25     # 節點變動通知的合併間隔(秒)，避免大型區網的廣播風暴讓 GUI 反覆重繪
+PING_INTERVAL = 5               # 節點延遲量測間隔(秒)
+PROBE_FALLBACK_DELAY = 0.3      # UDP echo 在此秒數內無回應時改以 TCP connect 量測 (舊版對端不回應 echo)
+PROBE_MAX_INFLIGHT = 256        # 同時進行的量測數上限 (每個量測最多佔用一個 TCP socket)
+
+# 節點連線品質與故障偵測 (phi accrual: 依各節點過去的訊號間隔分佈，計算「已離線」的懷疑程度)
+PEER_RTT_SAMPLES = 32           # 每個節點保留最近的 RTT 樣本數 (遺失也記一筆)
+PEER_HEARTBEAT_WINDOW = 100     # 計算訊號間隔分佈所用的最近間隔數
+PEER_HEARTBEAT_PAUSE = 3.0      # 可接受的額外停頓(秒)，容忍偶發的封包遺失
+PEER_PHI_MIN_STD = 1.0          # 間隔標準差下限(秒)，避免規律訊號讓偵測過度敏感 (連續遺失兩次廣播不應判定離線)
+PEER_PHI_WARN = 3               # 懷疑程度達此值時列表顯示為不穩定
+PEER_PHI_SUSPECT = 8            # 達此值視為不可達
+PEER_PHI_DEAD = 16              # 達此值移除節點
+PEER_LOSSY_RATE = 0.05          # 量測遺失率達此值視為不穩定鏈路 (傳輸改用較小分塊、更多連接)
+PEER_CACHE_MAX_AGE = 604800     # 節點快取項目的保留期限 7 天(秒)
+PEER_CACHE_SIZE = 64            # 節點快取最多保留的節點數
+PEER_CACHE_SAVE_INTERVAL = 60   # 節點快取寫入間隔(秒) (停止服務時另外寫入一次)
+
+# 成員管理模式
+# "broadcast": 每個節點每 BROADCAST_INTERVAL 秒廣播，每 PING_INTERVAL 秒量測所有節點 (流量隨節點數平方成長，適合小型區網)
+# "gossip": SWIM 式成員管理 (數百台的大型區網)，加入後很少廣播，每週期只量測少數成員，
+#           成員變動附帶在量測封包中傳播，直接量測無回應時請其他成員間接量測
+MEMBERSHIP_MODE = "broadcast"
+GOSSIP_PERIOD = 1.0             # 協定週期(秒)
+GOSSIP_PROBES = 1               # 每週期量測的成員數 (依打亂後的順序輪流，每個成員每輪一定被量測一次)
+GOSSIP_INDIRECT = 3             # 直接量測無回應時，請幾個成員代為量測
+GOSSIP_FANOUT = 3               # 新成員加入時預期回應 (並同步成員列表) 的成員數
+GOSSIP_MAX_PACKET = 1200        # 單一封包上限 (bytes)，不超過一般 MTU，避免 IP 分片
+GOSSIP_SAMPLE = 3               # 每個封包額外附帶的隨機成員數 (反熵，讓遺漏的成員最終也會收到)
+GOSSIP_RETRANSMIT_MULT = 4      # 每個成員事件附帶傳送 mult * ceil(log10(N+1)) 次
+GOSSIP_SUSPECT_MULT = 5         # 懷疑期限 = mult * max(1, log10(N+1)) 個週期，期間內未反駁即判定離線
+GOSSIP_ANNOUNCE_INTERVAL = 60   # 加入後的廣播間隔(秒)，只用於修復分割的網路
+GOSSIP_SUPPRESS = 2             # 同一間隔內已聽到這麼多成員廣播時省略自己的廣播 (Trickle)
+GOSSIP_DEAD_RETENTION = 60      # 離線成員的墓碑保留秒數 (期間內忽略過期的存活事件)
+
+# 主動掃描 (網路擋住廣播時): 以單一 selector 迴圈對網段內每個位址的傳輸端口發起非阻塞 TCP connect
+SWEEP_ENABLED = False           # 啟動時與每 SWEEP_INTERVAL 秒自動掃描 (「重新掃描」按鈕不受此限)
+SWEEP_INTERVAL = 300            # 自動掃描間隔(秒)
+SWEEP_SUBNETS = []              # 掃描的 CIDR 列表，例如 ["10.1.2.0/24"] (空列表為各介面所在的 /24)
+SWEEP_RATE = 1000               # 每秒最多發起的連接數
+SWEEP_MAX_INFLIGHT = 256        # 同時進行的連接數上限
+SWEEP_TIMEOUT = 0.5             # 每個位址等待連接的秒數 (區網內的主機遠低於此值，不存在的位址等到逾時)
+SWEEP_MAX_HOSTS = 4096          # 單次掃描的位址數上限
+SWEEP_CONFIRM_WAIT = 0.5        # 單播發現訊息後等待回應的秒數，未回應的主機以 IP 為名稱加入
+
+# 容量公告: 發現訊息與量測回應附帶接收目錄剩餘空間、進行中的接收數、連結速度與協定能力
+DISCOVERY_MAX_PACKET = 1200     # 發現訊息上限 (bytes)，超過時減少附帶的位址 (一個封包，不分片)
+CAPACITY_REFRESH = 1.0          # 本機容量重新計算的間隔(秒) (量測回應頻繁，不每次查詢磁碟)
+CAPACITY_MAX_AGE = 30           # 對端公告的容量超過此秒數未更新即不採用
+CAPACITY_SLOW_LINK = 100        # 對端連結速度 (Mbps) 不超過此值時並行連接數上限為 2 (多連接無法超過連結本身)
+
 BUFFER_SIZE = 65536             # 傳輸緩衝區大小 (64KB for better throughput)
 FILE_CHUNK_SIZE = 1048576       # 檔案分塊大小 (1MB for maximum speed)
 
@@ -28,13 +80,80 @@ PARALLEL_CONNECTIONS = 8        # 並行連接數 (回調到 8，更穩定)
 PARALLEL_CHUNK_SIZE = 33554432  # 並行傳輸分塊大小 32MB (增大以減少開銷)
 PARALLEL_PORT_START = 52530     # 並行傳輸起始端口
 PARALLEL_MIN_FILE_SIZE = 10485760  # 啟用並行傳輸的最小檔案大小 10MB
+PARALLEL_LOSSY_CHUNK_SIZE = 8388608  # 不穩定鏈路的分塊大小 8MB (中型檔案也分散到多條連接，單一連接的重傳不會拖住整體)
+PARALLEL_STRIPE_SIZE = 16777216  # 多路徑並行傳輸的條帶大小上限 16MB (連接完成一條帶後再領取下一條)
+PARALLEL_STRIPE_MIN = 1048576    # 條帶大小下限 1MB
 
 # 高速傳輸參數
 SEND_CHUNK_SIZE = 262144        # 單次發送大小 256KB (更大的塊=更少系統調用)
 
+# Page cache 管理 (大檔案傳輸時避免擠掉系統中其他資料的快取)
+# "default": 不給提示 / "sequential": 只給預讀提示 / "drop_behind": 預讀 + 已讀寫區段自快取丟棄
+PAGE_CACHE_POLICY = "drop_behind"
+PAGE_CACHE_WINDOW = 16777216    # 提示窗口 16MB
+PAGE_CACHE_MIN_SIZE = 67108864  # 小於 64MB 的檔案不給提示 (接收後常會馬上開啟)
+
+# 接收管線 (網路接收與磁碟寫入分開在兩個執行緒，以緩衝區環銜接)
+PIPELINE_BUFFERS = 4            # 緩衝區數量 (磁碟短暫變慢時可先吸收 4MB)
+PIPELINE_BUFFER_SIZE = 1048576  # 單一緩衝區 1MB (每次寫入磁碟的大小)
+
+# 資料夾小檔案寫入池 (大量小檔案時，開檔/寫入/關檔的中繼資料延遲由多執行緒分攤)
+FOLDER_SMALL_FILE_SIZE = 1048576  # 不超過 1MB 的檔案先收進記憶體，交由寫入池落盤
+FOLDER_WRITER_THREADS = 4         # 寫入執行緒數 (所有資料夾傳輸共用)
+FOLDER_WRITE_BUFFER = 8388608     # 每個資料夾傳輸尚未寫入的小檔案資料上限 8MB
+
+# 記憶體預算 (小型 NAS 等接收端: 同時傳輸再多，接收緩衝區合計也不超過上限)
+# 每個傳輸開始前預留所需的緩衝區大小，預算不足時排隊等待
+TRANSFER_MEMORY_BUDGET = 67108864   # 所有傳輸的接收緩衝區合計上限 64MB
+BUFFER_POOL_IDLE_MAX = 16777216     # 緩衝區池最多保留 16MB 閒置緩衝區供重複使用
+ADMISSION_TIMEOUT = 20              # 排隊等待預算的上限(秒)，須小於發送端等待準備好信號的 30 秒
+RECV_CHUNK_SIZE = 262144            # 並行分塊接收緩衝區 256KB (減少系統調用次數)
+
+# 接收伺服器連接管理 (准入上限、逐階段超時、閒置回收)
+SERVER_MAX_CONNECTIONS = 64     # 全域同時連接上限 (超過時直接關閉新連接)
+SERVER_MAX_PER_PEER = 8         # 單一對端同時連接上限 (會話 + 資料夾 + 並行主連接)
+SERVER_BACKLOG = 128            # 初始 listen backlog (不超過系統 somaxconn)
+SERVER_BACKLOG_MAX = 1024       # 連接突增時 backlog 倍增的上限
+HEADER_TIMEOUT = 10             # 連接後必須在此秒數內送完首個標頭 (防止慢速標頭佔住執行緒)
+HEADER_MAX_SIZE = 1048576       # 首個標頭大小上限 1MB (之後的分塊、資料夾檔案標頭同樣適用)
+TEXT_MAX_SIZE = 16777216        # 舊版協定文字訊息大小上限 16MB (依標頭長度預先配置緩衝區)
+DATA_TIMEOUT = 60               # 傳輸中兩次收到資料的最長間隔(秒)
+REAPER_INTERVAL = 2             # 閒置回收檢查間隔(秒)
+SERVER_PROCESSES = 1            # 接收工作程序數，>1 時以 SO_REUSEPORT 分散連接到多個程序 (僅 Linux)
+
+# 接收端 I/O 排程 (多個發送端同時傳輸時，依發送端公平分配磁碟寫入)
+IO_SCHED_SLOTS = 4                          # 同時進行的磁碟寫入數，超過時依公平順序排隊
+IO_SCHED_SMALL_TRANSFER = 67108864          # 總大小不超過 64MB 的傳輸視為小型傳輸
+IO_SCHED_SMALL_WEIGHT = 4                   # 小型傳輸的權重 (大量傳輸為 1)，讓小傳輸先完成
+
+# CPU 密集工作卸載 (完整 hash / 區段 digest / 壓縮交給程序池，不受傳輸執行緒的 GIL 限制)
+OFFLOAD_WORKERS = 0             # 程序池大小，0 = CPU 核心數 (單核心時不卸載)
+OFFLOAD_MIN_SIZE = 4194304      # 小於 4MB 的輸入在呼叫端直接計算 (程序間往返的成本較高)
+OFFLOAD_BLOCK_SIZE = 1048576    # 平行壓縮的區塊大小 1MB
+
+# 進度回呼 (GUI 更新) 的最短間隔(秒)，期間內的更新合併為一次；傳輸結束時一定送出最終進度
+PROGRESS_INTERVAL = 0.1
+
+# 持久性 (回應確認前是否 fsync，避免斷電後留下發送端以為已送達的截斷檔案)
+# "none": 不 fsync (交由作業系統回寫)
+# "session": 每次傳輸 (單檔 / 並行檔案 / 整個資料夾 / 會話中的單一串流) 在最終確認前批次 fsync 一次
+# "file": 資料夾中每個檔案在各自的確認前 fsync
+# "range": 同 "file"，大檔案寫入過程中每 DURABILITY_RANGE_SIZE 額外 fdatasync 一次 (斷電時最多遺失一個區段)
+DURABILITY_MODE = "session"
+DURABILITY_RANGE_SIZE = 67108864  # range 模式的同步區段 64MB
+DURABILITY_SYNC_THREADS = 8       # 批次 fsync 的並行數 (讓檔案系統合併日誌提交)
+
+# 啟動時間預算 (視窗先繪製，網路模組的載入與服務啟動延後到第一次繪製之後)
+STARTUP_FIRST_PAINT_BUDGET = 0.5  # 程序啟動到視窗第一次繪製完成的上限(秒)
+STARTUP_READY_BUDGET = 1.0        # 程序啟動到網路服務就緒 (發現與接收已啟動) 的上限(秒)
+
 # 訊息類型
 MSG_TYPE_DISCOVERY = "PCPCS_DISCOVERY"
 MSG_TYPE_RESPONSE = "PCPCS_RESPONSE"
+MSG_TYPE_PING = "PCPCS_PING"    # RTT 量測 (送到發現端口，對端原樣帶回 id)
+MSG_TYPE_PONG = "PCPCS_PONG"
+MSG_TYPE_PING_REQ = "PCPCS_PING_REQ"  # 請對方代為量測 target，回應以原 id 轉回
+MSG_TYPE_GOSSIP = "PCPCS_GOSSIP"      # 只傳播成員事件 (新成員加入時的成員列表同步)
 MSG_TYPE_TEXT = "TEXT"
 MSG_TYPE_FILE = "FILE"
 MSG_TYPE_FILE_CHUNK = "FILE_CHUNK"
@@ -50,6 +169,15 @@ MSG_TYPE_PARALLEL_FILE = "PARALLEL_FILE"    # 並行檔案傳輸請求
 MSG_TYPE_PARALLEL_CHUNK = "PARALLEL_CHUNK"  # 並行分塊數據
 MSG_TYPE_PARALLEL_DONE = "PARALLEL_DONE"    # 並行傳輸完成
 
+# 持久會話訊息類型 (每個對端一條長連接，多工承載文字/控制/小檔案)
+MSG_TYPE_SESSION = "SESSION"
+
+# 持久會話參數
+SESSION_FRAME_SIZE = 65536      # 單一資料框最大負載 64KB (讓文字可穿插在檔案資料之間)
+SESSION_WINDOW_SIZE = 8388608   # 流量控制窗口 8MB (未確認的資料上限)
+SESSION_IDLE_TIMEOUT = 120      # 會話閒置超時(秒)，超過後接收端關閉連接
+SESSION_ACK_TIMEOUT = 30        # 等待串流確認的超時(秒)
+
 # 回應類型 (固定 8 bytes 避免 TCP 黏包)
 RESP_LENGTH = 8            # 回應固定長度
 RESP_ACK = "ACK".ljust(RESP_LENGTH, '_')      # 發送用: "ACK_____"
@@ -60,6 +188,19 @@ RESP_ACK_STRIPPED = "ACK"
 RESP_SKIP_STRIPPED = "SKIP"
 RESP_ERROR_STRIPPED = "ERROR"
 
+# 協定版本協商
+# 客戶端在首個標頭 (FOLDER_START / SESSION) 附上 "wire" 版本列表
+# 伺服器回應 "WIRE<n>" 表示改用版本 n；回應 ACK 表示維持 JSON (舊版對端)
+WIRE_VERSION_JSON = 0           # 4 bytes 長度 + JSON 標頭，8 bytes 填充回應
+WIRE_VERSION_BINARY = 1         # 精簡二進位標頭 (varint + 路徑前綴字典)，1 byte 回應
+WIRE_VERSIONS = (WIRE_VERSION_BINARY, WIRE_VERSION_JSON)  # 本機支援 (優先順序)
+RESP_WIRE_PREFIX = "WIRE"
+
+# 能力協商 (會話開始時的 HELLO 交換)
+COMPRESSION_CODECS = ("none", "zlib")   # 壓縮偏好順序 (區網預設不壓縮；慢速鏈路可將 zlib 排前)
+HASH_ALGORITHMS = ("sha256", "sha1", "blake2b", "md5")  # 可用的 hash (實際偏好依本機實測速度排序)
+PEER_CAPS_TTL = 300             # 對端能力與舊版判定的快取時間(秒)，過期後重新協商 (對端可能已升級或換機)
+
 # 取得本機資訊
 def get_hostname():
     return socket.gethostname()
@@ -67,16 +208,24 @@ def get_hostname():
 def get_platform():
     return platform.system()
 
-def get_local_ip():
-    """取得本機 IP 位址"""
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1"
+_local_ip = None
+
+def get_local_ip(refresh: bool = False):
+    """
+    取得本機 IP 位址 (預設路由的出口介面)
+    結果在程序內快取，視窗標題、網路發現與診斷共用同一次探測；refresh=True 時重新探測
+    """
+    global _local_ip
+    if _local_ip is None or refresh:
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+            s.close()
+        except Exception:
+            ip = "127.0.0.1"
+        _local_ip = ip
+    return _local_ip
 
 # 預設接收目錄
 import os
@@ -0,0 +1,316 @@
+"""
+PCPCS 檔案 I/O 輔助
+Page cache 管理 (posix_fadvise 預讀 / 讀寫後丟棄)
+接收端空間預留 (posix_fallocate) 與依偏移量寫入 (pwrite)
+持久性 (批次 fsync / 目錄 fsync / 區段 fdatasync)
+"""
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from .config import (
+    PAGE_CACHE_POLICY, PAGE_CACHE_WINDOW, PAGE_CACHE_MIN_SIZE,
+    DURABILITY_RANGE_SIZE, DURABILITY_SYNC_THREADS
+)
+
+# posix_fadvise 只在 Linux/BSD 可用 (macOS 與 Windows 無此函式)
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+# posix_fallocate / pwrite 只在 POSIX 平台可用
+HAS_FALLOCATE = hasattr(os, 'posix_fallocate')
+HAS_PWRITE = hasattr(os, 'pwrite')
+
+# 無 pwrite 時 lseek + write 必須成對執行
+_seek_lock = threading.Lock()
+
+# 策略
+CACHE_POLICY_DEFAULT = "default"          # 不給提示，交由作業系統決定
+CACHE_POLICY_SEQUENTIAL = "sequential"    # 只給循序讀取 / 預讀提示
+CACHE_POLICY_DROP_BEHIND = "drop_behind"  # 預讀 + 已處理區段自 page cache 丟棄
+
+
+def fadvise(fd: int, offset: int, length: int, advice_name: str):
+    """呼叫 posix_fadvise (不支援的平台或失敗時靜默忽略)"""
+    if not HAS_FADVISE:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+    except (OSError, AttributeError):
+        pass
+
+
+class CacheAdvisor:
+    """
+    為單一檔案區段 [offset, offset + length) 提供 page cache 提示
+    mode='read': 循序 + 預讀下一個窗口，已發送的窗口丟棄
+    mode='write': 已寫入的窗口丟棄 (DONTNEED 會啟動回寫，下次呼叫時乾淨頁即被釋放)
+    呼叫者以 advance(已處理字節數) 回報進度，結束時呼叫 finish()
+    filesize 為整個檔案大小 (區段只是檔案一部分時)，小於 PAGE_CACHE_MIN_SIZE 不給提示
+    """
+
+    def __init__(self, fd: int, offset: int, length: int, mode: str = 'read',
+                 filesize: int = None, policy: str = None):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.mode = mode
+        self.policy = policy or PAGE_CACHE_POLICY
+        self.enabled = (HAS_FADVISE and self.policy != CACHE_POLICY_DEFAULT
+                        and (filesize or length) >= PAGE_CACHE_MIN_SIZE)
+        self.drop = self.enabled and self.policy == CACHE_POLICY_DROP_BEHIND
+        self._next_mark = PAGE_CACHE_WINDOW
+        self._dropped = 0
+
+        if self.enabled and mode == 'read':
+            fadvise(fd, offset, length, 'POSIX_FADV_SEQUENTIAL')
+            fadvise(fd, offset, min(length, PAGE_CACHE_WINDOW * 2), 'POSIX_FADV_WILLNEED')
+
+    def advance(self, done: int):
+        """回報區段內已處理的字節數 (累計值)"""
+        if not self.enabled or done < self._next_mark:
+            return
+
+        # 對齊到窗口邊界
+        mark = done - done % PAGE_CACHE_WINDOW
+        self._next_mark = mark + PAGE_CACHE_WINDOW
+
+        if self.mode == 'read':
+            # 預讀再往後一個窗口
+            ahead = self.offset + mark + PAGE_CACHE_WINDOW
+            fadvise(self.fd, ahead, min(PAGE_CACHE_WINDOW, self.offset + self.length - ahead),
+                    'POSIX_FADV_WILLNEED')
+
+        if self.drop:
+            # 寫入時往回多涵蓋一個窗口: 上次啟動回寫的頁此時已乾淨，可被丟棄
+            start = self._dropped
+            if self.mode == 'write':
+                start = max(0, start - PAGE_CACHE_WINDOW)
+            fadvise(self.fd, self.offset + start, mark - start, 'POSIX_FADV_DONTNEED')
+            self._dropped = mark
+
+    def finish(self):
+        """區段處理完畢: 丟棄整段"""
+        if self.drop:
+            fadvise(self.fd, self.offset, self.length, 'POSIX_FADV_DONTNEED')
+
+
+# ==================== 空間預留與寫入 ====================
+
+def free_space(directory: str) -> Optional[int]:
+    """目錄所在磁碟的可用空間 (bytes)，無法查詢 (例如目錄尚未建立) 時返回 None"""
+    try:
+        return shutil.disk_usage(directory).free
+    except OSError:
+        return None
+
+
+def ensure_free_space(directory: str, size: int):
+    """確認目錄所在磁碟有足夠空間，不足時拋出 OSError(ENOSPC)"""
+    if size <= 0:
+        return
+    free = free_space(directory)
+    if free is None:
+        # 無法查詢時交由實際配置判斷
+        return
+    if free < size:
+        raise OSError(errno.ENOSPC,
+                      f"磁碟空間不足: 需要 {size} bytes，可用 {free} bytes", directory)
+
+
+def preallocate(fd: int, size: int):
+    """
+    為檔案預留 size bytes 的實際空間 (連續 extent，避免邊寫邊長)
+    檔案系統不支援 fallocate 時退回 ftruncate 設定大小
+    空間不足時拋出 OSError(ENOSPC)
+    """
+    if size <= 0:
+        return
+    if HAS_FALLOCATE:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EFBIG):
+                raise
+    os.ftruncate(fd, size)
+
+
+def open_for_write(filepath: str, size: int) -> int:
+    """建立 (截斷) 檔案並預留空間，返回可供多執行緒 write_at 的 fd"""
+    fd = os.open(filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        preallocate(fd, size)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def write_at(fd: int, data, offset: int):
+    """在指定偏移量寫入全部數據 (不移動共用的檔案位置)"""
+    view = memoryview(data)
+    while view:
+        if HAS_PWRITE:
+            n = os.pwrite(fd, view, offset)
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+
+# ==================== 持久性 ====================
+
+# 持久性等級 (由弱到強)
+DURABILITY_NONE = "none"
+DURABILITY_SESSION = "session"
+DURABILITY_FILE = "file"
+DURABILITY_RANGE = "range"
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_SESSION, DURABILITY_FILE, DURABILITY_RANGE)
+
+# fdatasync 不同步 mtime 等中繼資料，區段同步時較便宜 (macOS / Windows 無此函式)
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def durability_level(mode: str) -> int:
+    """持久性模式轉為可比較的等級 (未知模式視為 none)"""
+    if mode in DURABILITY_LEVELS:
+        return DURABILITY_LEVELS.index(mode)
+    return 0
+
+
+def fsync_path(filepath: str):
+    """以路徑 fsync 已關閉的檔案 (Windows 的 FlushFileBuffers 需要寫入權限)"""
+    flags = os.O_RDWR if os.name == 'nt' else os.O_RDONLY
+    fd = os.open(filepath, flags | getattr(os, 'O_BINARY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: str):
+    """
+    fsync 目錄，讓新建檔案的目錄項目落盤
+    Windows 無法開啟目錄、部分檔案系統不支援目錄 fsync，皆略過
+    """
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class RangeSync:
+    """
+    range 模式: 每寫入 range_size bytes 以 fdatasync 落盤一次
+    多個寫入者 (並行分塊) 可共用同一個實例
+    """
+
+    def __init__(self, fd: int, range_size: int = DURABILITY_RANGE_SIZE):
+        self.fd = fd
+        self.range_size = range_size
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes: int):
+        """回報新寫入的字節數 (增量)"""
+        with self._lock:
+            self._pending += nbytes
+            if self._pending < self.range_size:
+                return
+            self._pending = 0
+        _fdatasync(self.fd)
+
+
+class _SyncRequest:
+    __slots__ = ("paths", "dirs", "event", "error")
+
+    def __init__(self, paths: list, dirs: list):
+        self.paths = paths
+        self.dirs = dirs
+        self.event = threading.Event()
+        self.error: Optional[OSError] = None
+
+
+class GroupCommitter:
+    """
+    group commit: 多條連接同時要求落盤時合併成一批
+    背景執行緒一次取出所有等待中的請求，並行 fsync 所有檔案
+    (檔案系統可把多個 fsync 合併成少數幾次日誌提交)，每個目錄只同步一次，再喚醒等待者
+    """
+
+    def __init__(self, workers: int = DURABILITY_SYNC_THREADS):
+        self.workers = workers
+        self.batches = 0        # 已提交的批次數
+        self.files = 0          # 已 fsync 的檔案數
+        self._queue = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def sync(self, paths: Iterable[str], dirs: Iterable[str] = ()):
+        """
+        等待 paths 中的檔案與其所在目錄 (以及額外的 dirs) 落盤
+        任一檔案 fsync 失敗時拋出 OSError
+        """
+        request = _SyncRequest(list(paths), list(dirs))
+        if not request.paths and not request.dirs:
+            return
+        with self._cond:
+            self._queue.append(request)
+            if self._thread is None:
+                # 第一次使用時才啟動背景執行緒
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch, self._queue = self._queue, []
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        paths = {p for request in batch for p in request.paths}
+        errors = {}
+
+        def sync_one(filepath):
+            try:
+                fsync_path(filepath)
+            except OSError as e:
+                errors[filepath] = e
+
+        if len(paths) <= 1:
+            for filepath in paths:
+                sync_one(filepath)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(paths))) as executor:
+                list(executor.map(sync_one, paths))
+
+        # 檔案內容落盤後再同步目錄 (先子目錄後父目錄)
+        dirs = {os.path.dirname(p) for p in paths}
+        dirs.update(d for request in batch for d in request.dirs)
+        for path in sorted(dirs, key=len, reverse=True):
+            fsync_dir(path)
+
+        self.batches += 1
+        self.files += len(paths)
+        for request in batch:
+            request.error = next((errors[p] for p in request.paths if p in errors), None)
+            request.event.set()
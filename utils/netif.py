@@ -0,0 +1,196 @@
+"""
+本機網路介面列舉 (只使用標準庫)
+Linux: 以 SIOCGIFADDR / SIOCGIFNETMASK ioctl 取得每個介面的 IPv4 位址與遮罩，
+       /sys/class/net 提供連結速度與介面類型 (有線 / 無線 / VPN)
+其他平台: 沒有不依賴第三方套件的介面列舉方式，改用主機名稱解析出的位址加上預設路由的位址，
+          網段假設為 /24 (一般家用 / 辦公室網路)
+"""
+import ipaddress
+import socket
+import struct
+from typing import List, Optional
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import get_local_ip
+
+KIND_WIRED = "wired"
+KIND_WIRELESS = "wireless"
+KIND_VPN = "vpn"
+KIND_UNKNOWN = "unknown"
+
+# 無法讀取連結速度時依類型估計的頻寬 (Mbps)
+_DEFAULT_SPEED = {
+    KIND_WIRED: 1000,
+    KIND_WIRELESS: 300,
+    KIND_VPN: 50,
+    KIND_UNKNOWN: 100,
+}
+
+# VPN / 隧道介面的名稱前綴
+_VPN_PREFIXES = ("tun", "tap", "wg", "ppp", "tailscale", "zt", "utun", "ipsec")
+
+# Linux ioctl 請求碼與介面旗標
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+_IFF_UP = 0x1
+_IFF_LOOPBACK = 0x8
+_IFF_POINTOPOINT = 0x10
+
+_SYS_NET = "/sys/class/net"
+
+
+def _to_int(ip: str) -> int:
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def _to_ip(value: int) -> str:
+    return socket.inet_ntoa(struct.pack("!I", value & 0xFFFFFFFF))
+
+
+class Interface:
+    """本機的一個 IPv4 介面"""
+    __slots__ = ("name", "address", "netmask", "broadcast", "speed", "kind")
+
+    def __init__(self, name: str, address: str, netmask: str = "255.255.255.0",
+                 kind: str = KIND_UNKNOWN, speed: Optional[int] = None, point_to_point: bool = False):
+        self.name = name
+        self.address = address
+        self.netmask = netmask
+        self.kind = kind
+        self.speed = speed if speed and speed > 0 else _DEFAULT_SPEED[kind]   # Mbps
+        # 點對點 (隧道) 與 /31、/32 沒有廣播位址
+        mask = _to_int(netmask)
+        if point_to_point or mask >= 0xFFFFFFFE:
+            self.broadcast: Optional[str] = None
+        else:
+            self.broadcast = _to_ip(_to_int(address) | ~mask)
+
+    def contains(self, ip: str) -> bool:
+        """ip 是否在此介面的網段內"""
+        try:
+            mask = _to_int(self.netmask)
+            return _to_int(ip) & mask == _to_int(self.address) & mask
+        except OSError:
+            return False
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "address": self.address,
+            "netmask": self.netmask,
+            "broadcast": self.broadcast,
+            "speed": self.speed,
+            "kind": self.kind
+        }
+
+    def __repr__(self):
+        return f"Interface({self.name!r}, {self.address}/{self.netmask}, {self.kind}, {self.speed}Mbps)"
+
+
+def _sys_value(name: str, entry: str) -> Optional[str]:
+    try:
+        with open(os.path.join(_SYS_NET, name, entry)) as f:
+            return f.read().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def _linux_kind(name: str, point_to_point: bool) -> str:
+    if os.path.isdir(os.path.join(_SYS_NET, name, "wireless")):
+        return KIND_WIRELESS
+    # type 65534 為 ARPHRD_NONE (tun / wireguard)
+    if point_to_point or name.startswith(_VPN_PREFIXES) or _sys_value(name, "type") == "65534":
+        return KIND_VPN
+    if os.path.exists(os.path.join(_SYS_NET, name, "device")):
+        return KIND_WIRED
+    return KIND_UNKNOWN
+
+
+def _linux_speed(name: str) -> Optional[int]:
+    # 未連線或虛擬介面讀取失敗 / 為 -1
+    try:
+        return int(_sys_value(name, "speed") or "")
+    except ValueError:
+        return None
+
+
+def _list_linux() -> List[Interface]:
+    import fcntl
+
+    interfaces = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            request = struct.pack("256s", name.encode("utf-8")[:15])
+            try:
+                flags = struct.unpack("H", fcntl.ioctl(sock.fileno(), _SIOCGIFFLAGS, request)[16:18])[0]
+                if not flags & _IFF_UP or flags & _IFF_LOOPBACK:
+                    continue
+                # 沒有 IPv4 位址的介面在此拋出 OSError (EADDRNOTAVAIL)
+                address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, request)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFNETMASK, request)[20:24])
+            except OSError:
+                continue
+            point_to_point = bool(flags & _IFF_POINTOPOINT)
+            interfaces.append(Interface(name, address, netmask, _linux_kind(name, point_to_point),
+                                        _linux_speed(name), point_to_point))
+    finally:
+        sock.close()
+    return interfaces
+
+
+def _list_fallback() -> List[Interface]:
+    addresses = []
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.append(info[4][0])
+    except OSError:
+        pass
+    addresses.append(get_local_ip())
+    return [Interface("", address) for address in dict.fromkeys(addresses)
+            if not address.startswith("127.")]
+
+
+def list_interfaces() -> List[Interface]:
+    """列出已啟用、有 IPv4 位址的非迴路介面 (無法列舉時返回空列表)"""
+    if sys.platform.startswith("linux") and hasattr(socket, "if_nameindex"):
+        try:
+            return _list_linux()
+        except (OSError, ImportError):
+            pass
+    return _list_fallback()
+
+
+def interface_for(ip: str, interfaces: List[Interface]) -> Optional[Interface]:
+    """返回與 ip 在同一網段的本機介面 (遮罩最長者優先)，不在任何本機網段內時返回 None"""
+    best = None
+    for iface in interfaces:
+        if iface.contains(ip) and (best is None or _to_int(iface.netmask) > _to_int(best.netmask)):
+            best = iface
+    return best
+
+
+def subnet_hosts(cidrs: List[str], interfaces: List[Interface], limit: int) -> List[str]:
+    """
+    CIDR 列表中的主機位址 (最多 limit 個)
+    cidrs 為空時使用各介面位址所在的 /24 (不含 VPN 介面: 不主動掃描隧道另一端的網路)
+    """
+    if not cidrs:
+        cidrs = [f"{iface.address}/24" for iface in interfaces if iface.kind != KIND_VPN]
+    hosts: List[str] = []
+    for cidr in cidrs:
+        try:
+            network = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            continue
+        if network.version != 4:
+            continue
+        for host in network.hosts():
+            if len(hosts) >= limit:
+                return list(dict.fromkeys(hosts))
+            hosts.append(str(host))
+    return list(dict.fromkeys(hosts))